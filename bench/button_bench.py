@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Latency of ubrain-daemon's button reports, from the serial line arriving to a
+## reader finding out, for each way of finding out:
+##
+##     socket   blocked in recv() on buttons.sock
+##     mmap     spinning on the sequence number in buttons.state
+##     file     spinning on os.path.exists(buttonA), as fast as it can go - anything
+##              that polls it less often adds up to its polling interval on top
+##
+##     python bench/button_bench.py [--presses N] [--json results.json]
+##
+## Runs ubrain-daemon on a pty, so needs pyserial but not a uBrain.
+##
+
+import os
+import pty
+import sys
+import time
+import json
+import tty
+import shutil
+import socket
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+sys.path.insert(0, BIN_DIR)
+import button_state
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(master, presses, wait):
+    ''' Press and release button 0 presses times, calling wait(on) after writing
+        each line to find out when the reader sees it.
+        Returns: list of latencies in seconds'''
+    latencies = []
+    for i in range(presses):
+        for on in (True, False):
+            start = time.time()
+            os.write(master, on and "!ON 0\r\n" or "!OFF 0\r\n")
+            wait(on)
+            latencies.append(time.time() - start)
+        # let the daemon settle, so each press starts from idle
+        time.sleep(0.002)
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--presses", dest="presses", default=500, type="int",
+                      help="How many presses to time for each reader. Default 500")
+    parser.add_option("--json", dest="json_file",
+                      help="Write results to this file as JSON")
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="soma-buttons-")
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    state_file = os.path.join(tmpdir, "buttons.state")
+    socket_path = os.path.join(tmpdir, "buttons.sock")
+    with open(os.devnull, "w") as devnull:
+        daemon = subprocess.Popen([sys.executable, os.path.join(BIN_DIR, "ubrain-daemon"),
+                                   "--button-dir", tmpdir, "--state-file", state_file,
+                                   "--socket", socket_path, "--button-timeout", "10",
+                                   "--telemetry-socket", "", "--log-dir", "",
+                                   os.ttyname(slave)], stdout=devnull)
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        time.sleep(0.2)
+
+        subscriber = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        subscriber.connect(socket_path)
+        def wait_socket(on):
+            subscriber.recv(64)
+
+        reader = button_state.StateReader(state_file)
+        def wait_mmap(on):
+            while reader.read()[1][0][0] != on:
+                pass
+
+        button_file = os.path.join(tmpdir, "buttonA")
+        def wait_file(on):
+            while os.path.exists(button_file) != on:
+                pass
+
+        results = []
+        for name, wait in (("socket", wait_socket), ("mmap", wait_mmap), ("file", wait_file)):
+            latencies = measure(master, options.presses, wait)
+            result = {"name": "button/%s" % name, "count": len(latencies),
+                      "median_us": percentile(latencies, 0.5) * 1e6,
+                      "p90_us": percentile(latencies, 0.9) * 1e6,
+                      "p99_us": percentile(latencies, 0.99) * 1e6}
+            results.append(result)
+            print "%-15s median %7.1f us   p90 %7.1f us   p99 %7.1f us" % \
+                  (result["name"], result["median_us"], result["p90_us"], result["p99_us"])
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(tmpdir)
+
+    if options.json_file:
+        with open(options.json_file, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
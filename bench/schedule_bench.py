@@ -0,0 +1,375 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Timing benchmarks for sunCalcs.py and new_schedule.py.
+##
+##     python bench/schedule_bench.py [--json results.json] [--compare baseline.json]
+##
+## Each benchmark is timed over several rounds and the best round is reported, as
+## microseconds per operation. --json writes the results out as a list of objects:
+##     {"name": ..., "ops": ..., "us_per_op": ..., "seconds": ...}
+## and --compare checks them against an earlier --json file, exiting with status 1
+## if anything got slower by more than --threshold.
+##
+
+import os
+import sys
+import time
+import json
+import shutil
+import datetime
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import sunCalcs
+import tzfile
+import new_schedule
+import multi_schedule
+
+CONF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "conf")
+NEW_SCHEDULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "new_schedule.py")
+
+SITES = [
+    ("pier14", 37.451688, 122.18305),
+    ("tromso", 69.6492, -18.9553),
+    ("alert", 82.5018, 62.3481),
+    ("mcmurdo", -77.846, -166.676),
+]
+
+
+def timeit(func, rounds=3, min_time=0.2):
+    ''' Call func until at least min_time has passed, rounds times.
+        func returns the number of operations it did.
+        Returns: (operations, seconds) of the fastest round'''
+    best = None
+    for i in range(rounds):
+        ops = 0
+        start = time.time()
+        while True:
+            ops += func()
+            elapsed = time.time() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / ops < best[1] / best[0]:
+            best = (ops, elapsed)
+    return best
+
+
+def write_schedule(filename, first_date, days, default=True):
+    ''' Write a schedule file with one line per day, in the style of conf/schedule.conf'''
+    times = ["sunset+10   2:00am", "8:00pm      2:00am", "sunset-20   11:30pm", "sunrise     9:00am"]
+    with open(filename, "w") as f:
+        for i in range(days):
+            date = first_date + datetime.timedelta(days=i)
+            f.write("%s      %s\n" % (date.isoformat(), times[i % len(times)]))
+        if default:
+            f.write("default         sunset-20  2:00am\n")
+
+
+def set_site(latitude, longitude):
+    new_schedule.default_parser.latitude = latitude
+    new_schedule.default_parser.longitude = longitude
+    new_schedule.default_parser.sun_cache = sunCalcs.SunCache()
+
+
+def bench_calcSun(results):
+    start = datetime.date(2014, 1, 1)
+    for name, latitude, longitude in SITES:
+        def run():
+            for i in range(365):
+                sunCalcs.calcSun(latitude, longitude, start + datetime.timedelta(days=i))
+            return 365
+        results.append(("calcSun/%s" % name,) + timeit(run, min_time=0.5))
+
+
+def bench_calcNextSun(results):
+    now = time.mktime((2014, 7, 1, 12, 0, 0, 0, 0, -1))
+    for name, latitude, longitude in SITES:
+        def run():
+            for i in range(50):
+                sunCalcs.calcNextSun(latitude, longitude, None, now + i * 86400 * 7)
+            return 50
+        results.append(("calcNextSun/%s" % name,) + timeit(run))
+
+
+def bench_parse_relative_time(results):
+    for name, latitude, longitude in SITES[:2]:
+        for token in ("8:00pm", "sunset+10", "civil-dusk"):
+            def run():
+                set_site(latitude, longitude)     # empty cache every round
+                for day in range(1, 29):
+                    new_schedule.parse_relative_time(2014, 7, day, token)
+                return 28
+            results.append(("parse_relative_time/%s/%s" % (name, token),) + timeit(run))
+
+
+def bench_timezone(results):
+    ''' Clock times to unix time for every day of 20 years, through libc as
+        parse_relative_time used to, and through tzfile with its per-day cache
+        empty and full'''
+    days = [datetime.date(2014, 1, 1) + datetime.timedelta(days=i) for i in range(20 * 365)]
+
+    def mktime():
+        for day in days:
+            time.mktime((day.year, day.month, day.day, 20, 0, 0, 0, 0, -1))
+        return len(days)
+
+    def cold():
+        zone = tzfile.TimeZone.load("America/Los_Angeles")
+        for day in days:
+            zone.local_to_utc(day.year, day.month, day.day, 20, 0)
+        return len(days)
+
+    zone = tzfile.TimeZone.load("America/Los_Angeles")
+
+    def warm():
+        for day in days:
+            zone.local_to_utc(day.year, day.month, day.day, 20, 0)
+        return len(days)
+    results.append(("timezone/mktime",) + timeit(mktime))
+    results.append(("timezone/tzfile/cold",) + timeit(cold))
+    results.append(("timezone/tzfile/warm",) + timeit(warm))
+
+
+def bench_read_schedule_file(results, tmpdir):
+    files = [("schedule.conf", os.path.join(CONF_DIR, "schedule.conf"))]
+    for years in (1, 5, 20):
+        filename = os.path.join(tmpdir, "schedule-%dy.conf" % years)
+        write_schedule(filename, datetime.date(2014, 1, 1), years * 365)
+        files.append(("%dyears" % years, filename))
+    # the same 20 years as a handful of rules
+    filename = os.path.join(tmpdir, "schedule-rules.conf")
+    with open(filename, "w") as f:
+        f.write("2014-01-01..2033-12-31  sunset+10   2:00am\n")
+        f.write("2014-01-01..2033-12-31  8:00pm      2:00am  tue,fri  priority=3\n")
+        f.write("2014-01-01..2033-12-31  off                 mon\n")
+        f.write("default                 sunset-20   2:00am\n")
+    files.append(("20years-rules", filename))
+
+    # the middle of the generated files, so the window has lines in it
+    now = time.mktime((2014, 7, 1, 12, 0, 0, 0, 0, -1))
+    for name, latitude, longitude in (SITES[0], SITES[2]):
+        for label, filename in files:
+            for window in (2, None):
+                def run():
+                    set_site(latitude, longitude)
+                    new_schedule.read_schedule_file(filename, now, window)
+                    return 1
+                results.append(("read_schedule_file/%s/%s/%s" % (name, label, "all" if window is None else window),)
+                               + timeit(run, min_time=0.5))
+
+
+def bench_disposition(results, tmpdir):
+    ''' disposition against the interval index, and the linear scan over every
+        schedule that it replaced'''
+    set_site(*SITES[0][1:])
+    for years in (1, 20, 50):
+        filename = os.path.join(tmpdir, "schedule-%dy.conf" % years)
+        write_schedule(filename, datetime.date(2014, 1, 1), years * 365)
+        new_schedule.read_schedule_file(filename, window=None)
+        first = time.mktime((2014, 1, 1, 0, 0, 0, 0, 0, -1))
+        queries = [first + i * 3607.0 * years for i in range(1000)]
+        windows = [(s["start"], s["end"]) for s in new_schedule.default_parser.schedules]
+
+        def linear():
+            for now in queries:
+                for start, end in windows:
+                    if start <= now and end > now:
+                        break
+            return len(queries)
+
+        def run():
+            for now in queries:
+                new_schedule.disposition(now)
+            return len(queries)
+
+        def transition():
+            for now in queries:
+                new_schedule.default_parser.schedule_index.next_transition(now)
+            return len(queries)
+        results.append(("disposition/%dyears/linear" % years,) + timeit(linear))
+        results.append(("disposition/%dyears" % years,) + timeit(run))
+        results.append(("next_transition/%dyears" % years,) + timeit(transition))
+
+
+def bench_simulate(results):
+    ''' A year of one-minute samples, including working out the year's sun times'''
+    filename = os.path.join(CONF_DIR, "new_schedule.conf")
+    for name, latitude, longitude in (SITES[0], SITES[2]):
+        def run():
+            set_site(latitude, longitude)
+            new_schedule.read_schedule_file(filename, time.mktime((2014, 1, 1, 12, 0, 0, 0, 0, -1)))
+            new_schedule.simulate(datetime.date(2014, 1, 1), datetime.date(2014, 12, 31))
+            return 1
+        results.append(("simulate/%s/1year" % name,) + timeit(run, min_time=1.0))
+
+
+def bench_cache(results, tmpdir):
+    ''' Whole new_schedule.py runs, as cron does them: cold (no compiled schedule),
+        warm (compiled schedule up to date) and with --no-cache. Not dry runs, which
+        don't write the compiled schedule, so they run true or false like cron would
+        run soma-start or soma-stop.'''
+    for label, filename in (("schedule.conf", os.path.join(CONF_DIR, "schedule.conf")),
+                            ("20years", os.path.join(tmpdir, "schedule-20y.conf"))):
+        if not os.path.exists(filename):
+            write_schedule(filename, datetime.date(2014, 1, 1), 20 * 365)
+        schedule_file = os.path.join(tmpdir, "cache-" + os.path.basename(filename))
+        shutil.copy(filename, schedule_file)
+        cache_file = os.path.splitext(schedule_file)[0] + ".cache"
+        command = [sys.executable, NEW_SCHEDULE, "--schedule", schedule_file,
+                   "--config", os.path.join(CONF_DIR, "latlong.conf"), "--ephemeris", "/nonexistent",
+                   "--start", "true", "--stop", "false", "--state-file", os.path.join(tmpdir, "scheduler.state")]
+        with open(os.devnull, "w") as devnull:
+            def cold():
+                if os.path.exists(cache_file):
+                    os.remove(cache_file)
+                subprocess.check_call(command, stdout=devnull)
+                return 1
+
+            def warm():
+                subprocess.check_call(command, stdout=devnull)
+                return 1
+
+            def nocache():
+                subprocess.check_call(command + ["--no-cache"], stdout=devnull)
+                return 1
+            results.append(("new_schedule/%s/cold" % label,) + timeit(cold, min_time=1.0))
+            results.append(("new_schedule/%s/warm" % label,) + timeit(warm, min_time=1.0))
+            results.append(("new_schedule/%s/nocache" % label,) + timeit(nocache, min_time=1.0))
+
+
+def bench_multisite(results, tmpdir):
+    ''' Loading and querying hundreds of sites, spread over 20 locations and 4
+        schedules, against looking each one up in its own IntervalIndex'''
+    schedules = ["default  sunset+10   2:00am\n", "default  sunset-20   11:30pm\n",
+                 "default  civil-dusk  1:00am\n", "default  8:00pm      2:00am  fri,sat\n"]
+    for i, text in enumerate(schedules):
+        with open(os.path.join(tmpdir, "site-%d.sch" % i), "w") as f:
+            f.write(text)
+    for i in range(20):
+        with open(os.path.join(tmpdir, "site-%d.conf" % i), "w") as f:
+            f.write("latitude=%f\nlongitude=%f\ntimezone=America/Los_Angeles\n" % (30 + i, 100 + i * 2))
+    now = time.mktime((2014, 7, 1, 12, 0, 0, 0, 0, -1))
+    for count in (100, 500):
+        sites_file = os.path.join(tmpdir, "sites-%d.conf" % count)
+        with open(sites_file, "w") as f:
+            for i in range(count):
+                f.write("site%d  site-%d.conf  site-%d.sch\n" % (i, i % 20, i % 4))
+        sites = multi_schedule.read_sites_file(sites_file)
+
+        def load():
+            multi_schedule.SiteSet(sites, ephemeris_file="/nonexistent").load(now)
+            return 1
+        results.append(("multisite/%d/load" % count,) + timeit(load, min_time=1.0))
+
+        site_set = multi_schedule.SiteSet(sites, ephemeris_file="/nonexistent")
+        site_set.load(now)
+        queries = [now + i * 599.0 for i in range(100)]
+
+        def batched():
+            for t in queries:
+                site_set.states(t)
+            return len(queries)
+
+        indexes = [site.compiled.index for site in sites]
+
+        def per_site():
+            for t in queries:
+                for index in indexes:
+                    index.contains(t)
+                    index.next_transition(t)
+            return len(queries)
+        results.append(("multisite/%d/query" % count,) + timeit(batched))
+        results.append(("multisite/%d/query/per_site" % count,) + timeit(per_site))
+
+
+def bench_threads(results):
+    ''' Scheduler.state from several threads at once, with and without another
+        thread swapping in a freshly compiled schedule every 10ms. Threads share
+        the GIL, so this shows what locking costs rather than any speedup.'''
+    now = time.mktime((2014, 8, 1, 12, 0, 0, 0, 0, -1))
+    scheduler = new_schedule.Scheduler(os.path.join(CONF_DIR, "schedule.conf"),
+                                       os.path.join(CONF_DIR, "latlong.conf"))
+    scheduler.reload(now)
+    queries = [now + i * 61.0 for i in range(5000)]
+    for threads in (1, 2, 4, 8):
+        for reloading in (False, True):
+            def run():
+                stop = []
+
+                def reloader():
+                    while not stop:
+                        scheduler.reload(now, check_files=False)
+                        time.sleep(0.01)
+
+                def worker():
+                    for t in queries:
+                        scheduler.state(t)
+                workers = [threading.Thread(target=worker) for i in range(threads)]
+                if reloading:
+                    workers.append(threading.Thread(target=reloader))
+                for thread in workers:
+                    thread.start()
+                for thread in workers[:threads]:
+                    thread.join()
+                stop.append(True)
+                for thread in workers[threads:]:
+                    thread.join()
+                return threads * len(queries)
+            results.append(("scheduler/%dthreads%s" % (threads, reloading and "/reloading" or ""),)
+                           + timeit(run))
+
+
+def compare(results, baseline_file, threshold):
+    ''' Returns: list of benchmark names that got slower than baseline * threshold'''
+    with open(baseline_file) as f:
+        baseline = dict((r["name"], r["us_per_op"]) for r in json.load(f))
+    slower = []
+    for r in results:
+        if r["name"] in baseline and r["us_per_op"] > baseline[r["name"]] * threshold:
+            slower.append(r["name"])
+            print "SLOWER %-50s %10.1f us (was %.1f)" % (r["name"], r["us_per_op"], baseline[r["name"]])
+    return slower
+
+
+BENCHMARKS = ["calcSun", "calcNextSun", "parse_relative_time", "timezone", "read_schedule_file", "disposition", "simulate", "cache", "multisite", "threads"]
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--bench", dest="bench", action="append",
+                      help="Benchmark to run: %s. Default all" % ", ".join(BENCHMARKS))
+    parser.add_option("--json", dest="json_file",
+                      help="Write results to this file as JSON")
+    parser.add_option("--compare", dest="baseline_file",
+                      help="Compare with results from an earlier --json run")
+    parser.add_option("--threshold", dest="threshold", default=1.25, type="float",
+                      help="How much slower than the baseline counts as a regression. Default 1.25")
+    options, args = parser.parse_args()
+
+    # schedules are in local time; pin it so runs are comparable
+    os.environ["TZ"] = "America/Los_Angeles"
+    time.tzset()
+
+    tmpdir = tempfile.mkdtemp(prefix="soma-bench-")
+    raw = []
+    for name in options.bench or BENCHMARKS:
+        if name in ("read_schedule_file", "disposition", "cache", "multisite"):
+            globals()["bench_" + name](raw, tmpdir)
+        else:
+            globals()["bench_" + name](raw)
+
+    results = []
+    for name, ops, seconds in raw:
+        results.append({"name": name, "ops": ops, "seconds": seconds, "us_per_op": seconds / ops * 1e6})
+        print "%-50s %10.1f us/op" % (name, seconds / ops * 1e6)
+
+    if options.json_file:
+        with open(options.json_file, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if options.baseline_file and compare(results, options.baseline_file, options.threshold):
+        sys.exit(1)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Checks of which schedule lines new_schedule.py applies to a day. Run from anywhere:
+##     python bench/schedule_rules.py [--json results.json]
+##
+## Each check writes a small schedule file, reads it with conf/latlong.conf, and
+## compares the (start, end) of the lines that apply to a day (rules_for_day), or
+## whether the system should be on at a time, with what README_newschedule.txt says.
+## In particular, a default line only applies to days without a line of their own -
+## it is not added on top of them, as it was before the interval index.
+##
+## Exits with status 1 if any check fails.
+##
+
+import os
+import sys
+import json
+import shutil
+import datetime
+import tempfile
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "bin"))
+import new_schedule
+
+LATLONG_FILE = os.path.join(BENCH_DIR, "..", "conf", "latlong.conf")
+
+# 2014-08-04 is a Monday
+MONDAY = datetime.date(2014, 8, 4)
+TUESDAY = datetime.date(2014, 8, 5)
+SATURDAY = datetime.date(2014, 8, 9)
+
+# name, schedule lines, day, the (start, end) that should apply that day
+DAY_CHECKS = [
+    ("default alone", ["default sunset-20 2:00am"],
+     MONDAY, [("sunset-20", "2:00am")]),
+    ("a day's own line replaces default", ["default sunset-20 2:00am", "2014-08-04 8:00pm 11:00pm"],
+     MONDAY, [("8:00pm", "11:00pm")]),
+    ("default still applies the next day", ["default sunset-20 2:00am", "2014-08-04 8:00pm 11:00pm"],
+     TUESDAY, [("sunset-20", "2:00am")]),
+    ("two lines for one day both apply", ["default sunset-20 2:00am", "2014-08-04 8:00pm 11:00pm",
+                                          "2014-08-04 sunset-20 2:00am"],
+     MONDAY, [("8:00pm", "11:00pm"), ("sunset-20", "2:00am")]),
+    ("a range replaces default", ["default sunset-20 2:00am", "2014-08-01..2014-08-31 sunset+10 1:00am"],
+     MONDAY, [("sunset+10", "1:00am")]),
+    ("a date replaces a range", ["2014-08-01..2014-08-31 sunset+10 1:00am", "2014-08-04 8:00pm 11:00pm"],
+     MONDAY, [("8:00pm", "11:00pm")]),
+    ("off turns default off", ["default sunset-20 2:00am", "2014-08-01..2014-08-31 off mon"],
+     MONDAY, []),
+    ("off only on its weekdays", ["default sunset-20 2:00am", "2014-08-01..2014-08-31 off mon"],
+     TUESDAY, [("sunset-20", "2:00am")]),
+    ("weekday default", ["default sunset-20 2:00am sat,sun"],
+     MONDAY, []),
+    ("weekday default on its day", ["default sunset-20 2:00am sat,sun"],
+     SATURDAY, [("sunset-20", "2:00am")]),
+    ("priority lets default win", ["default sunset-20 2:00am priority=5", "2014-08-04 8:00pm 11:00pm"],
+     MONDAY, [("sunset-20", "2:00am")]),
+]
+
+# name, schedule lines, local time (y, m, d, h, min), whether it should be on
+ON_CHECKS = [
+    ("on in the day's own window", ["default sunset-20 2:00am", "2014-08-04 8:00pm 11:00pm"],
+     (2014, 8, 4, 22, 30), True),
+    ("off after it, although default would be on", ["default sunset-20 2:00am", "2014-08-04 8:00pm 11:00pm"],
+     (2014, 8, 4, 23, 30), False),
+    ("default the night before runs on past midnight", ["default sunset-20 2:00am", "2014-08-04 8:00pm 11:00pm"],
+     (2014, 8, 4, 1, 30), True),
+]
+
+
+def read_lines(directory, lines):
+    ''' Returns: ScheduleParser that has read lines as a schedule file'''
+    filename = os.path.join(directory, "schedule.conf")
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    schedule_parser = new_schedule.ScheduleParser()
+    schedule_parser.read_config_file(LATLONG_FILE)
+    schedule_parser.read_schedule_file(filename, window=None)
+    return schedule_parser
+
+
+def check_days(directory):
+    failures = []
+    for name, lines, day, expected in DAY_CHECKS:
+        got = [rule["times"] for rule in read_lines(directory, lines).rules_for_day(day)]
+        if sorted(got) != sorted(expected):
+            failures.append("%s: %s expected %s got %s" % (name, day, expected, got))
+    return {"name": "rules_for_day", "count": len(DAY_CHECKS), "failures": failures}
+
+
+def check_on(directory):
+    failures = []
+    for name, lines, when, expected in ON_CHECKS:
+        schedule_parser = read_lines(directory, lines)
+        now = schedule_parser.get_timezone().local_to_utc(*when)
+        got = schedule_parser.disposition(now)
+        if got != expected:
+            failures.append("%s: %s expected %s got %s" % (name, when, expected and "on" or "off",
+                                                           got and "on" or "off"))
+    return {"name": "disposition", "count": len(ON_CHECKS), "failures": failures}
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--json", dest="json_file",
+                      help="Write results to this file as JSON")
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="soma-rules-")
+    try:
+        results = [check_days(tmpdir), check_on(tmpdir)]
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for result in results:
+        print "%-14s %5d checked %5d failed" % (result["name"], result["count"], len(result["failures"]))
+        for failure in result["failures"]:
+            print "   ", failure
+
+    if options.json_file:
+        with open(options.json_file, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if any(result["failures"] for result in results):
+        sys.exit(1)
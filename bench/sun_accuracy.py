@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Accuracy checks for sunCalcs.py. Run from anywhere:
+##     python bench/sun_accuracy.py [--json results.json]
+##
+## Two sets of data to check against:
+##   conf/sunset.dat          published local sunset times for the Bay Area, to the
+##                            minute. The only independent reference here; the site
+##                            isn't exactly Pier 14, so allow a few minutes.
+##   bench/sun_snapshot.txt   sunrise, sunset and civil twilight from calcSun and
+##                            calcSunEvents, one line per site and date, including polar
+##                            sites. A regression snapshot of sunCalcs.py's own output,
+##                            not a reference: it can only catch a change in the numbers,
+##                            not say whether they were right. After a change that is
+##                            *meant* to move them, check the differences and rewrite it
+##                            with --regenerate.
+##
+## Exits with status 1 if any check fails.
+##
+
+import os
+import sys
+import time
+import json
+import datetime
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "bin"))
+import sunCalcs
+
+SUNSET_FILE = os.path.join(BENCH_DIR, "..", "conf", "sunset.dat")
+LATLONG_FILE = os.path.join(BENCH_DIR, "..", "conf", "latlong.conf")
+SNAPSHOT_FILE = os.path.join(BENCH_DIR, "sun_snapshot.txt")
+
+SNAPSHOT_SITES = [
+    ("pier14",     37.451688,  122.18305),
+    ("equator",     0.0,         0.0),
+    ("sydney",    -33.8688,   -151.2093),
+    ("tromso",     69.6492,    -18.9553),
+    ("longyear",   78.2232,    -15.6267),
+    ("alert",      82.5018,     62.3481),
+    ("mcmurdo",   -77.846,    -166.676),
+]
+
+
+def read_latlong(filename):
+    ''' Read latitude and longitude the way new_schedule.read_config_file does'''
+    latitude = longitude = None
+    with open(filename) as f:
+        for line in f:
+            name, var = line.partition("=")[::2]
+            if name.lower() == "latitude":
+                latitude = float(var)
+            elif name.lower() == "longitude":
+                longitude = float(var)
+    return latitude, longitude
+
+
+def parse_local(date, hhmm):
+    ''' "2014-04-01", "7:32pm" -> unix time, in the local timezone'''
+    year, month, day = [int(x) for x in date.split("-")]
+    hour, minute = [int(x) for x in hhmm[:-2].split(":")]
+    if hhmm[-2:].lower() == "pm" and hour != 12:
+        hour += 12
+    elif hhmm[-2:].lower() == "am" and hour == 12:
+        hour = 0
+    return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+
+def check_sunset_dat(tolerance):
+    ''' Compare calcSun sunsets with conf/sunset.dat.
+        Returns: dict of results'''
+    latitude, longitude = read_latlong(LATLONG_FILE)
+    errors = []
+    failures = []
+    with open(SUNSET_FILE) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            date, hhmm = fields
+            expected = parse_local(date, hhmm)
+            riseTime, setTime = sunCalcs.calcSun(latitude, longitude,
+                                                 datetime.date(*[int(x) for x in date.split("-")]))
+            # the table is truncated to the minute
+            error = (setTime - expected - 30) / 60.0
+            errors.append(error)
+            if abs(error) > tolerance:
+                failures.append("%s expected %s got %s" % (date, hhmm, time.strftime("%I:%M:%S%p", time.localtime(setTime))))
+    return {"name": "sunset.dat", "count": len(errors), "failures": failures,
+            "max_error_min": max(abs(e) for e in errors), "mean_error_min": sum(errors) / len(errors)}
+
+
+def snapshot_dates():
+    dates = []
+    for year in (2014, 2020, 2033):
+        for month in range(1, 13):
+            dates.append(datetime.date(year, month, 1))
+            dates.append(datetime.date(year, month, 21))
+    return dates
+
+
+def snapshot_line(name, latitude, longitude, date):
+    riseTime, setTime = sunCalcs.calcSun(latitude, longitude, date)
+    dawn, dusk = sunCalcs.calcSunEvents(latitude, longitude, date, [sunCalcs.TWILIGHT_ZENITHS["civil"]])[0]
+    fields = [name, date.isoformat(), riseTime, setTime, dawn, dusk]
+    return fields
+
+
+def format_snapshot(fields):
+    values = []
+    for value in fields[2:]:
+        if sunCalcs.isNumber(value):
+            values.append("%.1f" % value)
+        else:
+            values.append("-")
+    return "%-10s %s %s" % (fields[0], fields[1], " ".join(values))
+
+
+def regenerate_snapshot():
+    with open(SNAPSHOT_FILE, "w") as f:
+        f.write("# site date sunrise sunset civil-dawn civil-dusk (unix time, - for none)\n")
+        for name, latitude, longitude in SNAPSHOT_SITES:
+            f.write("# %s %s %s\n" % (name, latitude, longitude))
+        for name, latitude, longitude in SNAPSHOT_SITES:
+            for date in snapshot_dates():
+                f.write(format_snapshot(snapshot_line(name, latitude, longitude, date)) + "\n")
+
+
+def check_snapshot(tolerance):
+    ''' Compare calcSun and civil twilight with the snapshot of what they gave before.
+        Returns: dict of results'''
+    sites = dict((name, (latitude, longitude)) for name, latitude, longitude in SNAPSHOT_SITES)
+    worst = 0.0
+    count = 0
+    failures = []
+    with open(SNAPSHOT_FILE) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.split()
+            name, date = fields[0], fields[1]
+            latitude, longitude = sites[name]
+            got = snapshot_line(name, latitude, longitude,
+                              datetime.date(*[int(x) for x in date.split("-")]))[2:]
+            for label, expected, value in zip(("sunrise", "sunset", "dawn", "dusk"), fields[2:], got):
+                count += 1
+                if expected == "-" or not sunCalcs.isNumber(value):
+                    if expected != "-" or sunCalcs.isNumber(value):
+                        failures.append("%s %s %s expected %s got %s" % (name, date, label, expected, value))
+                    continue
+                error = abs(value - float(expected))
+                worst = max(worst, error)
+                if error > tolerance:
+                    failures.append("%s %s %s off by %.1fs" % (name, date, label, error))
+    return {"name": "snapshot", "count": count, "failures": failures, "max_error_s": worst}
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--json", dest="json_file",
+                      help="Write results to this file as JSON")
+    parser.add_option("--regenerate", dest="regenerate", default=False, action="store_true",
+                      help="Rewrite %s from the current code" % os.path.basename(SNAPSHOT_FILE))
+    parser.add_option("--sunset-tolerance", dest="sunset_tolerance", default=4.0, type="float",
+                      help="Allowed difference from sunset.dat, in minutes. Default 4")
+    parser.add_option("--snapshot-tolerance", dest="snapshot_tolerance", default=1.0, type="float",
+                      help="Allowed difference from the snapshot, in seconds. Default 1")
+    options, args = parser.parse_args()
+
+    # sunset.dat is in Pacific time
+    os.environ["TZ"] = "America/Los_Angeles"
+    time.tzset()
+
+    if options.regenerate:
+        regenerate_snapshot()
+
+    results = [check_sunset_dat(options.sunset_tolerance), check_snapshot(options.snapshot_tolerance)]
+    for result in results:
+        print "%-12s %5d checked %5d failed" % (result["name"], result["count"], len(result["failures"])),
+        print " ".join("%s=%.3g" % (k, v) for k, v in sorted(result.items()) if k.startswith(("max", "mean")))
+        for failure in result["failures"][:20]:
+            print "   ", failure
+
+    if options.json_file:
+        with open(options.json_file, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if any(result["failures"] for result in results):
+        sys.exit(1)
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Benchmarks for sunCalcs.py. Run from anywhere:
+##     python bench/sun_bench.py [--days N]
+##
+## "legacy" is the calculation as it was before the solar state was fused: every
+## sunrise and sunset computed solar noon from scratch, and equation of time and
+## declination were worked out separately, each redoing the obliquity, mean
+## longitude and anomaly of the sun. For the polar searches, "legacy" is the old
+## one-day-at-a-time scan for the nearest day with a sunrise or sunset.
+##
+
+import os
+import sys
+import time
+import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import sunCalcs
+from sunCalcs import calcTimeJulianCent, calcJDFromJulianCent, calcEquationOfTime, \
+                     calcSunDeclination, calcHourAngleSunrise, calcHourAngleSunset, radToDeg
+
+SITES = [
+    ("Pier 14",    37.451688, 122.18305),
+    ("Equator",     0.0,        0.0),
+    ("Tromso",     69.6492,   -18.9553),
+    ("McMurdo",   -77.846,   -166.676),
+]
+
+POLAR_SITES = [
+    ("Tromso",     69.6492,   -18.9553),
+    ("Longyear",   78.2232,   -15.6267),
+    ("Alert",      82.5018,    62.3481),
+    ("McMurdo",   -77.846,   -166.676),
+    ("Pole",      -89.0,        0.0),
+]
+
+
+def legacySolNoonUTC(t, longitude):
+    tnoon = calcTimeJulianCent(calcJDFromJulianCent(t) + longitude / 360.0)
+    eqTime = calcEquationOfTime(tnoon)
+    solNoonUTC = 720 + (longitude * 4) - eqTime
+    newt = calcTimeJulianCent(calcJDFromJulianCent(t) - 0.5 + solNoonUTC / 1440.0)
+    eqTime = calcEquationOfTime(newt)
+    return 720 + (longitude * 4) - eqTime
+
+
+def legacySunEventUTC(JD, latitude, longitude, calcHourAngle):
+    t = calcTimeJulianCent(JD)
+    noonmin = legacySolNoonUTC(t, longitude)
+    tnoon = calcTimeJulianCent(JD + noonmin / 1440.0)
+
+    eqTime = calcEquationOfTime(tnoon)
+    solarDec = calcSunDeclination(tnoon)
+    hourAngle = calcHourAngle(latitude, solarDec)
+    timeUTC = 720 + 4 * (longitude - radToDeg(hourAngle)) - eqTime
+
+    newt = calcTimeJulianCent(calcJDFromJulianCent(t) + timeUTC / 1440.0)
+    eqTime = calcEquationOfTime(newt)
+    solarDec = calcSunDeclination(newt)
+    hourAngle = calcHourAngle(latitude, solarDec)
+    return 720 + 4 * (longitude - radToDeg(hourAngle)) - eqTime
+
+
+def legacyDay(JD, latitude, longitude):
+    return (legacySunEventUTC(JD, latitude, longitude, calcHourAngleSunrise),
+            legacySunEventUTC(JD, latitude, longitude, calcHourAngleSunset))
+
+
+def fusedDay(JD, latitude, longitude):
+    return sunCalcs.calcSunriseSetUTC(JD, latitude, longitude)
+
+
+def legacyFindDay(jd, latitude, longitude, calcEvent, direction):
+    julianday = jd
+    while not sunCalcs.isNumber(calcEvent(julianday, latitude, longitude)):
+        julianday += direction
+    return julianday
+
+
+def count_calls(func, *args):
+    ''' Count the python function calls and math library calls made by func'''
+    counts = {"call": 0, "c_call": 0}
+
+    def profiler(frame, event, arg):
+        if event in counts:
+            counts[event] += 1
+
+    sys.setprofile(profiler)
+    try:
+        func(*args)
+    finally:
+        sys.setprofile(None)
+    # don't count the call to func itself
+    return counts["call"] - 1, counts["c_call"]
+
+
+def time_days(func, latitude, longitude, jd0, days):
+    start = time.time()
+    for i in xrange(days):
+        func(jd0 + i, latitude, longitude)
+    return time.time() - start
+
+
+def bench_fused(days):
+    jd0 = sunCalcs.calcJD(2014, 1, 1)
+    print "%-10s %-8s %8s %8s %12s %10s" % ("site", "variant", "pycalls", "mathcalls", "us/day", "maxdiff")
+    for name, latitude, longitude in SITES:
+        worst = 0.0
+        for i in xrange(days):
+            a = legacyDay(jd0 + i, latitude, longitude)
+            b = fusedDay(jd0 + i, latitude, longitude)
+            for x, y in zip(a, b):
+                if sunCalcs.isNumber(x) and sunCalcs.isNumber(y):
+                    worst = max(worst, abs(x - y) * 60)
+        for variant, func in (("legacy", legacyDay), ("fused", fusedDay)):
+            pycalls, mathcalls = count_calls(func, jd0 + 180, latitude, longitude)
+            elapsed = time_days(func, latitude, longitude, jd0, days)
+            print "%-10s %-8s %8d %8d %12.1f %9.2gs" % (name, variant, pycalls, mathcalls,
+                                                        elapsed / days * 1e6, worst)
+
+
+def bench_polar(days):
+    ''' Search for the nearest sunrise/sunset in both directions from every day'''
+    jd0 = sunCalcs.calcJD(2014, 1, 1)
+    searches = [(sunCalcs.calcSunriseUTC, 1), (sunCalcs.calcSunriseUTC, -1),
+                (sunCalcs.calcSunsetUTC, 1), (sunCalcs.calcSunsetUTC, -1)]
+    print "%-10s %-8s %10s %10s %10s %10s" % ("site", "variant", "evals", "maxevals", "seconds", "mismatch")
+    for name, latitude, longitude in POLAR_SITES:
+        legacy = []
+        fused = []
+        for i in xrange(days):
+            for calcEvent, direction in searches:
+                legacy.append(legacyFindDay(jd0 + i, latitude, longitude, calcEvent, direction))
+                fused.append(sunCalcs.findSunEventDay(jd0 + i, latitude, longitude, calcEvent, direction))
+        mismatch = sum(1 for a, b in zip(legacy, fused) if a != b)
+
+        for variant, func in (("legacy", legacyFindDay), ("bounded", sunCalcs.findSunEventDay)):
+            evals = []
+            start = time.time()
+            for i in xrange(days):
+                for calcEvent, direction in searches:
+                    func(jd0 + i, latitude, longitude, calcEvent, direction)
+            elapsed = time.time() - start
+            for i in xrange(0, days, 7):
+                for calcEvent, direction in searches:
+                    evals.append(count_evaluations(func, jd0 + i, latitude, longitude, calcEvent, direction))
+            print "%-10s %-8s %10.1f %10d %10.3f %10d" % (name, variant, float(sum(evals)) / len(evals),
+                                                          max(evals), elapsed, mismatch)
+
+
+def count_evaluations(func, *args):
+    ''' Count calls to the sunrise/sunset and declination functions made by func'''
+    names = ("calcSunriseUTC", "calcSunsetUTC", "calcPolarMargin")
+    counts = [0]
+
+    def profiler(frame, event, arg):
+        if event == "call" and frame.f_code.co_name in names:
+            counts[0] += 1
+
+    sys.setprofile(profiler)
+    try:
+        func(*args)
+    finally:
+        sys.setprofile(None)
+    return counts[0]
+
+
+CHEBYSHEV_LATITUDES = [0.0, 37.451688, 60.0, 66.0, 70.0, 78.2232, 85.0, -77.846, -89.0]
+
+
+def bench_chebyshev(days):
+    ''' Accuracy and speed of the Chebyshev ephemeris against the NOAA series'''
+    ephemeris = sunCalcs.ChebyshevEphemeris.fit(2014, 2024)
+    jd0 = sunCalcs.calcJD(2014, 1, 1)
+    longitude = -15.6267
+    print "%-10s %12s %12s %10s %10s %10s" % ("latitude", "maxerr", "meanerr", "nanmismatch", "exact us", "cheb us")
+    worst = 0.0
+    for latitude in CHEBYSHEV_LATITUDES:
+        errors = []
+        mismatch = 0
+        for i in xrange(days):
+            exact = sunCalcs.calcSunriseSetUTC(jd0 + i, latitude, longitude)
+            fitted = ephemeris.calcSunriseSetUTC(jd0 + i, latitude, longitude)
+            for x, y in zip(exact, fitted):
+                if sunCalcs.isNumber(x) and sunCalcs.isNumber(y):
+                    errors.append(abs(x - y) * 60)
+                elif sunCalcs.isNumber(x) or sunCalcs.isNumber(y):
+                    mismatch += 1
+        elapsed = []
+        for func in (sunCalcs.calcSunriseSetUTC, ephemeris.calcSunriseSetUTC):
+            elapsed.append(time_days(func, latitude, longitude, jd0, days) / days * 1e6)
+        worst = max(worst, max(errors or [0]))
+        print "%-10s %11.2gs %11.2gs %10d %10.1f %10.1f" % (latitude, max(errors or [0]),
+                sum(errors) / max(1, len(errors)), mismatch, elapsed[0], elapsed[1])
+    print "worst error %.3gs" % worst
+
+
+def bench_sites(days):
+    ''' Many sites at once with calcSunSites, against calcSun per site and day'''
+    import random
+    random.seed(14)
+    start = datetime.date(2014, 1, 1)
+    end = start + datetime.timedelta(days=days - 1)
+    print "%-8s %10s %10s %12s" % ("sites", "matrix s", "scalar s", "maxdiff")
+    for nsites in (1, 10, 100, 500):
+        sites = [(random.uniform(-89.5, 89.5), random.uniform(-180, 180)) for i in range(nsites)]
+        begin = time.time()
+        riseTimes, setTimes = sunCalcs.calcSunSites(sites, start, end)
+        matrix = time.time() - begin
+
+        # the scalar loop is slow, so time a sample of sites and scale up
+        sample = sites[:10]
+        worst = 0.0
+        begin = time.time()
+        for i, (latitude, longitude) in enumerate(sample):
+            for day in xrange(days):
+                riseTime, setTime = sunCalcs.calcSun(latitude, longitude, start + datetime.timedelta(days=day))
+                worst = max(worst, abs(riseTime - riseTimes[i, day]), abs(setTime - setTimes[i, day]))
+        scalar = (time.time() - begin) * nsites / len(sample)
+        print "%-8d %10.3f %10.3f %11.2gs" % (nsites, matrix, scalar, worst)
+
+
+BENCHMARKS = {
+    "fused": bench_fused,
+    "polar": bench_polar,
+    "chebyshev": bench_chebyshev,
+    "sites": bench_sites,
+}
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--days", dest="days", default=365, type="int",
+                      help="Number of days to compute per site. Default 365")
+    parser.add_option("--bench", dest="bench", action="append",
+                      help="Benchmark to run: %s. Default all" % ", ".join(sorted(BENCHMARKS)))
+    options, args = parser.parse_args()
+
+    for name in options.bench or sorted(BENCHMARKS):
+        print "==", name
+        BENCHMARKS[name](options.days)
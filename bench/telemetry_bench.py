@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Timing and memory for telemetry.py: decoding uBrain status lines, adding them to
+## the tiers, and reading the tiers back.
+##
+##     python bench/telemetry_bench.py [--json results.json]
+##
+## Memory is the size of the tiers' arrays, against keeping the same hour, day and
+## month of samples one dict per sample, the way the lines would naturally be kept.
+##
+
+import os
+import sys
+import json
+import random
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "bin"))
+sys.path.insert(0, BENCH_DIR)
+import telemetry
+from schedule_bench import timeit
+
+START = 1407700000.0
+
+
+def status_lines(count):
+    ''' Returns: count status lines like uBrain.ino's show_output prints'''
+    lines = []
+    for i in range(count):
+        raws = [random.randint(140, 160) for j in range(4)]
+        lines.append("@2014-08-10 21:%02d:%02d   %.2f   Acc: %.5f     Amps: %.2f     TempRaw: %d %d %d %d   "
+                     "TempF: %.2f  %.2f  %.2f  %.2f\r\n" %
+                     ((i // 60) % 60, i % 60, i, random.random() * 0.1, random.random() * 8,
+                      raws[0], raws[1], raws[2], raws[3],
+                      raws[0] * 500.0 / 1024 * 9 / 5 + 32, raws[1] * 500.0 / 1024 * 9 / 5 + 32,
+                      raws[2] * 500.0 / 1024 * 9 / 5 + 32, raws[3] * 500.0 / 1024 * 9 / 5 + 32))
+    return lines
+
+
+def array_bytes(store):
+    total = 0
+    for tier in store.tiers:
+        for values in [tier.times, tier.counts] + tier.sums + tier.mins + tier.maxs:
+            total += len(values) * values.itemsize
+    return total
+
+
+def dict_bytes(samples):
+    ''' Rough size of samples as one dict of floats each'''
+    sample = dict(zip(("time",) + telemetry.FIELDS, [0.5] * (len(telemetry.FIELDS) + 1)))
+    each = sys.getsizeof(sample) + sum(sys.getsizeof(v) for v in sample.values()) + 8
+    return each * samples
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--json", dest="json_file",
+                      help="Write results to this file as JSON")
+    options, args = parser.parse_args()
+
+    lines = status_lines(3600)
+    decoded = [telemetry.decode_status(line) for line in lines]
+    raw = []
+
+    def decode():
+        for line in lines:
+            telemetry.decode_status(line)
+        return len(lines)
+    raw.append(("telemetry/decode",) + timeit(decode))
+
+    store = telemetry.Telemetry()
+    clock = [START]
+
+    def add():
+        t = clock[0]
+        for values in decoded:
+            store.add(t, values)
+            t += 1.0
+        clock[0] = t
+        return len(decoded)
+    raw.append(("telemetry/add",) + timeit(add))
+
+    def decode_add():
+        t = clock[0]
+        for line in lines:
+            store.add(t, telemetry.decode_status(line))
+            t += 1.0
+        clock[0] = t
+        return len(lines)
+    raw.append(("telemetry/decode+add",) + timeit(decode_add))
+
+    for seconds, span in ((1, 3600), (60, 86400), (3600, 30 * 86400)):
+        def report():
+            store.report(seconds, clock[0] - span)
+            return 1
+        raw.append(("telemetry/report/%ds" % seconds,) + timeit(report))
+
+    results = []
+    for name, ops, seconds in raw:
+        results.append({"name": name, "ops": ops, "seconds": seconds, "us_per_op": seconds / ops * 1e6})
+        print "%-50s %10.1f us/op" % (name, seconds / ops * 1e6)
+
+    kept = sum(capacity for seconds, capacity in telemetry.TIERS)
+    covered = max(seconds * capacity for seconds, capacity in telemetry.TIERS)
+    memory = {"name": "telemetry/memory", "tier_bytes": array_bytes(store),
+              "dict_bytes_same_buckets": dict_bytes(kept), "dict_bytes_every_sample": dict_bytes(covered)}
+    results.append(memory)
+    print "tiers %d KB for %d days; dicts %d KB for the same buckets, %d MB for every sample" % \
+          (memory["tier_bytes"] / 1024, covered / 86400, memory["dict_bytes_same_buckets"] / 1024,
+           memory["dict_bytes_every_sample"] / 1024 / 1024)
+
+    if options.json_file:
+        with open(options.json_file, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
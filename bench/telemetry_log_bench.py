@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## telemetry_log.py against ubrain-daemon's stdout log, which is where status lines
+## went before: a repr() of every line, flushed as it goes (the daemon runs -u).
+##
+##     python bench/telemetry_log_bench.py [--days 7] [--json results.json]
+##
+## Writes --days of once a second status lines both ways into a temporary directory,
+## then compares:
+##     append    time to log a line, decoded and binary, or as text
+##     disk      bytes on disk per line
+##     range     getting an hour of lines from the middle, by binary search on the
+##               mmap'd segments, or by reading the text log until past the hour
+##     buckets   mean, min and max per minute over a day, from the segments with
+##               numpy, or decoding the text lines for that day
+##
+## The segment size limit is raised so that nothing is expired.
+##
+
+import os
+import sys
+import json
+import calendar
+import time
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "bin"))
+sys.path.insert(0, BENCH_DIR)
+import telemetry
+import telemetry_log
+from schedule_bench import timeit
+
+START = 1407700000.0
+
+
+def status_line(t):
+    ''' Returns: a status line like uBrain.ino's show_output prints at time t'''
+    raws = [random.randint(140, 160) for j in range(4)]
+    return "@%s   %.2f   Acc: %.5f     Amps: %.2f     TempRaw: %d %d %d %d   " \
+           "TempF: %.2f  %.2f  %.2f  %.2f\r\n" % \
+           ((time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t)), t - START, random.random() * 0.1,
+             random.random() * 8) + tuple(raws) + tuple(raw * 500.0 / 1024 * 9 / 5 + 32 for raw in raws))
+
+
+def text_range(path, start, end):
+    ''' Returns: the lines of the text log from start to end, found the only way a
+        text log allows, by reading it from the top'''
+    first = "'@" + time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start))
+    last = "'@" + time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(end))
+    lines = []
+    with open(path) as f:
+        for line in f:
+            if line < first:
+                continue
+            if line >= last:
+                break
+            lines.append(line)
+    return lines
+
+
+def directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--days", dest="days", default=7, type="int",
+                      help="Days of status lines to log. Default 7")
+    parser.add_option("--json", dest="json_file",
+                      help="Write results to this file as JSON")
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="soma-telemetry-")
+    try:
+        lines = [status_line(START + i) for i in range(3600)]
+        raw = []
+
+        # appending, one line at a time as the daemon does
+        log_dir = os.path.join(tmpdir, "append")
+        log = telemetry_log.SegmentLog(log_dir, max_size=1 << 40)
+        clock = [START]
+
+        def append_binary():
+            t = clock[0]
+            for line in lines:
+                log.append(t, telemetry.decode_status(line))
+                t += 1.0
+            clock[0] = t
+            return len(lines)
+        raw.append(("telemetry_log/append/decode+binary",) + timeit(append_binary))
+        log.close()
+
+        stdout = open(os.path.join(tmpdir, "stdout.log"), "w")
+
+        def append_text():
+            for line in lines:
+                stdout.write(repr(line) + "\n")
+                stdout.flush()
+            return len(lines)
+        raw.append(("telemetry_log/append/stdout_text",) + timeit(append_text))
+        stdout.close()
+
+        # days of both, for size and queries
+        seconds = options.days * 86400
+        log_dir = os.path.join(tmpdir, "segments")
+        log = telemetry_log.SegmentLog(log_dir, max_size=1 << 40, flush_every=4096)
+        text_path = os.path.join(tmpdir, "days.log")
+        with open(text_path, "w") as text:
+            for i in range(seconds):
+                # the lines' own time stamps have to be right for the text scan
+                line = status_line(START + i)
+                log.append(START + i, telemetry.decode_status(line))
+                text.write(repr(line) + "\n")
+        log.close()
+        binary_bytes = directory_bytes(log_dir)
+        text_bytes = os.path.getsize(text_path)
+
+        middle = START + seconds // 2
+        expected = len(telemetry_log.read_range(log_dir, middle, middle + 3600))
+        assert expected == 3600 == len(text_range(text_path, middle, middle + 3600))
+
+        def range_binary():
+            telemetry_log.read_range(log_dir, middle, middle + 3600)
+            return 1
+        raw.append(("telemetry_log/range_1h/segments",) + timeit(range_binary))
+
+        def range_text():
+            text_range(text_path, middle, middle + 3600)
+            return 1
+        raw.append(("telemetry_log/range_1h/stdout_text",) + timeit(range_text))
+
+        day = START + (options.days // 2) * 86400
+
+        def buckets_binary():
+            telemetry_log.aggregate(log_dir, day, day + 86400, 60)
+            return 1
+        raw.append(("telemetry_log/buckets_1d_60s/segments",) + timeit(buckets_binary))
+
+        def buckets_text():
+            store = telemetry.Tier(60, 1440)
+            for line in text_range(text_path, day, day + 86400):
+                line = eval(line)
+                stamp = time.strptime(line[1:20], "%Y-%m-%d %H:%M:%S")
+                store.add(calendar.timegm(stamp), telemetry.decode_status(line))
+            return 1
+        raw.append(("telemetry_log/buckets_1d_60s/stdout_text",) + timeit(buckets_text, rounds=1))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    results = []
+    for name, ops, elapsed in raw:
+        results.append({"name": name, "ops": ops, "seconds": elapsed, "us_per_op": elapsed / ops * 1e6})
+        print "%-50s %12.1f us/op" % (name, elapsed / ops * 1e6)
+
+    disk = {"name": "telemetry_log/disk", "days": options.days,
+            "segment_bytes": binary_bytes, "stdout_text_bytes": text_bytes,
+            "segment_bytes_per_line": float(binary_bytes) / seconds,
+            "stdout_text_bytes_per_line": float(text_bytes) / seconds}
+    results.append(disk)
+    print "%d days: segments %.1f MB (%.1f bytes/line), stdout text %.1f MB (%.1f bytes/line)" % \
+          (options.days, binary_bytes / 1048576.0, disk["segment_bytes_per_line"],
+           text_bytes / 1048576.0, disk["stdout_text_bytes_per_line"])
+
+    if options.json_file:
+        with open(options.json_file, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
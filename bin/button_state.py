@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Button state from ubrain-daemon, for anything that wants it faster than by
+## checking for /var/run/soma/buttonA etc.:
+##
+##   /var/run/soma/buttons.state  a small file that ubrain-daemon keeps mmap'd and
+##                                updates in place. Readers mmap it too, and check
+##                                the sequence number, which changes whenever any
+##                                button does, without a system call.
+##   /var/run/soma/buttons.sock   a Unix socket. Anyone who connects is sent "!ON n"
+##                                for each button that is on, and then "!OFF n" and
+##                                "!ON n" lines as the buttons change.
+##
+##     button_state.py [--state-file FILE] [--socket PATH] [--watch]
+##
+## prints the state of each button, or with --watch, prints the changes as they
+## come in over the socket.
+##
+## The state file is a header and then a slot per button, all little endian:
+##     header  "BTN1", button count (uint32), sequence (uint32), unused (uint32)
+##     slot    time of last change (double, unix time), on (uint32), presses (uint32)
+## The writer makes the sequence odd, changes the slots, then makes it even again. A
+## reader that sees an odd sequence, or a different one after reading the slots
+## than before, has to read again - for up to READ_TIMEOUT, in case the writer died
+## half way through.
+##
+
+import os
+import sys
+import time
+import mmap
+import errno
+import socket
+import struct
+from optparse import OptionParser
+
+STATE_MAGIC = "BTN1"
+STATE_HEADER = struct.Struct("<4sIII")
+STATE_SLOT = struct.Struct("<dII")
+SEQUENCE_OFFSET = 8
+# how long StateReader.read waits for the writer to finish an update, in seconds.
+# A writer that died half way through one never will.
+READ_TIMEOUT = 0.1
+
+
+class StateWriter(object):
+    ''' ubrain-daemon's side of the state file'''
+
+    def __init__(self, filename, count):
+        self.count = count
+        self.sequence = 0
+        size = STATE_HEADER.size + STATE_SLOT.size * count
+        # readers should never see a half made file, so make it and rename it
+        tmpname = filename + ".tmp"
+        fd = os.open(tmpname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        STATE_HEADER.pack_into(self.map, 0, STATE_MAGIC, count, self.sequence, 0)
+        os.rename(tmpname, filename)
+        self.presses = [0] * count
+
+    def update(self, num, on, when):
+        if on:
+            self.presses[num] += 1
+        struct.pack_into("<I", self.map, SEQUENCE_OFFSET, (self.sequence + 1) & 0xffffffff)
+        STATE_SLOT.pack_into(self.map, STATE_HEADER.size + STATE_SLOT.size * num,
+                             when, on and 1 or 0, self.presses[num])
+        self.sequence += 2
+        struct.pack_into("<I", self.map, SEQUENCE_OFFSET, self.sequence & 0xffffffff)
+
+
+class StateReader(object):
+    ''' A reader of the state file. sequence() is cheap enough to call in a loop:
+
+            state = StateReader()
+            last = None
+            while True:
+                if state.sequence() != last:
+                    last, buttons = state.read()
+                    ...
+    '''
+
+    def __init__(self, filename="/var/run/soma/buttons.state"):
+        self.filename = filename
+        # the last (sequence, buttons) read() got whole
+        self.last = None
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        magic, self.count, sequence, unused = STATE_HEADER.unpack_from(self.map, 0)
+        if magic != STATE_MAGIC:
+            raise ValueError("%s is not a button state file" % filename)
+
+    def sequence(self):
+        return struct.unpack_from("<I", self.map, SEQUENCE_OFFSET)[0]
+
+    def read(self, timeout=READ_TIMEOUT):
+        ''' Returns: (sequence, list of (on, time of last change, presses) per button)
+            If the writer is still in the middle of an update after timeout seconds,
+            returns the last state read, or raises IOError if there isn't one.'''
+        deadline = None
+        while True:
+            before = self.sequence()
+            if not before & 1:
+                slots = [STATE_SLOT.unpack_from(self.map, STATE_HEADER.size + STATE_SLOT.size * i)
+                         for i in range(self.count)]
+                if self.sequence() == before:
+                    self.last = before, [(bool(on), when, presses) for when, on, presses in slots]
+                    return self.last
+            if deadline is None:
+                deadline = time.time() + timeout
+            elif time.time() > deadline:
+                if self.last is None:
+                    raise IOError("%s is still being updated after %gs" % (self.filename, timeout))
+                return self.last
+
+
+class Publisher(object):
+    ''' ubrain-daemon's side of the socket. The listening socket and every
+        subscriber are non-blocking; a subscriber that isn't keeping up is dropped
+        rather than holding up the daemon.'''
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.sock.setblocking(0)
+        self.subscribers = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self, current):
+        ''' Take a new subscriber, and send it current, a list of lines'''
+        try:
+            connection = self.sock.accept()[0]
+        except socket.error:
+            return None
+        connection.setblocking(0)
+        self.subscribers.append(connection)
+        self.send([connection], "".join(current))
+        return connection
+
+    def readable(self, connection):
+        ''' A subscriber has something to say, which can only be goodbye'''
+        try:
+            if connection.recv(256):
+                return
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+        self.drop(connection)
+
+    def drop(self, connection):
+        if connection in self.subscribers:
+            self.subscribers.remove(connection)
+        connection.close()
+
+    def send(self, connections, text):
+        for connection in connections:
+            try:
+                if connection.send(text) != len(text):
+                    self.drop(connection)
+            except socket.error:
+                self.drop(connection)
+
+    def publish(self, line):
+        self.send(list(self.subscribers), line)
+
+
+def subscribe(path="/var/run/soma/buttons.sock"):
+    ''' Yields: (on, button number) for each change, starting with the buttons that
+        are on when it connects'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    pending = ""
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        lines = (pending + data).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            state, num = line.split()
+            yield state == "!ON", int(num)
+    sock.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--state-file", dest="state_file", default="/var/run/soma/buttons.state",
+                      help="Button state file. Default /var/run/soma/buttons.state")
+    parser.add_option("--socket", dest="socket", default="/var/run/soma/buttons.sock",
+                      help="ubrain-daemon's socket, for --watch. Default /var/run/soma/buttons.sock")
+    parser.add_option("--watch", dest="watch", default=False, action="store_true",
+                      help="Print each change as it happens")
+    options, args = parser.parse_args()
+
+    if options.watch:
+        for on, num in subscribe(options.socket):
+            print "%.3f" % time.time(), on and "ON " or "OFF", num
+            sys.stdout.flush()
+        sys.exit()
+
+    sequence, buttons = StateReader(options.state_file).read()
+    for num, (on, when, presses) in enumerate(buttons):
+        print num, on and "ON " or "OFF", "since", time.ctime(when), "pressed", presses, "times"
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## On/off decisions for several installations from one box. Each site has its own
+## lat/long file and schedule file, as new_schedule.py takes them, listed in a sites
+## file with one line per site:
+##
+##     # name      lat/long file               schedule file
+##     pier14      /etc/soma/latlong.conf      /etc/soma/schedule.conf
+##     burn        burn/latlong.conf           burn/schedule.conf
+##
+## (relative paths are relative to the sites file). Then
+##
+##     multi_schedule.py --sites sites.conf [--unixtime T]
+##
+## prints whether each site should be on at T, and until when, and
+##
+##     multi_schedule.py --sites sites.conf --socket /var/run/soma/sites.sock
+##
+## stays running and answers the same for anyone who connects and sends a unix time
+## (or an empty line for now), one line per site: "name on|off next-change|none".
+##
+## Each site is compiled into the windows for the coming week with
+## new_schedule.compile_files. Sunrise and sunset are cached by location across all
+## sites, and worked out with the Chebyshev ephemeris (--chebyshev) if there is
+## one. Sites with the same lat/long and schedule files share the compiled windows
+## too. Queries are answered for all sites at once, with numpy.
+##
+
+import os
+import sys
+import time
+import hashlib
+from optparse import OptionParser
+
+import new_schedule
+
+
+class Site(object):
+    ''' One installation, and its CompiledSchedule. That can be shared with other
+        sites with the same files, so key is this site's own schedule_cache_key, from
+        when it was last compiled, to tell when its files change.'''
+
+    def __init__(self, name, config_file, schedule_file):
+        self.name = name
+        self.config_file = config_file
+        self.schedule_file = schedule_file
+        self.compiled = None
+        self.key = None
+        self.zone = None
+
+    def covers(self, now):
+        return self.compiled is not None and self.compiled.covers(now)
+
+
+def read_sites_file(sites_file_name):
+    ''' Returns: list of Sites from a sites file. Bad lines are reported and skipped'''
+    directory = os.path.dirname(os.path.abspath(sites_file_name))
+    sites = []
+    names = set()
+    with open(sites_file_name) as f:
+        for line_number, line in enumerate(f):
+            fields = line.partition("#")[0].split()
+            if not fields:
+                continue
+            if len(fields) != 3 or fields[0] in names:
+                print "Trouble parsing sites file, line", line_number + 1
+                continue
+            names.add(fields[0])
+            sites.append(Site(fields[0], os.path.join(directory, fields[1]),
+                              os.path.join(directory, fields[2])))
+    return sites
+
+
+class SiteSet(object):
+    ''' Every site's compiled schedule, padded out into sites x windows arrays so
+        that all sites can be looked up at once'''
+
+    def __init__(self, sites, days=new_schedule.COMPILED_DAYS, ephemeris_file=None, chebyshev_file=None):
+        self.sites = sites
+        self.days = days
+        self.ephemeris_file = ephemeris_file
+        self.chebyshev_file = chebyshev_file
+        self.sun_cache = None
+        # file_stats of the ephemeris files, when load last looked
+        self.sun_stats = None
+        # (config digest, schedule digest) -> CompiledSchedule, and
+        # timezone name -> TimeZone
+        self.compiled = {}
+        self.zones = {}
+        self.starts = None
+        self.ends = None
+        self.span_starts = None
+        self.span_ends = None
+
+    def sun_files(self):
+        return (self.ephemeris_file, self.chebyshev_file)
+
+    def compile_site(self, site, now):
+        ''' Read site's files and work out its windows for the coming days'''
+        if self.sun_cache is None:
+            import sunCalcs
+            # the cache is keyed by location, so any number of sites can share it
+            self.sun_cache = sunCalcs.SunCache(size=4096, ephemeris_file=self.ephemeris_file,
+                                               chebyshev_file=self.chebyshev_file)
+        key = new_schedule.schedule_cache_key(site.schedule_file, site.config_file, self.sun_files())
+        digests = []
+        for name in (site.config_file, site.schedule_file):
+            with open(name, "rb") as f:
+                digests.append(hashlib.md5(f.read()).digest())
+        shared = tuple(digests)
+        compiled = self.compiled.get(shared)
+        if compiled is None or not compiled.covers(now):
+            compiled = new_schedule.compile_files(site.schedule_file, site.config_file, now,
+                                                  self.days, self.sun_cache, self.sun_files())
+            self.compiled[shared] = compiled
+        if compiled.timezone not in self.zones:
+            import tzfile
+            self.zones[compiled.timezone] = tzfile.TimeZone.load(compiled.timezone)
+        site.compiled = compiled
+        site.key = key
+        site.zone = self.zones[compiled.timezone]
+
+    def load(self, now, check_files=True):
+        ''' Compile every site whose compiled schedule doesn't cover now, or (if
+            check_files) whose files have changed. Sites that can't be read keep what
+            they had, and are off if they never had anything.
+            Returns: list of (site name, error) for sites that couldn't be read'''
+        errors = []
+        changed = False
+        if check_files:
+            sun_stats = new_schedule.file_stats(self.sun_files())
+            if self.sun_stats is not None and sun_stats != self.sun_stats:
+                # the ephemeris files have been rewritten, so the sun times and the
+                # compiled schedules shared by content are all stale
+                self.sun_cache = None
+                self.compiled = {}
+            self.sun_stats = sun_stats
+        for shared, compiled in self.compiled.items():
+            if compiled.span[1] <= now:
+                del self.compiled[shared]
+        for site in self.sites:
+            if site.covers(now) and (not check_files or
+               site.key == new_schedule.schedule_cache_key(site.schedule_file, site.config_file,
+                                                           self.sun_files())):
+                continue
+            try:
+                self.compile_site(site, now)
+                changed = True
+            except Exception, e:
+                errors.append((site.name, e))
+        if changed or self.starts is None:
+            self.build()
+        return errors
+
+    def elsewhen(self, when):
+        ''' Returns: a SiteSet of the same sites, loaded for when, that shares this
+            one's sun cache and time zones but leaves its compiled schedules alone.
+            For queries about times these schedules don't cover.'''
+        other = SiteSet([Site(site.name, site.config_file, site.schedule_file) for site in self.sites],
+                        self.days, self.ephemeris_file, self.chebyshev_file)
+        other.sun_cache = self.sun_cache
+        other.zones = self.zones
+        other.load(when, check_files=False)
+        return other
+
+    def covers(self, when):
+        ''' Returns: whether every site that has a compiled schedule can answer for when'''
+        return all(site.covers(when) for site in self.sites if site.compiled is not None)
+
+    def build(self):
+        import numpy
+        # one more column than the most windows, so there is always an infinite
+        # start after the last one
+        indexes = [site.compiled and site.compiled.index or new_schedule.IntervalIndex([])
+                   for site in self.sites]
+        width = max([len(index) for index in indexes] + [0]) + 1
+        self.starts = numpy.empty((len(self.sites), width))
+        self.starts.fill(numpy.inf)
+        self.ends = self.starts.copy()
+        for row, index in enumerate(indexes):
+            self.starts[row, :len(index)] = index.starts
+            self.ends[row, :len(index)] = index.ends
+        spans = [site.compiled and site.compiled.span or (0.0, 0.0) for site in self.sites]
+        self.span_starts = numpy.array([span[0] for span in spans])
+        self.span_ends = numpy.array([span[1] for span in spans])
+
+    def states(self, now):
+        ''' Returns: (on, change) arrays in the order of sites - whether each should be
+            on at now, and the time of its next change, or inf if that isn't within
+            its compiled schedule. Call load first if now may be past the compiled
+            schedules.'''
+        import numpy
+        rows = numpy.arange(len(self.sites))
+        count = (self.starts <= now).sum(axis=1)
+        last = numpy.maximum(count - 1, 0)
+        on = (count > 0) & (now < self.ends[rows, last])
+        change = numpy.where(on, self.ends[rows, last], self.starts[rows, count])
+        change[change >= self.span_ends] = numpy.inf
+        on &= self.span_starts <= now
+        return on, change
+
+    def report(self, now):
+        ''' Returns: one line per site, "name on|off next-change|none"'''
+        on, change = self.states(now)
+        lines = []
+        for site, site_on, site_change in zip(self.sites, on, change):
+            if site_change == float("inf"):
+                lines.append("%s %s none\n" % (site.name, site_on and "on" or "off"))
+            else:
+                lines.append("%s %s %.3f\n" % (site.name, site_on and "on" or "off", site_change))
+        return "".join(lines)
+
+
+def serve(site_set, path, poll):
+    ''' Answer queries on a Unix socket at path, checking the files for changes every
+        poll seconds. Never returns.'''
+    import select
+    import socket
+    sock = new_schedule.open_query_socket(path)
+    if sock is None:
+        sys.exit(1)
+    checked = time.time()
+    while True:
+        ready = select.select([sock], [], [], poll)[0]
+        now = time.time()
+        if now - checked >= poll:
+            for name, e in site_set.load(now):
+                print time.ctime(now), "Cannot read site", name, e
+            checked = now
+            sys.stdout.flush()
+        if not ready:
+            continue
+        try:
+            connection = sock.accept()[0]
+        except IOError:
+            continue
+        try:
+            connection.settimeout(1.0)
+            request = ""
+            while not request.endswith("\n") and len(request) < 64:
+                data = connection.recv(64)
+                if not data:
+                    break
+                request += data
+            if request.strip():
+                when = float(request)
+            else:
+                when = time.time()
+            # a time outside the resident schedules (a client asking about next
+            # month) is compiled on the side, so it can't replace them
+            if site_set.covers(when):
+                connection.sendall(site_set.report(when))
+            else:
+                connection.sendall(site_set.elsewhen(when).report(when))
+        except (IOError, ValueError, socket.timeout):
+            pass
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--sites", dest="sites_file", default="/etc/soma/sites.conf",
+                      help="File listing the sites. Default /etc/soma/sites.conf")
+    parser.add_option("--ephemeris", dest="ephemeris_file", default="/etc/soma/sun.eph",
+                      help="Precomputed sunrise/sunset file, shared by all sites. Default /etc/soma/sun.eph")
+    parser.add_option("--chebyshev", dest="chebyshev_file", default="/etc/soma/sun.cheb",
+                      help="Chebyshev ephemeris, for the sites --ephemeris isn't for. Default /etc/soma/sun.cheb")
+    parser.add_option("--days", dest="days", default=new_schedule.COMPILED_DAYS, type="int",
+                      help="Compile each site's schedule this many days ahead. Default %d" % new_schedule.COMPILED_DAYS)
+    parser.add_option("--unixtime", dest="timenow",
+                      help="Time to report on, in unix time. Default now")
+    parser.add_option("--socket", dest="socket",
+                      help="Stay running, and answer queries on this Unix socket")
+    parser.add_option("--poll", dest="poll", default=30.0, type="float",
+                      help="With --socket, check the site files for changes this often, in seconds. Default 30")
+    options, args = parser.parse_args()
+
+    try:
+        sites = read_sites_file(options.sites_file)
+    except IOError, e:
+        print "Cannot read sites file", options.sites_file, e
+        sys.exit(1)
+
+    if options.timenow:
+        timenow = float(options.timenow)
+    else:
+        timenow = time.time()
+
+    site_set = SiteSet(sites, options.days, options.ephemeris_file, options.chebyshev_file)
+    errors = site_set.load(timenow)
+    for name, e in errors:
+        print "Cannot read site", name, e
+
+    if options.socket:
+        serve(site_set, options.socket, options.poll)
+
+    on, change = site_set.states(timenow)
+    for site, site_on, site_change in zip(sites, on, change):
+        if site_change == float("inf"):
+            print "%-20s %-3s" % (site.name, site_on and "ON" or "OFF")
+        else:
+            print "%-20s %-3s until %s" % (site.name, site_on and "ON" or "OFF",
+                                           site.zone.strftime('%m-%d-%Y %I:%M%p %Z', site_change))
+    if errors:
+        sys.exit(1)
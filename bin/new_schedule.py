@@ -6,132 +6,1080 @@
 ## and a default schedule when the day hasn't been specified
 ##
 
+import os
 import re
 import string
+import bisect
+import struct
+import hashlib
 import datetime
-import sunCalcs
+import calendar
+from array import array
 from optparse import OptionParser
 from subprocess import call
 import sys
 import time
+import thread
 
 # globals
-schedules = None
-default_schedule = None
-latitude = 0.0
-longitude = 0.0
 debug = False
+ephemeris_file = None
+chebyshev_file = None
 
+# Compiled schedule cache: header, then the starts and then the ends of the windows
+# in schedule_index, as native doubles
+COMPILED_MAGIC = "SOMASCH2"
+COMPILED_HEADER = struct.Struct("<8s16sddI")
+# How many days ahead a compiled schedule covers
+COMPILED_DAYS = 7
 
-def parse_relative_time(year, month, day, relativetime):
-    '''Accepts "HH:MM", "sunset", "sunrise"
-      "sunset-MIN", "sunrise-MIN", sunset+MIN, or "sunrise-MIN" '''
-    global latitude, longitude
-    is_sunset = re.compile("^sunset").match(relativetime)
-    is_sunrise = re.compile("^sunrise").match(relativetime)
-    is_time = re.compile("^\d?\d:\d\d[am|pm|AM|PM]").match(relativetime)
-    the_time = None;
-    #print year, month, day, relativetime, "sunrise", is_sunrise, "sunset", is_sunset, "date", is_date
-    if is_sunset:
-        sunrise,sunset = sunCalcs.calcSun(latitude, longitude, datetime.date(int(year), int(month), int(day)))
+
+class IntervalIndex(object):
+    ''' Sorted list of non-overlapping [start, end) windows, in unix time.
+        Overlapping and touching windows are merged when the index is built, so
+        a time is in at most one window and can be found by bisection.'''
+
+    def __init__(self, windows):
+        self.starts = array("d")
+        self.ends = array("d")
+        for start, end in sorted(windows):
+            if end <= start:
+                continue
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _find(self, now):
+        ''' Returns: index of the last window starting at or before now, or -1'''
+        return bisect.bisect_right(self.starts, now) - 1
+
+    def contains(self, now):
+        i = self._find(now)
+        return i >= 0 and now < self.ends[i]
+
+    def window(self, now):
+        ''' Returns: (start, end) of the window containing now, or None'''
+        i = self._find(now)
+        if i >= 0 and now < self.ends[i]:
+            return (self.starts[i], self.ends[i])
+        return None
+
+    def next_transition(self, now):
+        ''' Returns: the next time after now that the system should switch on or
+            off, or None if it never will'''
+        i = self._find(now)
+        if i >= 0 and now < self.ends[i]:
+            return self.ends[i]
+        if i + 1 < len(self.starts):
+            return self.starts[i + 1]
+        return None
+
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+# When more than one line covers a day, the one with the highest priority wins. Unless
+# a line says otherwise, a single date beats a range of dates, which beats default.
+DEFAULT_PRIORITY = 0
+RANGE_PRIORITY = 1
+DATE_PRIORITY = 2
+# only the am/pm of a clock time can be either case; parse_relative_time matches the
+# sun times as they are, so "Sunset+10" is a bad time
+TIME_TOKEN = re.compile("^(sunrise|sunset)([+-]\d+)?$|^(civil|nautical|astronomical)-(dawn|dusk)([+-]\d+)?$"
+                        "|^\d?\d:\d\d(am|pm|AM|PM)$")
+DATE_TOKEN = re.compile("^\d\d\d\d-\d\d-\d\d$")
+# MM-DD of the days every year has, so most dates can be checked without parsing them.
+# Anything else, Feb 29 included, goes through parse_rule, which parses it.
+COMMON_DAYS = set("%02d-%02d" % (month, day) for month in range(1, 13)
+                  for day in range(1, calendar.monthrange(2001, month)[1] + 1))
+# the same few times turn up on most lines, so only check each once
+good_time_tokens = set()
+
+
+def parse_weekdays(text):
+    ''' "mon-fri", "sat,sun", "fri-mon", "tue"
+        Returns: set of weekday numbers as in datetime.date.weekday(), or None if text
+        isn't a list of weekdays'''
+    days = set()
+    for part in text.lower().split(","):
+        first, dash, last = part.partition("-")
+        if first not in WEEKDAYS or (dash and last not in WEEKDAYS):
+            return None
+        i = WEEKDAYS.index(first)
+        if dash:
+            j = WEEKDAYS.index(last)
+        else:
+            j = i
+        days.add(i)
+        while i != j:
+            i = (i + 1) % 7
+            days.add(i)
+    return days
+
+
+def parse_rule(args, line_number):
+    ''' Turn the fields of a schedule line into a rule:
+            <dates> <start-time> <end-time> [<weekdays>] [priority=N]
+            <dates> off [<weekdays>] [priority=N]
+        <dates> is YYYY-MM-DD, YYYY-MM-DD..YYYY-MM-DD (inclusive) or default.
+        Returns: dict with "first" and "last" dates as YYYY-MM-DD text (None for
+        default), "weekdays" (None for any), "priority", "line" and "times", which is
+        (start-time, end-time), or None for off
+        Raises ValueError if the line doesn't make sense'''
+    dates = args[0]
+    if dates == "default":
+        first = last = None
+        priority = DEFAULT_PRIORITY
+    elif ".." in dates:
+        first, last = dates.split("..", 1)
+        if not DATE_TOKEN.match(first) or not DATE_TOKEN.match(last) or last < first:
+            raise ValueError("bad date range " + dates)
+        priority = RANGE_PRIORITY
+    elif DATE_TOKEN.match(dates):
+        first = last = dates
+        priority = DATE_PRIORITY
+    else:
+        raise ValueError("bad date " + dates)
+    # check the dates are real ones
+    if first is not None:
+        parse_date(first)
+        if last != first:
+            parse_date(last)
+
+    if len(args) >= 2 and args[1].lower() == "off":
+        times = None
+        options = args[2:]
+    elif len(args) >= 3:
+        for token in args[1:3]:
+            if token not in good_time_tokens:
+                if not TIME_TOKEN.match(token):
+                    raise ValueError("bad time " + token)
+                good_time_tokens.add(token)
+        times = (args[1], args[2])
+        options = args[3:]
+    else:
+        raise ValueError("missing times")
+
+    weekdays = None
+    for option in options:
+        if option.lower().startswith("priority="):
+            priority = int(option[9:])
+        elif weekdays is None and parse_weekdays(option) is not None:
+            weekdays = parse_weekdays(option)
+        else:
+            raise ValueError("don't understand " + option)
+    return {"first": first, "last": last, "weekdays": weekdays, "priority": priority,
+            "line": line_number, "times": times}
+
+
+def parse_date(the_date):
+    year, month, day = string.split(the_date, "-")
+    return datetime.date(int(year), int(month), int(day))
+
+
+def day_range(first, last):
+    day = first
+    while day <= last:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+class ScheduleParser(object):
+    ''' Everything read from a config and schedule file, and the windows worked out
+        from them so far. The command line and the daemon use default_parser, through
+        the module functions of the same names; compile_files makes one of its own for
+        each compile, so compiles don't get in each other's way or the module's.
+        sun_cache, if given, is used instead of a new one, to share it.'''
+
+    def __init__(self, sun_cache=None):
+        self.schedules = None
+        self.default_schedule = None
+        self.schedule_index = None
+        self.schedule_entries = None
+        self.schedule_rules = None
+        self.resolved_days = None
+        self.resolved_span = (0.0, 0.0)
+        self.resolve_window = 2
+        self.latitude = 0.0
+        self.longitude = 0.0
+        self.sun_cache = sun_cache
+        # zone from the config file, or None for $TZ or else the system timezone
+        self.timezone_name = None
+        self.local_zone = None
+
+    def get_sun_cache(self):
+        ''' sunCalcs is only imported when a sun time is actually needed, so that
+            runs answered from the compiled schedule don't pay for it'''
+        if self.sun_cache is None:
+            import sunCalcs
+            self.sun_cache = sunCalcs.SunCache(ephemeris_file=ephemeris_file, chebyshev_file=chebyshev_file)
+        return self.sun_cache
+
+    def get_timezone(self):
+        ''' The timezone clock times in the schedule are in. Worked out from the
+            zoneinfo files rather than the process TZ, which the init scripts unset,
+            and kept for the life of the process so each day's offsets are only worked
+            out once.'''
+        if self.local_zone is None:
+            import tzfile
+            self.local_zone = tzfile.TimeZone.load(self.timezone_name or os.environ.get("TZ"))
+        return self.local_zone
+
+    def parse_relative_time(self, year, month, day, relativetime):
+        '''Accepts "HH:MMam", "HH:MMpm", "sunset", "sunrise"
+          "sunset-MIN", "sunrise-MIN", sunset+MIN, or "sunrise-MIN",
+          and "civil-dusk", "nautical-dawn", "astronomical-dusk+MIN" etc. for twilight.
+          A clock time that the clocks skip over when they go forward comes out an hour
+          later; one that happens twice when they go back is the first of the two.'''
+        is_sunset = re.compile("^sunset").match(relativetime)
+        is_sunrise = re.compile("^sunrise").match(relativetime)
+        is_twilight = re.compile("^(civil|nautical|astronomical)-(dawn|dusk)([+-]\d+)?$").match(relativetime)
+        is_time = re.compile("^\d?\d:\d\d[am|pm|AM|PM]").match(relativetime)
+        the_time = None;
+        #print year, month, day, relativetime, "sunrise", is_sunrise, "sunset", is_sunset, "date", is_date
+        if is_sunset:
+            sunrise,sunset = self.get_sun_cache().calcSun(self.latitude, self.longitude, datetime.date(int(year), int(month), int(day)))
+            try:
+                offset_minutes=int(relativetime[6:])
+            except:
+                offset_minutes = 0
+            the_time = sunset + (offset_minutes*60)
+        elif is_sunrise:
+            sunrise,sunset = self.get_sun_cache().calcSun(self.latitude, self.longitude, datetime.date(int(year), int(month), int(day)))
+            try:
+                offset_minutes=int(relativetime[7:])
+            except:
+                offset_minutes = 0
+            the_time = sunrise + (offset_minutes*60)
+        elif is_twilight:
+            kind, event, offset = is_twilight.groups()
+            dawn,dusk = self.get_sun_cache().twilight(self.latitude, self.longitude, datetime.date(int(year), int(month), int(day)), kind)
+            offset_minutes = int(offset or 0)
+            if event == "dawn":
+                the_time = dawn + (offset_minutes*60)
+            else:
+                the_time = dusk + (offset_minutes*60)
+        elif is_time:
+            hour, minampm = string.split(relativetime, ":")
+            min = minampm[0:2]
+            ampm = minampm[2:4].lower()
+
+            # 12:30am is just after midnight, 12:30pm just after noon
+            hour = int(hour) % 12
+            if ampm == "pm":
+                hour += 12
+            the_time = self.get_timezone().local_to_utc(int(year), int(month), int(day), hour, int(min))
+
+        return the_time
+
+    def read_config_file(self, config_file_name):
+        ''' Read latitude and longitude from configuration file. Note that longitude is
+            positive *west*, the reverse of normal. timezone, if there is one, is a zone
+            name such as America/Los_Angeles'''
+        with open(config_file_name) as myfile:
+            for line in myfile:
+                name, var = line.partition("=")[::2]
+                if name:
+                    if name.lower() == "latitude":
+                        self.latitude = float(var)
+                    elif name.lower() == "longitude":
+                        self.longitude = float(var)
+                    elif name.lower() == "timezone":
+                        if var.strip() != self.timezone_name:
+                            self.timezone_name = var.strip()
+                            self.local_zone = None
+
+    def parse_window(self, year, month, day, start_time, end_time):
+        ''' Returns: (start, end) in UTC for a schedule line. An end time earlier than the
+            start time is taken to be on the next day'''
+        start_time_UTC = self.parse_relative_time(year, month, day, start_time)
+        end_time_UTC   = self.parse_relative_time(year, month, day, end_time)
+        if (end_time_UTC < start_time_UTC):
+            tomorrow = datetime.date(int(year),int(month),int(day)) + datetime.timedelta(days=1)
+            end_time_UTC   = self.parse_relative_time(tomorrow.year, tomorrow.month, tomorrow.day, end_time)
+        return start_time_UTC, end_time_UTC
+
+    def read_schedule_file(self, schedule_file_name, now=None, window=2):
+        ''' Read schedule file and output a list of schedules in canonical form.
+            Schedule file can have multiple lines, with each line expressed as
+            <date> <start-time> <end-time>. <date> is either in the format YYYY-MM-DD, or is
+            the special value "default" (explained later). <start-time> and <end-time> are
+            represented as a local time in HH:MM format, or one of the special values
+            "sunrise+MIN", "sunrise-MIN", "sunset+MIN", "sunset-MIN", or a twilight
+            such as "civil-dusk+MIN" or "nautical-dawn-MIN". Anything after a # is a comment.
+            Canonical form is [starttime, endtime], where both starttime and endtime are
+            expressed in UTC
+            If there is a "default" date value specified in the schedule file, it is used
+            for every day that doesn't have a line of its own.
+            <date> can also be a range, YYYY-MM-DD..YYYY-MM-DD, and a line can be limited
+            to some days of the week ("mon-fri", "sat,sun") and given a priority
+            ("priority=5"), or say "off" instead of times. See parse_rule. For each day,
+            the lines covering it with the highest priority all apply, unless one of
+            them is off.
+            Lines are only split up here. Times are worked out for the days within window
+            days of now (default the current time), or for every dated line if window is
+            None, and for any other day when disposition or next_transition needs it.
+            Everything worked out so far is in schedule_index.'''
+        schedule_file = open(schedule_file_name, "r")
+        self.schedules = []
+        self.schedule_entries = schedule_entries = {}
+        self.schedule_rules = schedule_rules = []
+        self.default_schedule = None
+        self.resolved_days = set()
+        self.resolved_span = (0.0, 0.0)
+        self.resolve_window = window
+        self.schedule_index = IntervalIndex([])
+        for line_number, line in enumerate(schedule_file):
+            args1 = string.split(line.partition("#")[0])
+            if not args1:
+                continue
+            if len(args1) == 3 and args1[1] in good_time_tokens and args1[2] in good_time_tokens \
+               and DATE_TOKEN.match(args1[0]) and args1[0][5:] in COMMON_DAYS and args1[0] >= "0001":
+                # by far the most common line, so skip parse_rule and just keep the times;
+                # rules_for_day turns them into a rule
+                schedule_entries.setdefault(args1[0], []).append((args1[1], args1[2]))
+                continue
+            try:
+                rule = parse_rule(args1, line_number + 1)
+            except ValueError, e:
+                print "Trouble parsing schedule, line", line_number + 1, e
+                continue
+            if rule["first"] is not None and rule["first"] == rule["last"] and rule["priority"] == DATE_PRIORITY:
+                # single dates are keyed on the text of the date, and parsed when needed
+                schedule_entries.setdefault(rule["first"], []).append(rule)
+            else:
+                schedule_rules.append(rule)
+
+        if window is None:
+            days = set()
+            for the_date in schedule_entries:
+                days.add(parse_date(the_date))
+            for rule in schedule_rules:
+                if rule["first"] is not None:
+                    days.update(day_range(parse_date(rule["first"]), parse_date(rule["last"])))
+            self.resolve_days(sorted(days))
+            if not any(rule["first"] is None for rule in schedule_rules):
+                self.resolved_span = (float("-inf"), float("inf"))
+        else:
+            today = self.local_date(now)
+            first = today - datetime.timedelta(days=window)
+            last = today + datetime.timedelta(days=window)
+            self.resolve_days(day_range(first, last))
+            # a time on any day after first has both its own day and the night before
+            self.resolved_span = (self.local_midnight(first + datetime.timedelta(days=1)),
+                                  self.local_midnight(last + datetime.timedelta(days=1)))
+            rules = self.rules_for_day(today)
+            if rules and all(rule["first"] is None for rule in rules):
+                start_time_UTC, end_time_UTC = self.parse_window(today.year, today.month, today.day, *rules[0]["times"])
+                self.default_schedule = {"start":start_time_UTC, "end":end_time_UTC}
+
+    def rules_for_day(self, day):
+        ''' Returns: list of the rules that apply on day, which is empty if none do or
+            the day is off'''
+        the_date = day.isoformat()
+        weekday = day.weekday()
+        candidates = []
+        for rule in self.schedule_entries.get(the_date, []):
+            if type(rule) is tuple:
+                rule = {"first": the_date, "last": the_date, "weekdays": None, "priority": DATE_PRIORITY,
+                        "line": None, "times": rule}
+            if rule["weekdays"] is None or weekday in rule["weekdays"]:
+                candidates.append(rule)
+        candidates += [rule for rule in self.schedule_rules
+                       if (rule["first"] is None or rule["first"] <= the_date <= rule["last"])
+                       and (rule["weekdays"] is None or weekday in rule["weekdays"])]
+        if not candidates:
+            return []
+        top = max(rule["priority"] for rule in candidates)
+        rules = [rule for rule in candidates if rule["priority"] == top]
+        if any(rule["times"] is None for rule in rules):
+            return []
+        return rules
+
+    def local_date(self, now=None):
+        if now is None:
+            now = time.time()
+        return self.get_timezone().local_date(now)
+
+    def local_midnight(self, day):
+        return self.get_timezone().local_midnight(day)
+
+    def format_time(self, t, format='%m-%d-%Y %I:%M%p'):
+        return self.get_timezone().strftime(format, t)
+
+    def resolve_days(self, days):
+        ''' Work out the schedule for the given days that haven't been worked out
+            yet, and add them to schedule_index'''
+        added = False
+        for day in days:
+            if day not in self.resolved_days:
+                self.resolved_days.add(day)
+                for rule in self.rules_for_day(day):
+                    start_time_UTC, end_time_UTC = self.parse_window(day.year, day.month, day.day, *rule["times"])
+                    self.schedules.append({"start": start_time_UTC, "end":end_time_UTC})
+                    added = True
+        if added:
+            self.schedule_index = IntervalIndex([(schedule["start"], schedule["end"]) for schedule in self.schedules])
+
+    def disposition(self, now):
+        ''' Determine whether the system should be on at this particular point in time.'''
+        if not self.resolved_span[0] <= now < self.resolved_span[1]:
+            # the night before can run on past midnight
+            day = self.local_date(now)
+            self.resolve_days((day - datetime.timedelta(days=1), day))
+        return self.schedule_index.contains(now)
+
+    def next_transition(self, now):
+        ''' Returns: the next time after now that the system should switch on or off, or
+            None if it won't within a year (or after the last line, without a default, or
+            within the week covered by a compiled schedule)'''
+        if self.schedule_entries is None:
+            # from read_compiled_schedule, so nothing more can be worked out
+            change = self.schedule_index.next_transition(now)
+            if change is not None and change < self.resolved_span[1]:
+                return change
+            return None
+        day = self.local_date(now)
+        step = datetime.timedelta(days=max(1, self.resolve_window or 0))
+        last = day + step
+        if any(rule["first"] is None for rule in self.schedule_rules):
+            limit = day + datetime.timedelta(days=366)
+        else:
+            lasts = self.schedule_entries.keys() + [rule["last"] for rule in self.schedule_rules]
+            limit = parse_date(max(lasts or [day.isoformat()])) + datetime.timedelta(days=1)
+        while True:
+            self.resolve_days(day_range(day - datetime.timedelta(days=1), last))
+            change = self.schedule_index.next_transition(now)
+            # a window can merge into the next one, which starts at the earliest the day after last
+            if (change is not None and change < self.local_midnight(last + datetime.timedelta(days=1))) \
+               or last >= limit:
+                return change
+            last = min(last + step, limit)
+
+    def compile_schedule(self, now, days=COMPILED_DAYS):
+        ''' Work out the schedule from the start of today to the end of the day days from
+            now, so that schedule_index alone can answer for any time in between. Needs
+            read_schedule_file first.
+            Returns: (start, end) of that span'''
+        today = self.local_date(now)
+        last = today + datetime.timedelta(days=days)
+        self.resolve_days(day_range(today - datetime.timedelta(days=1), last))
+        self.resolved_span = (self.local_midnight(today), self.local_midnight(last + datetime.timedelta(days=1)))
+        return self.resolved_span
+
+    def write_compiled_schedule(self, filename, key, now):
+        ''' Work out the schedule for the next COMPILED_DAYS days and save schedule_index
+            to filename, replacing it atomically. Needs read_schedule_file first.'''
+        self.compile_schedule(now)
+        tmpname = filename + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write(COMPILED_HEADER.pack(COMPILED_MAGIC, key, self.resolved_span[0], self.resolved_span[1],
+                                         len(self.schedule_index)))
+            f.write(self.schedule_index.starts.tostring())
+            f.write(self.schedule_index.ends.tostring())
+        os.rename(tmpname, filename)
+
+    def read_compiled_schedule(self, filename, key, now):
+        ''' Load schedule_index from a compiled schedule, if there is one for this key
+            that covers now.
+            Returns: True if it was loaded'''
         try:
-            offset_minutes=int(relativetime[6:])
-        except:
-            offset_minutes = 0
-        the_time = sunset + (offset_minutes*60)
-    elif is_sunrise:
-        sunrise,sunset = sunCalcs.calcSun(latitude, longitude, datetime.date(int(year), int(month), int(day)))
+            with open(filename, "rb") as f:
+                data = f.read()
+        except IOError:
+            return False
+        if len(data) < COMPILED_HEADER.size:
+            return False
+        magic, file_key, span_start, span_end, count = COMPILED_HEADER.unpack_from(data)
+        if magic != COMPILED_MAGIC or file_key != key or not span_start <= now < span_end:
+            return False
+        if len(data) != COMPILED_HEADER.size + 16 * count:
+            return False
+        index = IntervalIndex([])
+        index.starts.fromstring(data[COMPILED_HEADER.size:COMPILED_HEADER.size + 8 * count])
+        index.ends.fromstring(data[COMPILED_HEADER.size + 8 * count:])
+        self.schedule_index = index
+        self.resolved_span = (span_start, span_end)
+        return True
+
+    def forget_before(self, day):
+        ''' Drop the windows of the days before day, so that a resident process
+            doesn't keep every day it has ever worked out. Times from the end of day on
+            are answered as before; earlier days are worked out again if asked about.'''
+        if self.resolved_days is None:
+            return
+        cutoff = self.local_midnight(day)
+        old = [resolved for resolved in self.resolved_days if resolved < day]
+        if not old:
+            return
+        self.resolved_days.difference_update(old)
+        # a day's windows start on that day
+        self.schedules = [schedule for schedule in self.schedules if schedule["start"] >= cutoff]
+        self.schedule_index = IntervalIndex([(schedule["start"], schedule["end"]) for schedule in self.schedules])
+        # a time needs its own day and the night before
+        start = max(self.resolved_span[0], self.local_midnight(day + datetime.timedelta(days=1)))
+        self.resolved_span = (start, max(start, self.resolved_span[1]))
+
+    def simulate(self, first, last, step=60.0):
+        ''' Run the schedule from the start of day first to the end of day last, sampling
+            it every step seconds, all at once with numpy.
+            Returns: dict of
+                "on_hours"    hours on, from the samples
+                "exact_hours" hours on, from the windows themselves
+                "transitions" list of (time, on) for each change seen in the samples
+                "overlaps"    list of pairs of schedule windows that overlap
+                "dst"         list of (time, windows) for each time the clocks change, with
+                              the windows within an hour of it'''
+        import numpy
+
+        one_day = datetime.timedelta(days=1)
+        # the night before first can run on into it
+        self.resolve_days(day_range(first - one_day, last))
+        begin = self.local_midnight(first)
+        end = self.local_midnight(last + one_day)
+
+        starts = numpy.frombuffer(self.schedule_index.starts, dtype=numpy.float64)
+        ends = numpy.frombuffer(self.schedule_index.ends, dtype=numpy.float64)
+        times = numpy.arange(begin, end, step)
+        i = numpy.searchsorted(starts, times, side="right") - 1
+        on = (i >= 0) & (times < ends[numpy.maximum(i, 0)])
+
+        changes = numpy.flatnonzero(on[1:] != on[:-1]) + 1
+        transitions = [(times[j], bool(on[j])) for j in changes]
+        exact = numpy.clip(numpy.minimum(ends, end) - numpy.maximum(starts, begin), 0, None).sum()
+
+        windows = sorted((schedule["start"], schedule["end"]) for schedule in self.schedules
+                         if schedule["end"] > begin and schedule["start"] < end)
+        overlaps = []
+        latest = None
+        for window in windows:
+            if latest is not None and window[0] < latest[1]:
+                overlaps.append((latest, window))
+            if latest is None or window[1] > latest[1]:
+                latest = window
+
+        dst = []
+        for change, before, after in self.get_timezone().changes(begin, end):
+            dst.append((change, [window for window in windows
+                                 if window[0] <= change + 3600 and window[1] >= change - 3600]))
+
+        return {"on_hours": on.sum() * step / 3600.0, "exact_hours": exact / 3600.0,
+                "transitions": transitions, "overlaps": overlaps, "dst": dst}
+
+
+# The schedule the command line and the daemon work on. Its methods are also the
+# module's functions, for them and for anything else that only needs the one.
+default_parser = ScheduleParser()
+get_sun_cache = default_parser.get_sun_cache
+get_timezone = default_parser.get_timezone
+parse_relative_time = default_parser.parse_relative_time
+read_config_file = default_parser.read_config_file
+parse_window = default_parser.parse_window
+read_schedule_file = default_parser.read_schedule_file
+rules_for_day = default_parser.rules_for_day
+local_date = default_parser.local_date
+local_midnight = default_parser.local_midnight
+format_time = default_parser.format_time
+resolve_days = default_parser.resolve_days
+disposition = default_parser.disposition
+next_transition = default_parser.next_transition
+compile_schedule = default_parser.compile_schedule
+write_compiled_schedule = default_parser.write_compiled_schedule
+read_compiled_schedule = default_parser.read_compiled_schedule
+forget_before = default_parser.forget_before
+simulate = default_parser.simulate
+
+
+def file_stats(names):
+    ''' Returns: list of (name, mtime, size, inode) for each of names, or (name, None)
+        if it isn't there, to tell when any of them is rewritten'''
+    stats = []
+    for name in names:
         try:
-            offset_minutes=int(relativetime[7:])
-        except:
-            offset_minutes = 0
-        the_time = sunrise + (offset_minutes*60)
-    elif is_time:
-        hour, minampm = string.split(relativetime, ":")
-        min = minampm[0:2]
-        ampm = minampm[2:4].lower()
-        
-        if ampm == "pm":
-            hour = int(hour) + 12
-        the_time = time.mktime([int(year), int(month), int(day), int(hour), int(min), 0, 0, 0, -1])
-        
-    return the_time
-
-
-def read_config_file(config_file_name):
-    ''' Read latitude and longitude from configuration file. Note that longitude is 
-        positive *west*, the reverse of normal'''
-    global latitude
-    global longitude
-    with open(config_file_name) as myfile:
-        for line in myfile:
-            name, var = line.partition("=")[::2]
-            if name:
-                if name.lower() == "latitude":
-                    latitude = float(var)
-                elif name.lower() == "longitude":
-                    longitude = float(var)
-
-def read_schedule_file(schedule_file_name):
-    ''' Read schedule file and output a list of schedules in canonical form.
-        Schedule file can have multiple lines, with each line expressed as 
-        <date> <start-time> <end-time>. <date> is either in the format YYYY-MM-DD, or is
-        the special value "default" (explained later). <start-time> and <end-time> are 
-        represented as a local time in HH:MM format, or one of the special values 
-        "sunrise+MIN", "sunrise-MIN", "sunset+MIN", "sunset-MIN".
-        Canonical form is [starttime, endtime], where both starttime and endtime are
-        expressed in UTC
-        If there is a "default" date value specified in the schedule file, the function 
-        will also generate a canonical schedule for the current day'''
-    global schedules
-    global default_schedule
-    schedule_file = open(schedule_file_name, "r")
-    p = re.compile("\d\d\d\d-\d\d-\d\d")
-    schedules = []
+            st = os.stat(name)
+            stats.append((name, st.st_mtime, st.st_size, st.st_ino))
+        except (OSError, TypeError):
+            stats.append((name, None))
+    return stats
+
+
+def schedule_cache_key(schedule_file_name, config_file_name, sun_files=None):
+    ''' Returns: digest of everything the compiled schedule depends on - the schedule
+        and config files, the local timezone, and the ephemeris and Chebyshev files the
+        sun times come from. sun_files is the names of those two, default the module's
+        ephemeris_file and chebyshev_file.'''
+    if sun_files is None:
+        sun_files = (ephemeris_file, chebyshev_file)
+    parts = [COMPILED_MAGIC, os.environ.get("TZ"), time.timezone, time.altzone, time.tzname]
+    parts += file_stats([schedule_file_name, config_file_name, "/etc/localtime"] + list(sun_files))
+    return hashlib.md5(repr(parts)).digest()
+
+
+# Each compile has a ScheduleParser of its own, but the SunCache it is given may be
+# shared with other compiles, and isn't safe to use from two threads at once. So
+# still one compile at a time. Queries on a CompiledSchedule don't need it. thread
+# rather than threading, which takes far longer to import for the per-minute runs
+# that never use it.
+compile_lock = thread.allocate_lock()
+
+
+class CompiledSchedule(object):
+    ''' The windows for a schedule and config file pair over span, made once by
+        compile_files and never changed after, so any number of threads can query
+        one at the same time. key is schedule_cache_key of the files it came from.'''
+
+    __slots__ = ("index", "span", "key", "latitude", "longitude", "timezone")
+
+    def __init__(self, index, span, key, latitude, longitude, timezone):
+        for name, value in zip(self.__slots__, (index, span, key, latitude, longitude, timezone)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledSchedule is read only")
+
+    @classmethod
+    def from_parser(cls, schedule_parser, key):
+        ''' Returns: CompiledSchedule of what schedule_parser has worked out, after
+            its compile_schedule'''
+        return cls(schedule_parser.schedule_index, schedule_parser.resolved_span, key,
+                   schedule_parser.latitude, schedule_parser.longitude, schedule_parser.get_timezone().name)
+
+    def covers(self, now):
+        return self.span[0] <= now < self.span[1]
+
+    def state(self, now):
+        ''' Returns: (on, next transition), or None for the next transition if it
+            isn't within span. Only meaningful if covers(now).'''
+        change = self.index.next_transition(now)
+        if change is not None and change >= self.span[1]:
+            change = None
+        return self.index.contains(now), change
+
+
+def compile_files(schedule_file_name, config_file_name, now, days=COMPILED_DAYS, sun_cache=None,
+                  sun_files=None):
+    ''' Read a schedule and config file and work out their windows from the start of
+        today to days days after now, with a ScheduleParser of their own, so that
+        default_parser is left as it was.
+        sun_cache, if given, is used instead of a new one, to share it with other
+        compiles for the same location. sun_files is as for schedule_cache_key.
+        Returns: CompiledSchedule'''
+    with compile_lock:
+        schedule_parser = ScheduleParser(sun_cache)
+        key = schedule_cache_key(schedule_file_name, config_file_name, sun_files)
+        schedule_parser.read_config_file(config_file_name)
+        schedule_parser.read_schedule_file(schedule_file_name, now, window=1)
+        schedule_parser.compile_schedule(now, days)
+        return CompiledSchedule.from_parser(schedule_parser, key)
+
+
+class Scheduler(object):
+    ''' A schedule and config file pair that can be queried from many threads.
+        Queries use whichever CompiledSchedule is current; reload compiles a new one
+        and swaps it in with a single assignment, so a query sees either the old
+        schedule or the new one, never a mix. Once the current time is past the end
+        of the current one, the next query reloads first.
+
+            scheduler = Scheduler("/etc/soma/schedule.conf", "/etc/soma/global.conf")
+            on, change = scheduler.state(time.time())
+    '''
+
+    def __init__(self, schedule_file_name, config_file_name, days=COMPILED_DAYS, sun_cache=None):
+        self.schedule_file_name = schedule_file_name
+        self.config_file_name = config_file_name
+        self.days = days
+        self.sun_cache = sun_cache
+        self.own_sun_cache = sun_cache is None
+        self.compiled = None
+        self.reload_lock = thread.allocate_lock()
+
+    def reload(self, now=None, check_files=True):
+        ''' Compile the files again, if they have changed (or check_files is False) or
+            the current schedule doesn't cover now. If another thread is already
+            doing it, wait for that instead.
+            Returns: the CompiledSchedule now current'''
+        if now is None:
+            now = time.time()
+        compiled = self.compiled
+        with self.reload_lock:
+            if self.compiled is not compiled and self.compiled.covers(now):
+                # someone else just did it
+                return self.compiled
+            compiled = self.compiled
+            key = schedule_cache_key(self.schedule_file_name, self.config_file_name)
+            if compiled is None or not compiled.covers(now) or not check_files or compiled.key != key:
+                # a SunCache of our own is started again when the files change, in
+                # case it was the ephemeris files that did
+                if self.sun_cache is None or \
+                   (self.own_sun_cache and compiled is not None and compiled.key != key):
+                    import sunCalcs
+                    self.sun_cache = sunCalcs.SunCache(ephemeris_file=ephemeris_file,
+                                                       chebyshev_file=chebyshev_file)
+                self.compiled = compile_files(self.schedule_file_name, self.config_file_name, now,
+                                              self.days, self.sun_cache)
+            return self.compiled
+
+    def schedule(self, now):
+        ''' Returns: a CompiledSchedule that covers now. The current one is only
+            replaced once the current time is past it; a query about some other time
+            (last month, next year) gets a compile of its own, which is thrown away
+            after, so it can't take the current one away from everyone else.'''
+        compiled = self.compiled
+        if compiled is not None and compiled.covers(now):
+            return compiled
+        current = time.time()
+        if compiled is None or not compiled.covers(current):
+            compiled = self.reload(current, check_files=False)
+            if compiled.covers(now):
+                return compiled
+        return compile_files(self.schedule_file_name, self.config_file_name, now, self.days, self.sun_cache)
+
+    def state(self, now=None):
+        ''' Returns: (on, next transition or None) at now, default the current time'''
+        if now is None:
+            now = time.time()
+        return self.schedule(now).state(now)
+
+    def disposition(self, now=None):
+        if now is None:
+            now = time.time()
+        return self.schedule(now).index.contains(now)
+
+
+# inotify(7) event mask bits
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+
+
+def watch_files(filenames):
+    ''' Watch the directories holding filenames with inotify. Directories rather than
+        the files, since editors usually write a new file and rename it over the old.
+        Returns: inotify file descriptor, or None if inotify isn't available'''
     try:
-        for line in schedule_file:
-            args1 = string.split(line)
-            if len(args1) != 3:
-                continue 
-        
-            the_date = args1[0]
-            start_time = args1[1]
-            end_time = args1[2]
-        
-            if the_date == "default":
-                today = datetime.date.today()
-                start_time_UTC = parse_relative_time(today.year, today.month, today.day, start_time)
-                end_time_UTC   = parse_relative_time(today.year, today.month, today.day, end_time)
-                if (end_time_UTC < start_time_UTC):
-                    tomorrow = today + datetime.timedelta(days=1)
-                    end_time_UTC   = parse_relative_time(tomorrow.year, tomorrow.month, tomorrow.day, end_time)              
-                default_schedule = {"start":start_time_UTC, "end":end_time_UTC}
-            elif p.match(the_date):
-                year, month, day = string.split(the_date, "-")
-                start_time_UTC = parse_relative_time(year, month, day, start_time)
-                end_time_UTC   = parse_relative_time(year, month, day, end_time)
-                if (end_time_UTC < start_time_UTC): 
-                    tomorrow = datetime.date(int(year),int(month),int(day)) + datetime.timedelta(days=1)
-                    end_time_UTC   = parse_relative_time(tomorrow.year, tomorrow.month, tomorrow.day, end_time)   
-                # push onto schedules
-                schedules.append({"start": start_time_UTC, "end":end_time_UTC})
+        import ctypes
+        libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    for directory in set(os.path.dirname(os.path.abspath(name)) for name in filenames):
+        if libc.inotify_add_watch(fd, directory, mask) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+def open_query_socket(path):
+    ''' Returns: listening Unix socket at path, or None if it can't be created'''
+    import socket
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(5)
+    except (OSError, socket.error), e:
+        print "Cannot listen on", path, e
+        return None
+    sock.setblocking(0)
+    return sock
+
+
+def query_reply(now):
+    ''' The answer to a query: "on" or "off", then the time of the next change in
+        unix time, or "none"'''
+    change = next_transition(now)
+    if disposition(now):
+        state = "on"
+    else:
+        state = "off"
+    if change is None:
+        return "%s none\n" % state
+    return "%s %.3f\n" % (state, change)
+
+
+def answer_query(sock):
+    try:
+        connection = sock.accept()[0]
+    except IOError:
+        return
+    try:
+        connection.settimeout(1.0)
+        connection.sendall(query_reply(time.time()))
+    except IOError:
+        pass
+    connection.close()
+
+
+def query_daemon(path):
+    ''' Ask a running --daemon for its state.
+        Returns: (on, next transition or None)'''
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5.0)
+    sock.connect(path)
+    reply = ""
+    while not reply.endswith("\n"):
+        data = sock.recv(64)
+        if not data:
+            break
+        reply += data
+    sock.close()
+    state, change = reply.split()
+    if change == "none":
+        return state == "on", None
+    return state == "on", float(change)
+
+
+# In daemon mode, a start or stop command that fails is tried again after this many
+# seconds, and then twice as long each time, up to RETRY_MAX
+RETRY_FIRST = 10.0
+RETRY_MAX = 600.0
+
+
+def run_daemon(options):
+    ''' Stay resident: run the start or stop command at each change in the schedule,
+        sleeping until the next one in between, and reload the schedule and config
+        files when they change. Never returns, except on SIGTERM or SIGINT.'''
+    import select
+    import signal
+    import heapq
+    import errno
+
+    signals = []
+    def on_signal(signum, frame):
+        signals.append(signum)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, on_signal)
+
+    def load():
+        # the ephemeris files may be what changed, so their sun times go too
+        default_parser.sun_cache = None
+        read_config_file(options.config_file)
+        read_schedule_file(options.schedule_file, time.time(), options.window)
+        return schedule_cache_key(options.schedule_file, options.config_file)
+
+    def actuate(on, now):
+        ''' Returns: whether the command worked'''
+        if on:
+            command = options.start_cmd
+        else:
+            command = options.stop_cmd
+        if options.debug or options.dry_run:
+            print time.ctime(now), "System should be", on and "ON" or "OFF"
+        if options.dry_run:
+            print "I would have run", on and "START" or "STOP", "command", command
+            worked = True
+        else:
+            try:
+                worked = call(command) == 0
+            except OSError:
+                worked = False
+            if worked:
+                try:
+                    write_state(options.state_file, on, now, now)
+                except (IOError, OSError), e:
+                    if options.debug:
+                        print "Cannot save state", options.state_file, e
             else:
+                print time.ctime(now), "Command failed:", command
+        sys.stdout.flush()
+        return worked
+
+    # the state the system was last put in, None until a command has worked, and
+    # when to try again after one that didn't, which backs off from RETRY_FIRST
+    # seconds to RETRY_MAX
+    current = {"state": None, "retry_at": 0.0, "delay": RETRY_FIRST}
+
+    def apply(now):
+        on = disposition(now)
+        if on == current["state"] or now < current["retry_at"]:
+            return
+        if actuate(on, now):
+            current.update(state=on, retry_at=0.0, delay=RETRY_FIRST)
+        else:
+            current["retry_at"] = now + current["delay"]
+            heapq.heappush(timers, (current["retry_at"], "retry"))
+            current["delay"] = min(current["delay"] * 2, RETRY_MAX)
+
+    # (when, what) - what is "transition", "poll" or "retry"
+    timers = []
+    key = load()
+    today = local_date()
+    apply(time.time())
+
+    inotify = watch_files([options.schedule_file, options.config_file])
+    sock = None
+    if options.socket:
+        sock = open_query_socket(options.socket)
+
+    def schedule_transition():
+        change = next_transition(time.time())
+        if change is not None:
+            heapq.heappush(timers, (change, "transition"))
+    schedule_transition()
+    heapq.heappush(timers, (time.time() + options.poll, "poll"))
+
+    try:
+        while True:
+            if signals:
+                signum = signals.pop()
+                if signum == signal.SIGHUP:
+                    # reload, and try a command that failed again now
+                    key = None
+                    current["retry_at"] = 0.0
+                    heapq.heappush(timers, (0, "poll"))
+                else:
+                    break
+
+            # cap the sleep, so that the clock being set (ubrain-clock does this at
+            # boot) is noticed
+            timeout = max(0.0, min(timers[0][0] - time.time(), options.max_sleep))
+            readers = [f for f in (inotify, sock) if f is not None]
+            try:
+                ready = select.select(readers, [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            reload_due = False
+            if inotify is not None and inotify in ready:
+                try:
+                    os.read(inotify, 4096)
+                except OSError:
+                    pass
+                reload_due = True
+            if sock is not None and sock in ready:
+                answer_query(sock)
+
+            now = time.time()
+            while timers and timers[0][0] <= now:
+                when, what = heapq.heappop(timers)
+                if what == "poll":
+                    reload_due = True
+                    heapq.heappush(timers, (now + options.poll, "poll"))
+
+            if reload_due:
+                new_key = schedule_cache_key(options.schedule_file, options.config_file)
+                if new_key != key:
+                    try:
+                        key = load()
+                        if options.debug:
+                            print time.ctime(now), "Reloaded", options.schedule_file
+                    except Exception, e:
+                        print "Cannot reload schedule", e
+
+            # the days already past aren't needed again, so they don't pile up
+            # while the daemon runs
+            if local_date(now) != today:
+                today = local_date(now)
+                default_parser.forget_before(today - datetime.timedelta(days=1))
+
+            # whatever woke us, make sure the state and the next timer are right
+            apply(now)
+            timers = [timer for timer in timers if timer[1] != "transition"]
+            heapq.heapify(timers)
+            schedule_transition()
+    finally:
+        if sock is not None:
+            sock.close()
+            try:
+                os.remove(options.socket)
+            except OSError:
                 pass
-    except:
-        print "Trouble parsing schedule, line", line
-    
 
-def disposition(now):
-    ''' Determine whether the system should be on at this particular point in time.'''
-    #now = datetime.utcnow()
-    global default_schedule, schedules
-    if (default_schedule["start"] <= now and default_schedule["end"] > now):
+
+def read_state(filename):
+    ''' Read what was last done to the system, as saved by write_state.
+        Returns: (on, changed_at, applied_at), or None if there is no saved state'''
+    try:
+        with open(filename) as f:
+            state, changed_at, applied_at = f.read().split()
+        return state == "on", float(changed_at), float(applied_at)
+    except (IOError, ValueError):
+        return None
+
+
+def write_state(filename, on, changed_at, applied_at):
+    ''' Save the state the system was last put in, when it last changed, and when
+        the start or stop command was last run, replacing filename atomically'''
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as f:
+        f.write("%s %.3f %.3f\n" % (on and "on" or "off", changed_at, applied_at))
+    os.rename(tmpname, filename)
+
+
+def should_actuate(on, now, state, reassert, hysteresis):
+    ''' Decide whether to run the start or stop command, given the saved state.
+        A change is held off until the last change is at least hysteresis seconds
+        old, so the system doesn't flap at the edges of a window. With no change, the
+        command is run again every reassert seconds (0 for never), in case something
+        else switched the system, unless the schedule is about to change anyway.'''
+    if state is None:
         return True
-    for schedule in schedules:
-        if (schedule["start"] <= now and schedule["end"] > now):
-            return True
+    last_on, changed_at, applied_at = state
+    if on != last_on:
+        return now - changed_at >= hysteresis
+    if reassert and now - applied_at >= reassert:
+        change = next_transition(now)
+        return change is None or change - now > hysteresis
     return False
-        
+
+
+def wait_until_on(options):
+    ''' Block until the schedule says the system should be on, rereading the
+        schedule and config files if they change in the meantime'''
+    key = schedule_cache_key(options.schedule_file, options.config_file)
+    while True:
+        now = time.time()
+        if disposition(now):
+            return
+        change = next_transition(now)
+        # wake up now and then anyway, for edits and clock changes
+        if change is None:
+            timeout = options.max_sleep
+        else:
+            timeout = min(change - now, options.max_sleep)
+        time.sleep(max(0.0, timeout))
+        new_key = schedule_cache_key(options.schedule_file, options.config_file)
+        if new_key != key:
+            key = new_key
+            read_config_file(options.config_file)
+            read_schedule_file(options.schedule_file, time.time(), options.window)
+
+
+def print_simulation(result, watts=None):
+    show = format_time
+    print "On for %.2f hours (%.2f sampled), %d switches" % (result["exact_hours"], result["on_hours"],
+                                                           len(result["transitions"]))
+    if watts:
+        print "Energy at %g W: %.1f kWh" % (watts, result["exact_hours"] * watts / 1000.0)
+    for change, on in result["transitions"]:
+        print on and "ON " or "OFF", show(change)
+    for first, second in result["overlaps"]:
+        print "OVERLAP", show(first[0]), "-", show(first[1]), "and", show(second[0]), "-", show(second[1])
+    for change, windows in result["dst"]:
+        print "CLOCK CHANGE", format_time(change, "%m-%d-%Y %I:%M%p %Z"), \
+              "(%s before)" % format_time(change - 1, "%I:%M%p %Z")
+        for start, end in windows:
+            print "   ", show(start), "-", show(end), "is %.2f hours" % ((end - start) / 3600.0)
+
 
 if __name__ == '__main__':
 
@@ -140,82 +1088,186 @@ if __name__ == '__main__':
                        help="File to read schedule data from. Default /etc/soma/schedule.conf")
     parser.add_option("--config", dest="config_file", default="/etc/soma/global.conf",
                        help="File to read config data from. Default /etc/soma/global.conf")
+    parser.add_option("--ephemeris", dest="ephemeris_file", default="/etc/soma/sun.eph",
+                       help="Precomputed sunrise/sunset file, written by sunCalcs.py --write-ephemeris. Default /etc/soma/sun.eph")
+    parser.add_option("--chebyshev", dest="chebyshev_file", default="/etc/soma/sun.cheb",
+                       help="Chebyshev ephemeris, written by sunCalcs.py --write-chebyshev, for sun times the --ephemeris file doesn't have. Default /etc/soma/sun.cheb")
     parser.add_option("--start", dest="start_cmd",
                        help="Command to run when schedule says system should be ON. Required.")
     parser.add_option("--stop", dest="stop_cmd",
                        help="Command to run when schedule says system should be OFF. Required.")
     parser.add_option("--status", dest="status_cmd",
                        help="Command to run to find out if sysem is ON or OFF.")
+    parser.add_option("--state-file", dest="state_file", default="/var/run/soma/scheduler.state",
+                       help="Where to keep the state the system was last put in. Default /var/run/soma/scheduler.state")
+    parser.add_option("--reassert", dest="reassert", default=900.0, type="float",
+                       help="Run the start or stop command again after this many seconds without a change, 0 for never. Default 900")
+    parser.add_option("--hysteresis", dest="hysteresis", default=120.0, type="float",
+                       help="Don't change state again within this many seconds of the last change. Default 120")
     parser.add_option("--unixtime", dest="timenow",
                        help="In dry run mode, set timestamp of 'current' time")
+    parser.add_option("--cache", dest="cache_file",
+                       help="Compiled schedule to read, or write if it is out of date. Default next to the schedule file, with a .cache extension")
+    parser.add_option("--no-cache", dest="use_cache", default=True, action="store_false",
+                       help="Don't read or write the compiled schedule")
+    parser.add_option("--window", dest="window", default=2, type="int",
+                       help="Work out times for this many days either side of now up front. Default 2")
+    parser.add_option("--daemon", dest="daemon", default=False, action="store_true",
+                       help="Stay running, and run the start or stop command whenever the schedule changes state")
+    parser.add_option("--socket", dest="socket", default="/var/run/soma/scheduler.sock",
+                       help="In daemon mode, answer queries on this Unix socket. Default /var/run/soma/scheduler.sock")
+    parser.add_option("--next-transition", dest="next_transition", default=False, action="store_true",
+                       help="Print the time of the next change in the schedule, in unix time, and exit")
+    parser.add_option("--wait-until-on", dest="wait_until_on", default=False, action="store_true",
+                       help="Wait until the schedule says the system should be on, then exit")
+    parser.add_option("--simulate", dest="simulate", metavar="FIRST:LAST",
+                       help="Run the schedule from date FIRST to date LAST (YYYY-MM-DD) and report on it")
+    parser.add_option("--watts", dest="watts", type="float",
+                       help="With --simulate, the power drawn when on, to estimate energy used")
+    parser.add_option("--step", dest="step", default=60.0, type="float",
+                       help="With --simulate, the sampling interval in seconds. Default 60")
+    parser.add_option("--query", dest="query", default=False, action="store_true",
+                       help="Ask the daemon listening on --socket whether the system should be on, and when that next changes")
+    parser.add_option("--poll", dest="poll", default=30.0, type="float",
+                       help="In daemon mode, check the schedule and config files for changes this often, in seconds. Default 30")
+    parser.add_option("--max-sleep", dest="max_sleep", default=60.0, type="float",
+                       help="In daemon and --wait-until-on mode, never sleep longer than this, in seconds, in case the clock is changed. Default 60")
     parser.add_option("--dry-run", dest="dry_run", default=False, action="store_true",
                        help="Do a dry run")
     parser.add_option("--debug", dest="debug", default=False, action="store_true", 
                        help="Turn debugging printouts on")
     
     options, args = parser.parse_args()
+
+    if options.query:
+        on, change = query_daemon(options.socket)
+        if change is None:
+            print on and "ON" or "OFF"
+        else:
+            print on and "ON" or "OFF", "until", time.ctime(change)
+        sys.exit(not on)
     
-    if not options.start_cmd or not options.stop_cmd:
+    waiting = options.next_transition or options.wait_until_on or options.simulate
+    if not waiting and (not options.start_cmd or not options.stop_cmd):
         print "\n*** Start and stop commands required ***\n"
         parser.print_help()
         sys.exit()
     
-    if not options.timenow:
-        timenow = datetime.datetime.utcnow()
-    
-    try:
-        read_config_file(options.config_file)
-        if options.debug:
-            print "POSITION:\n", "latitude:", latitude, "longitude:", longitude, "\n"
-    except:
-        print "Cannot read config file", options.config_file
+    if options.timenow:
+        timenow = float(options.timenow)
+    else:
+        timenow = time.time()
+
+    ephemeris_file = options.ephemeris_file
+    chebyshev_file = options.chebyshev_file
+
+    if options.daemon:
+        run_daemon(options)
         sys.exit()
-        
-    if options.debug:
-        print "TIMEZONE:", time.strftime("%z", time.gmtime()), "\n"
 
-        
-    try:
-        read_schedule_file(options.schedule_file)
+    cache_file = options.cache_file or os.path.splitext(options.schedule_file)[0] + ".cache"
+    if options.use_cache:
+        cache_key = schedule_cache_key(options.schedule_file, options.config_file)
+
+    # --debug always reads the files, to show what is in them, and waiting needs
+    # more than the week in the compiled schedule
+    if options.use_cache and not options.debug and not waiting \
+       and read_compiled_schedule(cache_file, cache_key, timenow):
+        pass
+    else:
+        try:
+            read_config_file(options.config_file)
+            if options.debug:
+                print "POSITION:\n", "latitude:", default_parser.latitude, "longitude:", default_parser.longitude, "\n"
+        except:
+            print "Cannot read config file", options.config_file
+            sys.exit(1)
+            
         if options.debug:
-            print "Schedules are:"
-            timeStr = '%m-%d-%Y %I:%M%p'
-            for schedule in schedules:
-                print "START", datetime.datetime.fromtimestamp(schedule["start"]).strftime(timeStr),\
-                     " STOP", datetime.datetime.fromtimestamp(schedule["end"]).strftime(timeStr)
-            print "\nDefault schedule for today is:"
-            print "START", datetime.datetime.fromtimestamp(default_schedule["start"]).strftime(timeStr),\
-                  " STOP", datetime.datetime.fromtimestamp(default_schedule["end"]).strftime(timeStr), "\n"
-    except:
-        print "Cannot read schedule file", options.schedule_file
-        print sys.exc_info()[0]
+            print "TIMEZONE:", get_timezone().name, get_timezone().strftime("%Z", timenow), "\n"
+
+            
+        try:
+            read_schedule_file(options.schedule_file, timenow, options.window)
+            if options.debug:
+                print "Schedules are:"
+                for schedule in sorted(default_parser.schedules, key=lambda schedule: schedule["start"]):
+                    print "START", format_time(schedule["start"]), " STOP", format_time(schedule["end"])
+                if default_parser.default_schedule:
+                    print "\nDefault schedule for today is:"
+                    print "START", format_time(default_parser.default_schedule["start"]),\
+                          " STOP", format_time(default_parser.default_schedule["end"]), "\n"
+                change = next_transition(timenow)
+                if change:
+                    print "Next change at", format_time(change), "\n"
+        except:
+            print "Cannot read schedule file", options.schedule_file
+            print sys.exc_info()[0]
+            sys.exit(1)
+
+        # a dry run, or one for some other time, leaves the cache alone
+        if options.use_cache and not options.dry_run and not options.timenow:
+            try:
+                write_compiled_schedule(cache_file, cache_key, timenow)
+            except (IOError, OSError), e:
+                if options.debug:
+                    print "Cannot write compiled schedule", cache_file, e
+
+    if options.next_transition:
+        change = next_transition(timenow)
+        if change is None:
+            print "none"
+            sys.exit(1)
+        print "%d" % round(change)
+        sys.exit()
+
+    if options.wait_until_on:
+        wait_until_on(options)
+        sys.exit()
+
+    if options.simulate:
+        first, last = options.simulate.split(":")
+        print_simulation(simulate(parse_date(first), parse_date(last), options.step), options.watts)
         sys.exit()
     
+    on = disposition(timenow)
+    if options.debug:
+        print "System should be", on and "ON" or "OFF"
+
     if options.status_cmd:
+        # ask the system, rather than trusting the saved state
         status = call(options.status_cmd)
         if options.debug:
             print ("System is currently", status)
-        
-    if disposition(options.timenow):
-        if options.debug:
-            print "System should be ON"
-        if not options.status_cmd or status != 1:
-            if options.dry_run:
-                print "I would have run START command", options.start_cmd
-            else:
-                if options.debug:
-                    print "Turning system ON"
-                call(options.start_cmd)
+        state = None
+        run = (on and status != 1) or (not on and status != 0)
     else:
+        state = read_state(options.state_file)
+        run = should_actuate(on, timenow, state, options.reassert, options.hysteresis)
         if options.debug:
-            print "System should be OFF"
-        if not options.status_cmd or status != 0:
-            if options.dry_run:
-                print "I would have run STOP command", options.stop_cmd
-            else:
-                if options.debug:
-                    print "Turning system OFF"
-                call(options.stop_cmd)
+            print "Saved state", state, run and "- running command" or "- nothing to do"
+
+    if run:
+        if on:
+            command, name = options.start_cmd, "START"
+        else:
+            command, name = options.stop_cmd, "STOP"
+        if options.dry_run:
+            print "I would have run", name, "command", command
+        else:
+            if options.debug:
+                print "Turning system", on and "ON" or "OFF"
+            # only remember the state if the command worked, so the next run tries again
+            if call(command) == 0:
+                if state is None or state[0] != on:
+                    changed_at = timenow
+                else:
+                    changed_at = state[1]
+                try:
+                    write_state(options.state_file, on, changed_at, timenow)
+                except (IOError, OSError), e:
+                    if options.debug:
+                        print "Cannot save state", options.state_file, e
     
 
 '''
@@ -11,6 +11,12 @@ import math
 import time
 import datetime
 import calendar
+import os
+import mmap
+import struct
+import heapq
+import itertools
+from collections import OrderedDict
 from optparse import OptionParser
 
 #**********************************************************************
@@ -224,93 +230,159 @@ def calcEquationOfTime(t):
     return radToDeg(Etime) * 4.0    # in minutes of time
     
 
-def calcHourAngleSunrise(lat, solarDec):
+def calcSolarState(t):
+    '''Calculate the equation of time and the declination of the sun together. Same
+    results as calcEquationOfTime and calcSunDeclination, but every intermediate value
+    (obliquity, mean longitude, mean anomaly, ...) is only computed once.
+    @t : number of Julian centuries since J2000.0
+    Returns : eqTime (minutes of time), solarDec (degrees)'''
+    l0 = 280.46646 + t * (36000.76983 + 0.0003032 * t)
+    while (l0 > 360.0):
+        l0 -= 360.0
+    while (l0 < 0.0):
+        l0 += 360.0
+
+    m = 357.52911 + t * (35999.05029 - 0.0001537 * t)
+    e = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+
+    mrad = degToRad(m)
+    sinm = math.sin(mrad)
+    sin2m = math.sin(mrad + mrad)
+    c = sinm * (1.914602 - t * (0.004817 + 0.000014 * t)) + sin2m * (0.019993 - 0.000101 * t) + math.sin(mrad + mrad + mrad) * 0.000289
+
+    omega = degToRad(125.04 - 1934.136 * t)
+    seconds = 21.448 - t * (46.8150 + t * (0.00059 - t * (0.001813)))
+    epsilon = 23.0 + (26.0 + (seconds / 60.0)) / 60.0 + 0.00256 * math.cos(omega)
+    lmbda = l0 + c - 0.00569 - 0.00478 * math.sin(omega)
+
+    solarDec = radToDeg(math.asin(math.sin(degToRad(epsilon)) * math.sin(degToRad(lmbda))))
+
+    y = math.tan(degToRad(epsilon) / 2.0)
+    y *= y
+
+    l0rad = degToRad(l0)
+    Etime = (y * math.sin(2.0 * l0rad) - 2.0 * e * sinm + 4.0 * e * y * sinm * math.cos(2.0 * l0rad)
+             - 0.5 * y * y * math.sin(4.0 * l0rad) - 1.25 * e * e * math.sin(2.0 * mrad))
+
+    return radToDeg(Etime) * 4.0, solarDec
+
+
+# Zenith angle of the sun's center at sunrise and sunset, allowing for refraction and
+# the size of the sun's disc, and at the start/end of each kind of twilight
+SUNRISE_ZENITH = 90.833
+TWILIGHT_ZENITHS = {
+    "civil": 96.0,
+    "nautical": 102.0,
+    "astronomical": 108.0,
+}
+
+
+def calcHourAngleSunrise(lat, solarDec, zenith=SUNRISE_ZENITH, clamp=False):
     '''Calculate the hour angle of the sun at sunrise for the latitude
     @lat : latitude of observer in degrees
     @solarDec : declination angle of sun in degrees
+    @zenith : zenith angle of the event in degrees, default sunrise
+    @clamp : if the sun never reaches the zenith angle, return the hour angle where it
+        comes closest (0 or pi) rather than NaN
     Returns : hour angle of sunrise in radians'''
     latRad = degToRad(lat)
     sdRad = degToRad(solarDec)
 
-    HAarg = (math.cos(degToRad(90.833)) / (math.cos(latRad) * math.cos(sdRad)) - math.tan(latRad) * math.tan(sdRad))
+    HAarg = (math.cos(degToRad(zenith)) / (math.cos(latRad) * math.cos(sdRad)) - math.tan(latRad) * math.tan(sdRad))
+    if abs(HAarg) > 1.0:
+        if clamp:
+            return 0.0 if HAarg > 0 else math.pi
+        return float('nan')    # sun never crosses the horizon (polar day or night)
 
-    HA = (math.acos(math.cos(degToRad(90.833)) / (math.cos(latRad) * math.cos(sdRad)) - math.tan(latRad) * math.tan(sdRad)))
+    HA = math.acos(HAarg)
 
     return HA        # in radians
     
 
-def calcHourAngleSunset(lat, solarDec) :
+def calcHourAngleSunset(lat, solarDec, zenith=SUNRISE_ZENITH, clamp=False) :
     '''Calculate the hour angle of the sun at sunset for the latitude
     @lat : latitude of observer in degrees
     @solarDec : declination angle of sun in degrees
+    @zenith : zenith angle of the event in degrees, default sunset
+    @clamp : as for calcHourAngleSunrise
     Returns : hour angle of sunset in radians'''
-    latRad = degToRad(lat)
-    sdRad = degToRad(solarDec)
-
-    HAarg = (math.cos(degToRad(90.833)) / (math.cos(latRad) * math.cos(sdRad)) - math.tan(latRad) * math.tan(sdRad))
-
-    HA = (math.acos(math.cos(degToRad(90.833)) / (math.cos(latRad) * math.cos(sdRad)) - math.tan(latRad) * math.tan(sdRad)))
-
-    return -HA        # in radians
+    return -calcHourAngleSunrise(lat, solarDec, zenith, clamp)        # in radians
     
 
-
-def calcSunriseUTC(JD, latitude, longitude):
-    '''Calculate the Universal Coordinated Time (UTC) of sunrise for the given day 
-    at the given location on earth.
+def calcSolarNoonState(JD, longitude, solarState=calcSolarState):
+    '''Calculate the equation of time and declination of the sun at solar noon, which
+    is where both the sunrise and the sunset calculations start from.
     @JD  : julian day
-    @latitude : latitude of observer in degrees
     @longitude : longitude of observer in degrees
-    Returns : time in minutes from zero Z'''
-    t = calcTimeJulianCent(JD)
-
-    # *** Find the time of solar noon at the location, and use
-    #     that declination. This is better than start of the
-    #     Julian day
-    noonmin = calcSolNoonUTC(t, longitude)
+    @solarState : function giving (eqTime, solarDec) at a time, default calcSolarState
+    Returns : eqTime (minutes of time), solarDec (degrees)'''
+    noonmin = calcSolNoonUTC(calcTimeJulianCent(JD), longitude, solarState)
     tnoon = calcTimeJulianCent(JD + noonmin / 1440.0)
+    return solarState(tnoon)
 
-    # *** First pass to approximate sunrise (using solar noon)
-    eqTime = calcEquationOfTime(tnoon)
-    solarDec = calcSunDeclination(tnoon)
-    hourAngle = calcHourAngleSunrise(latitude, solarDec)
+
+def calcSunEventUTC(t, latitude, longitude, noonState, sign, solarState=calcSolarState):
+    '''Calculate the UTC time of sunrise (sign = 1) or sunset (sign = -1), starting
+    from the solar state at noon.
+    @t : number of Julian centuries since J2000.0, at the start of the day
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @noonState : (eqTime, solarDec) at solar noon, from calcSolarNoonState
+    @solarState : function giving (eqTime, solarDec) at a time, default calcSolarState
+    Returns : time in minutes from zero Z, NaN if the sun doesn't rise or set'''
+
+    # *** First pass to approximate the event (using solar noon)
+    eqTime, solarDec = noonState
+    hourAngle = sign * calcHourAngleSunrise(latitude, solarDec)
 
     delta = longitude - radToDeg(hourAngle)
     timeDiff = 4 * delta    # in minutes of time
     timeUTC = 720 + timeDiff - eqTime    # in minutes
 
-    # alert("eqTime = " + eqTime + "\nsolarDec = " + solarDec + "\ntimeUTC = " + timeUTC)
-
     # *** Second pass includes fractional jday in gamma calc
-
     newt = calcTimeJulianCent(calcJDFromJulianCent(t) + timeUTC / 1440.0)
-    eqTime = calcEquationOfTime(newt)
-    solarDec = calcSunDeclination(newt)
-    hourAngle = calcHourAngleSunrise(latitude, solarDec)
+    eqTime, solarDec = solarState(newt)
+    hourAngle = sign * calcHourAngleSunrise(latitude, solarDec)
+
     delta = longitude - radToDeg(hourAngle)
     timeDiff = 4 * delta
     timeUTC = 720 + timeDiff - eqTime # in minutes
 
-    # alert("eqTime = " + eqTime + "\nsolarDec = " + solarDec + "\ntimeUTC = " + timeUTC)
+    return timeUTC
+
 
-    return timeUTC  # XXX what about NaN?  This function is allowed to return NaN.
+def calcSunriseUTC(JD, latitude, longitude):
+    '''Calculate the Universal Coordinated Time (UTC) of sunrise for the given day 
+    at the given location on earth.
+    @JD  : julian day
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    Returns : time in minutes from zero Z, NaN if there is no sunrise on this day'''
+    t = calcTimeJulianCent(JD)
+
+    # *** Find the time of solar noon at the location, and use
+    #     that declination. This is better than start of the
+    #     Julian day
+    noonState = calcSolarNoonState(JD, longitude)
+
+    return calcSunEventUTC(t, latitude, longitude, noonState, 1)
     
 
-def calcSolNoonUTC(t, longitude) :
+def calcSolNoonUTC(t, longitude, solarState=calcSolarState) :
     '''Calculate the Universal Coordinated Time (UTC) of solar noon for the given day
      at the given location on earth.
     @t : number of Julian centuries since J2000.0
     @longitude : longitude of observer in degrees
+    @solarState : function giving (eqTime, solarDec) at a time, default calcSolarState
     Returns: time in minutes from start of day in UTC'''
     # First pass uses approximate solar noon to calculate eqtime
     tnoon = calcTimeJulianCent(calcJDFromJulianCent(t) + longitude / 360.0)
-    eqTime = calcEquationOfTime(tnoon)
+    eqTime, solarDec = solarState(tnoon)
     solNoonUTC = 720 + (longitude * 4) - eqTime # min
 
     newt = calcTimeJulianCent(calcJDFromJulianCent(t) - 0.5 + solNoonUTC / 1440.0)
 
-    eqTime = calcEquationOfTime(newt)
-    # var solarNoonDec = calcSunDeclination(newt)
+    eqTime, solarNoonDec = solarState(newt)
     solNoonUTC = 720 + (longitude * 4) - eqTime # min
 
     return solNoonUTC
@@ -322,39 +394,176 @@ def calcSunsetUTC(JD, latitude, longitude):
     @JD  : julian day
     @latitude : latitude of observer in degrees	
     @longitude : longitude of observer in degrees
-    Retuns : time in minutes from zero Z'''
+    Retuns : time in minutes from zero Z, NaN if there is no sunset on this day'''
     t = calcTimeJulianCent(JD)
 
     # *** Find the time of solar noon at the location, and use
     #     that declination. This is better than start of the
     #     Julian day
+    noonState = calcSolarNoonState(JD, longitude)
 
-    noonmin = calcSolNoonUTC(t, longitude)
-    tnoon = calcTimeJulianCent(JD + noonmin / 1440.0)
+    return calcSunEventUTC(t, latitude, longitude, noonState, -1)
 
-    # First calculates sunrise and approx length of day
 
-    eqTime = calcEquationOfTime(tnoon)
-    solarDec = calcSunDeclination(tnoon)
-    hourAngle = calcHourAngleSunset(latitude, solarDec)
+def calcSunriseSetUTC(JD, latitude, longitude, solarState=calcSolarState):
+    '''Calculate the UTC times of both sunrise and sunset for the given day at the
+    given location on earth. Same results as calcSunriseUTC and calcSunsetUTC, but
+    solar noon is only worked out once.
+    @JD  : julian day
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @solarState : function giving (eqTime, solarDec) at a time, default calcSolarState
+    Returns : riseTime, setTime in minutes from zero Z, NaN if there is no such event'''
+    t = calcTimeJulianCent(JD)
+    noonState = calcSolarNoonState(JD, longitude, solarState)
 
-    delta = longitude - radToDeg(hourAngle)
-    timeDiff = 4 * delta
-    timeUTC = 720 + timeDiff - eqTime
+    return (calcSunEventUTC(t, latitude, longitude, noonState, 1, solarState),
+            calcSunEventUTC(t, latitude, longitude, noonState, -1, solarState))
 
-    # first pass used to include fractional day in gamma calc
 
-    newt = calcTimeJulianCent(calcJDFromJulianCent(t) + timeUTC / 1440.0)
-    eqTime = calcEquationOfTime(newt)
-    solarDec = calcSunDeclination(newt)
-    hourAngle = calcHourAngleSunset(latitude, solarDec)
 
-    delta = longitude - radToDeg(hourAngle)
-    timeDiff = 4 * delta
-    timeUTC = 720 + timeDiff - eqTime # in minutes
+def calcSunEventsUTC(JD, latitude, longitude, zeniths, clamp=False):
+    '''Calculate the UTC times the sun crosses each of the given zenith angles, rising
+    and setting, on the given day. The solar state is worked out once for the day,
+    at solar noon and half a day either side of it, and the second pass for each
+    event interpolates between those, so each extra zenith angle costs a fraction of
+    a full sunrise/sunset calculation. Agrees with calcSunriseSetUTC to within a few
+    milliseconds.
+    @JD  : julian day
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @zeniths : sequence of zenith angles in degrees (see SUNRISE_ZENITH, TWILIGHT_ZENITHS)
+    @clamp : if the sun never reaches a zenith angle, report the time it comes closest
+        (solar noon or midnight) instead of NaN
+    Returns : list of (riseTime, setTime) in minutes from zero Z, one per zenith angle'''
+    t = calcTimeJulianCent(JD)
+    noonmin = calcSolNoonUTC(t, longitude)
+    tnoon = calcTimeJulianCent(JD + noonmin / 1440.0)
 
-    return timeUTC
+    # solar state at noon - half a day, noon, noon + half a day
+    eqNoon, decNoon = calcSolarState(tnoon)
+    eqBefore, decBefore = calcSolarState(calcTimeJulianCent(JD + noonmin / 1440.0 - 0.5))
+    eqAfter, decAfter = calcSolarState(calcTimeJulianCent(JD + noonmin / 1440.0 + 0.5))
+
+    # quadratic through the three, as a function of minutes from solar noon / 720
+    eqSlope = (eqAfter - eqBefore) / 2.0
+    eqCurve = (eqAfter + eqBefore) / 2.0 - eqNoon
+    decSlope = (decAfter - decBefore) / 2.0
+    decCurve = (decAfter + decBefore) / 2.0 - decNoon
+
+    results = []
+    for zenith in zeniths:
+        times = []
+        for sign in (1, -1):
+            # *** First pass using the state at solar noon
+            hourAngle = sign * calcHourAngleSunrise(latitude, decNoon, zenith, clamp)
+            timeUTC = 720 + 4 * (longitude - radToDeg(hourAngle)) - eqNoon
+
+            # *** Second pass with the state interpolated to the approximate event time
+            x = (timeUTC - noonmin) / 720.0
+            eqTime = eqNoon + x * (eqSlope + x * eqCurve)
+            solarDec = decNoon + x * (decSlope + x * decCurve)
+            hourAngle = sign * calcHourAngleSunrise(latitude, solarDec, zenith, clamp)
+            times.append(720 + 4 * (longitude - radToDeg(hourAngle)) - eqTime)
+        results.append(tuple(times))
+
+    return results
+
+
+def calcSunEvents(latitude, longitude, date, zeniths, clamp=False):
+    '''Calculate the times the sun crosses each of the given zenith angles on the
+    given date. See calcSunEventsUTC.
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @date : date at which to calculate the events
+    @zeniths : sequence of zenith angles in degrees
+    @clamp : report solar noon or midnight instead of NaN when the sun never gets there
+    Returns: list of (riseTime, setTime) UTC timestamp tuples, one per zenith angle'''
+    baseDate = calendar.timegm([date.year, date.month, date.day,0,0,0])
+    JD = calcJD(date.year, date.month, date.day)
+    return [(baseDate + riseTimeGMT * 60, baseDate + setTimeGMT * 60)
+            for riseTimeGMT, setTimeGMT in calcSunEventsUTC(JD, latitude, longitude, zeniths, clamp)]
+
+
+# The sun's declination never changes by more than about 0.4 degrees a day
+MAX_DECLINATION_RATE = 0.41
+# How much the declination can differ between solar noon and sunrise or sunset, so
+# how close calcPolarMargin has to get to zero before there can be an event
+POLAR_MARGIN_SLACK = 0.25
+# Upper bound on the number of steps findSunEventDay takes
+MAX_POLAR_SEARCH = 64
+# Longest bracket findSunEventDay will try near the boundary. Close to the solstices
+# the margin barely changes from one day to the next, so extrapolating it can land
+# months away, past a whole polar day or night.
+MAX_POLAR_BRACKET = 8
+
+
+def calcPolarMargin(jd, latitude, longitude):
+    '''How far the sun's declination at solar noon is from letting it rise and set on
+    the given day. The sun stays up all day when its lower culmination is above the
+    horizon (declination > 89.167 - latitude), and down all day when its upper
+    culmination is below it (declination < latitude - 90.833).
+    @jd : julian day
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    Returns : margin in degrees, positive if there is no sunrise or sunset on this day'''
+    solarDec = calcSunDeclination(calcTimeJulianCent(jd + 0.5 + longitude / 360.0))
+    if latitude < 0:
+        latitude = -latitude
+        solarDec = -solarDec
+    return max(solarDec - (89.167 - latitude), (latitude - 90.833) - solarDec)
+
+
+def findSunEventDay(jd, latitude, longitude, calcEvent, direction):
+    '''Find the nearest julian day, starting from the given day and moving forward
+    (direction = 1) or back (direction = -1), on which calcEvent finds a time.
+    Rather than trying every day, jump towards the polar day/night boundary as far
+    as the declination of the sun allows without passing it. Near the boundary,
+    bracket the first day with an event using the rate the margin is shrinking at,
+    and bisect the bracket with the full calculation. Takes no more than
+    MAX_POLAR_SEARCH steps.
+    @jd : julian day
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @calcEvent : calcSunriseUTC or calcSunsetUTC
+    @direction : 1 or -1
+    Returns : julian day of the nearest event'''
+    if isNumber(calcEvent(jd, latitude, longitude)):
+        return jd
+
+    lo = jd        # always a day without an event
+    hi = None
+    steps = 0
+    while hi is None and steps < MAX_POLAR_SEARCH:
+        steps += 1
+        margin = calcPolarMargin(lo, latitude, longitude)
+        jump = int((margin - POLAR_MARGIN_SLACK) / MAX_DECLINATION_RATE)
+        if jump >= 1:
+            lo += direction * jump
+            continue
+
+        rate = margin - calcPolarMargin(lo + direction, latitude, longitude)
+        if rate > 0 and margin > 0:
+            candidate = lo + direction * int(min(MAX_POLAR_BRACKET, math.ceil(margin / rate)))
+        else:
+            candidate = lo + direction
+        if isNumber(calcEvent(candidate, latitude, longitude)):
+            hi = candidate
+        else:
+            lo = candidate
 
+    if hi is None:
+        return lo
+
+    while abs(hi - lo) > 1 and steps < MAX_POLAR_SEARCH:
+        steps += 1
+        mid = lo + direction * (abs(hi - lo) // 2)
+        if isNumber(calcEvent(mid, latitude, longitude)):
+            hi = mid
+        else:
+            lo = mid
+
+    return hi
 
 
 def findRecentSunrise(jd, latitude, longitude): 
@@ -364,14 +573,7 @@ def findRecentSunrise(jd, latitude, longitude):
     @latitude : latitude of observer in degrees
     @longitude : longitude of observer in degrees
     Returns : julian day of the most recent sunrise'''
-    julianday = jd
-
-    time = calcSunriseUTC(julianday, latitude, longitude)
-    while ( not isNumber(time)):  # XXX how is this going to work?
-        julianday -= 1.0
-        time = calcSunriseUTC(julianday, latitude, longitude)
-
-    return julianday
+    return findSunEventDay(jd, latitude, longitude, calcSunriseUTC, -1)
 
 
 def isNumber(number):
@@ -385,14 +587,7 @@ def findRecentSunset(jd, latitude, longitude):
     @latitude : latitude of observer in degrees
     @longitude : longitude of observer in degrees
     Returns : julian day of the most recent sunset'''
-    julianday = jd
-
-    time = calcSunsetUTC(julianday, latitude, longitude)
-    while (not isNumber(time)):
-        julianday -= 1.0
-        time = calcSunsetUTC(julianday, latitude, longitude)
- 
-    return julianday
+    return findSunEventDay(jd, latitude, longitude, calcSunsetUTC, -1)
     
 
 
@@ -403,14 +598,7 @@ def findNextSunrise(jd, latitude, longitude):
     @latitude : latitude of observer in degrees
     @longitude : longitude of observer in degrees
     Returns : julian day of the next sunrise'''
-    julianday = jd
-
-    time = calcSunriseUTC(julianday, latitude, longitude)
-    while (not isNumber(time)):
-        julianday += 1.0
-        time = calcSunriseUTC(julianday, latitude, longitude)
-
-    return julianday
+    return findSunEventDay(jd, latitude, longitude, calcSunriseUTC, 1)
     
 
 
@@ -421,14 +609,7 @@ def findNextSunset(jd, latitude, longitude):
     @latitude : latitude of observer in degrees
     @longitude : longitude of observer in degrees
     Returns : julian day of the next sunset'''
-    julianday = jd
-
-    time = calcSunsetUTC(julianday, latitude, longitude)
-    while (not isNumber(time)):
-        julianday += 1.0
-        time = calcSunsetUTC(julianday, latitude, longitude)
-
-    return julianday
+    return findSunEventDay(jd, latitude, longitude, calcSunsetUTC, 1)
     
 
 def timeString(minutes):
@@ -464,55 +645,78 @@ def timeString(minutes):
 # Exported Functions here
 # 
 #############################################################
-def calcNextSun(latitude, longitude, date):
+def iterSunEvents(latitude, longitude, start):
+    '''Generate every sunrise and sunset after the given instant, in time order. Each
+    day is calculated once, when the stream gets to it; runs of polar days or nights
+    with neither event are skipped over with findNextSunrise/findNextSunset.
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @start : UTC timestamp to start from
+    Yields: (event_type, utc_timestamp), event_type being "sunrise" or "sunset"'''
+    if ((latitude >= -90) and (latitude < -89)) :
+        latitude = -89
+    if ((latitude <= 90) and (latitude > 89)) :
+        latitude = 89
+
+    # An event can be up to about 12 hours before the start of its UTC day (and a day
+    # and a half after it), so start two days early
+    date = datetime.datetime.utcfromtimestamp(start - 2 * 86400).date()
+    JD = calcJD(date.year, date.month, date.day)
+    baseDate = calendar.timegm([date.year, date.month, date.day,0,0,0])
+
+    pending = []    # heap of (utc_timestamp, event_type) not yet yielded
+    while True:
+        riseTimeGMT, setTimeGMT = calcSunriseSetUTC(JD, latitude, longitude)
+        if isNumber(riseTimeGMT):
+            heapq.heappush(pending, (baseDate + riseTimeGMT * 60, "sunrise"))
+        if isNumber(setTimeGMT):
+            heapq.heappush(pending, (baseDate + setTimeGMT * 60, "sunset"))
+
+        days = 1
+        if not isNumber(riseTimeGMT) and not isNumber(setTimeGMT):
+            days = max(1, min(findNextSunrise(JD, latitude, longitude),
+                              findNextSunset(JD, latitude, longitude)) - JD)
+        JD += days
+        baseDate += days * 86400
+
+        # nothing from the days still to come can be earlier than this
+        while pending and pending[0][0] < baseDate - 86400:
+            utc_timestamp, event_type = heapq.heappop(pending)
+            if utc_timestamp >= start:
+                yield event_type, utc_timestamp
+
+
+def nextSunEvents(latitude, longitude, start, count):
+    '''The next count sunrises and sunsets after start.
+    Returns: list of (event_type, utc_timestamp)'''
+    return list(itertools.islice(iterSunEvents(latitude, longitude, start), count))
+
+
+def sunEventsBetween(latitude, longitude, start, end):
+    '''The sunrises and sunsets from start up to (not including) end.
+    Returns: list of (event_type, utc_timestamp)'''
+    return list(itertools.takewhile(lambda event: event[1] < end, iterSunEvents(latitude, longitude, start)))
+
+
+def calcNextSun(latitude, longitude, date, now=None):
     '''Calculate next sunrise and sunset, after current time, given the entered
-    location.  In the special cases near earth's poles the date of nearest sunrise 
-    and set are reported.
+    location.  Near earth's poles these may be days or months away.
     @latitude : latitude of observer in degrees
     @longitude : longitude of observer in degrees
+    @date : unused, kept for compatibility. The search starts at now.
+    @now : UTC timestamp to search from, default the current time
     Returns: riseTime, setTime - UTC timestamp tuple'''
-    
-    # set up base dates for passed in date, as well as next and previous dates  
-    oneDay = datetime.timedelta(days=1)
-
-    todayDate = date
-    tomorrowDate = todayDate + oneDay
-    yesterdayDate = todayDate - oneDay
-
-    todayBaseDate = calendar.timegm([todayDate.year, todayDate.month, todayDate.day,0,0,0])
-    tomorrowBaseDate = calendar.timegm([tomorrowDate.year, tomorrowDate.month, tomorrowDate.day,0,0,0])
-    yesterdayBaseDate = calendar.timegm([yesterdayDate.year, yesterdayDate.month, yesterdayDate.day,0,0,0])
-      
-    JDToday     = calcJD(todayDate.year,     todayDate.month,     todayDate.day)
-    JDTomorrow  = calcJD(tomorrowDate.year,  tomorrowDate.month,  tomorrowDate.day)
-    JDYesterday = calcJD(yesterdayDate.year, yesterdayDate.month, yesterdayDate.day)
-
-    # calculate UTC rise and set times for yesterday, today, and tomorrow
-    riseSets = [None] * 10
-    riseSets[0] = yesterdayBaseDate + calcSunriseUTC(JDYesterday, latitude, longitude) * 60 #* 1000
-    riseSets[1] = yesterdayBaseDate + calcSunsetUTC( JDYesterday, latitude, longitude) * 60 #* 1000
-
-    riseSets[2] = todayBaseDate + calcSunriseUTC(JDToday, latitude, longitude) * 60 #* 1000
-    riseSets[3] = todayBaseDate + calcSunsetUTC( JDToday, latitude, longitude) * 60  #* 1000
-
-    riseSets[4] = tomorrowBaseDate + calcSunriseUTC(JDTomorrow, latitude, longitude) * 60 #* 1000
-    riseSets[5] = tomorrowBaseDate + calcSunsetUTC( JDTomorrow, latitude, longitude) * 60  #* 1000
-
-    # parse through, looking for the pair right after the current date...    
-    overTime = 0
-    curUTC = time.time()
-    for overTime in range(0,6):
-        if (riseSets[overTime] > curUTC):
+    if now is None:
+        now = time.time()
+
+    riseTime = setTime = None
+    for event_type, utc_timestamp in iterSunEvents(latitude, longitude, now):
+        if event_type == "sunrise" and riseTime is None:
+            riseTime = utc_timestamp
+        elif event_type == "sunset" and setTime is None:
+            setTime = utc_timestamp
+        if riseTime is not None and setTime is not None:
             break
-    
-    # XXX - What do you do with overtime == 5? I mean, sure, you're fucked. But what do you do?
-    if (overTime < 5):
-        if (overTime % 2 == 1):
-            riseTime = riseSets[overTime + 1]
-            setTime = riseSets[overTime]
-        else: 
-            riseTime = riseSets[overTime]
-            setTime  = riseSets[overTime + 1]
 
     return riseTime, setTime
     
@@ -550,17 +754,16 @@ def calcSun(latitude, longitude, date):
     #eqTime = Etime
     #solarDec = theta
 
-    # Calculate sunrise for this date
+    # Calculate sunrise and sunset for this date
     # if no sunrise is found, set flag nosunrise
+    # if no sunset is found, set flag nosunset
+    riseTimeGMT, setTimeGMT = calcSunriseSetUTC(JD, latitude, longitude)
+
     nosunrise = False
-    riseTimeGMT = calcSunriseUTC(JD, latitude, longitude)
     if (not isNumber(riseTimeGMT)):
         nosunrise = True    
 
-    # Calculate sunset for this date
-    # if no sunset is found, set flag nosunset
     nosunset = False
-    setTimeGMT = calcSunsetUTC(JD, latitude, longitude)
     if (not isNumber(setTimeGMT)):
         nosunset = True
     
@@ -645,6 +848,568 @@ def calcSun(latitude, longitude, date):
     return riseTime, setTime
 
 
+#**********************************************************************
+#**********************************************************************
+#
+# Vectorized versions of the above, for computing whole date ranges at
+# once. These need numpy, which is only imported when they are called.
+#
+#**********************************************************************
+#**********************************************************************
+
+def calcSolarStateArray(t):
+    '''Calculate the equation of time and solar declination for an array of times.
+    Same math as calcEquationOfTime and calcSunDeclination.
+    @t : numpy array of Julian centuries since J2000.0
+    Returns : eqTime (minutes of time), solarDec (degrees) as numpy arrays'''
+    import numpy
+
+    l0 = numpy.mod(280.46646 + t * (36000.76983 + 0.0003032 * t), 360.0)
+    m = 357.52911 + t * (35999.05029 - 0.0001537 * t)
+    e = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+
+    mrad = numpy.radians(m)
+    c = (numpy.sin(mrad) * (1.914602 - t * (0.004817 + 0.000014 * t)) +
+         numpy.sin(2 * mrad) * (0.019993 - 0.000101 * t) + numpy.sin(3 * mrad) * 0.000289)
+
+    omega = numpy.radians(125.04 - 1934.136 * t)
+    seconds = 21.448 - t * (46.8150 + t * (0.00059 - t * (0.001813)))
+    epsilon = numpy.radians(23.0 + (26.0 + (seconds / 60.0)) / 60.0 + 0.00256 * numpy.cos(omega))
+    lmbda = numpy.radians(l0 + c - 0.00569 - 0.00478 * numpy.sin(omega))
+
+    solarDec = numpy.degrees(numpy.arcsin(numpy.sin(epsilon) * numpy.sin(lmbda)))
+
+    y = numpy.tan(epsilon / 2.0) ** 2
+    l0rad = numpy.radians(l0)
+    sinm = numpy.sin(mrad)
+    Etime = (y * numpy.sin(2.0 * l0rad) - 2.0 * e * sinm + 4.0 * e * y * sinm * numpy.cos(2.0 * l0rad) -
+             0.5 * y * y * numpy.sin(4.0 * l0rad) - 1.25 * e * e * numpy.sin(2.0 * mrad))
+    eqTime = numpy.degrees(Etime) * 4.0
+
+    return eqTime, solarDec
+
+
+def calcHourAngleArray(lat, solarDec, zenith=SUNRISE_ZENITH):
+    '''Calculate the (sunrise) hour angle for arrays of latitudes and declinations.
+    Days on which the sun never crosses the horizon come back as NaN.
+    @lat : latitude of observer in degrees
+    @solarDec : numpy array of solar declinations in degrees
+    @zenith : zenith angle of the event in degrees, default sunrise
+    Returns : hour angle in radians'''
+    import numpy
+
+    latRad = numpy.radians(lat)
+    sdRad = numpy.radians(solarDec)
+    HAarg = (math.cos(degToRad(zenith)) / (numpy.cos(latRad) * numpy.cos(sdRad)) - numpy.tan(latRad) * numpy.tan(sdRad))
+    with numpy.errstate(invalid='ignore'):
+        HAarg = numpy.where(numpy.abs(HAarg) > 1.0, numpy.nan, HAarg)
+    return numpy.arccos(HAarg)
+
+
+def calcSunEventUTCArray(JD, latitude, longitude, sign):
+    '''Vectorized calcSunriseUTC (sign=1) / calcSunsetUTC (sign=-1).
+    @JD : numpy array of julian days
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    Returns : numpy array of times in minutes from zero Z, NaN if there is no event'''
+    import numpy
+
+    t = (JD - 2451545.0) / 36525.0
+
+    # solar noon, as in calcSolNoonUTC
+    eqTime, solarDec = calcSolarStateArray(t + (longitude / 360.0) / 36525.0)
+    solNoonUTC = 720 + (longitude * 4) - eqTime
+    eqTime, solarDec = calcSolarStateArray(t + (solNoonUTC / 1440.0 - 0.5) / 36525.0)
+    noonmin = 720 + (longitude * 4) - eqTime
+
+    # first pass, using the declination at solar noon
+    eqTime, solarDec = calcSolarStateArray(t + (noonmin / 1440.0) / 36525.0)
+    hourAngle = sign * calcHourAngleArray(latitude, solarDec)
+    timeUTC = 720 + 4 * (longitude - numpy.degrees(hourAngle)) - eqTime
+
+    # second pass, at the approximate time of the event
+    eqTime, solarDec = calcSolarStateArray(t + (timeUTC / 1440.0) / 36525.0)
+    hourAngle = sign * calcHourAngleArray(latitude, solarDec)
+    timeUTC = 720 + 4 * (longitude - numpy.degrees(hourAngle)) - eqTime
+
+    return timeUTC
+
+
+def fillPolarArray(times, JD, latitude, longitude, calcEvent, findRecent, findNext, useRecent):
+    '''Fill the NaN entries of a sunrise or sunset array the way calcSun does, with the
+    time of the most recent (useRecent) or next event. Valid days inside the array are
+    used first; only entries with no valid day in range fall back to findRecent/findNext.
+    @times : numpy array of event times in minutes, NaN where there is no event
+    @JD : numpy array of julian days matching times
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @calcEvent : calcSunriseUTC or calcSunsetUTC
+    @findRecent, findNext : the matching findRecent*/findNext* functions
+    @useRecent : boolean numpy array, True to use the most recent event rather than the next
+    Returns : filled copy of times'''
+    import numpy
+
+    n = len(times)
+    valid = ~numpy.isnan(times)
+    index = numpy.arange(n)
+
+    recent = numpy.maximum.accumulate(numpy.where(valid, index, -1))
+    following = numpy.minimum.accumulate(numpy.where(valid, index, n)[::-1])[::-1]
+
+    # Days with no valid day before (after) them in the array all share the event
+    # found by searching back from the first (forward from the last) day
+    before = []
+    after = []
+
+    filled = times.copy()
+    for i in numpy.nonzero(~valid)[0]:
+        j = recent[i] if useRecent[i] else following[i]
+        if 0 <= j < n:
+            filled[i] = times[j]
+        elif useRecent[i]:
+            if not before:
+                before.append(calcEvent(findRecent(JD[0], latitude, longitude), latitude, longitude))
+            filled[i] = before[0]
+        else:
+            if not after:
+                after.append(calcEvent(findNext(JD[-1], latitude, longitude), latitude, longitude))
+            filled[i] = after[0]
+    return filled
+
+
+def calcSunRange(latitude, longitude, start_date, end_date):
+    '''Calculate time of sunrise and sunset for every day from start_date to end_date
+    (inclusive) in one vectorized pass. Gives the same results as calling calcSun for
+    each day, including the special cases near earth's poles.
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @start_date : first date of the range
+    @end_date : last date of the range
+    Returns: riseTimes, setTimes - numpy arrays of UTC timestamps, one per day'''
+    riseTimes, setTimes = calcSunSites([(latitude, longitude)], start_date, end_date)
+    return riseTimes[0], setTimes[0]
+
+
+def calcSunSites(sites, start_date, end_date):
+    '''Calculate time of sunrise and sunset at several sites for every day from
+    start_date to end_date (inclusive), all in one vectorized pass. Gives the same
+    results as calling calcSun for each site and day.
+    @sites : sequence of (latitude, longitude) pairs, in degrees
+    @start_date : first date of the range
+    @end_date : last date of the range
+    Returns: riseTimes, setTimes - numpy arrays of UTC timestamps, sites x days'''
+    import numpy
+
+    sites = numpy.asarray(sites, dtype=float).reshape(-1, 2)
+    # as in calcSun, latitudes within a degree of the poles are moved to 89
+    latitude = numpy.clip(sites[:, 0:1], -89, 89)
+    longitude = sites[:, 1:2]
+
+    ndays = max(0, (end_date - start_date).days + 1)
+    days = numpy.arange(ndays)
+    baseDates = calendar.timegm([start_date.year, start_date.month, start_date.day,0,0,0]) + days * 86400.0
+    JD = calcJD(start_date.year, start_date.month, start_date.day) + days
+
+    riseTimeGMT = calcSunEventUTCArray(JD, latitude, longitude, 1)
+    setTimeGMT = calcSunEventUTCArray(JD, latitude, longitude, -1)
+
+    nosunrise = numpy.isnan(riseTimeGMT)
+    nosunset = numpy.isnan(setTimeGMT)
+    neither = numpy.zeros(riseTimeGMT.shape, dtype=bool)
+    polar = numpy.nonzero((nosunrise | nosunset).any(axis=1))[0]
+    if len(polar):
+        # day of year, for the seasonal tests in calcSun
+        doy = numpy.array([(start_date + datetime.timedelta(days=int(i))).timetuple().tm_yday for i in days])
+    for site in polar:
+        lat = latitude[site, 0]
+        lon = longitude[site, 0]
+        summer = (((lat > 66.4) & (doy > 79) & (doy < 267)) |
+                  ((lat < -66.4) & ((doy < 83) | (doy > 263))))
+        winter = ~summer & (((lat > 66.4) & ((doy < 83) | (doy > 263))) |
+                            ((lat < -66.4) & (doy > 79) & (doy < 267)))
+        neither[site] = ~summer & ~winter
+
+        # in summer use the previous sunrise and next sunset, in winter the reverse
+        riseTimeGMT[site] = fillPolarArray(riseTimeGMT[site], JD, lat, lon, calcSunriseUTC,
+                                           findRecentSunrise, findNextSunrise, summer)
+        setTimeGMT[site] = fillPolarArray(setTimeGMT[site], JD, lat, lon, calcSunsetUTC,
+                                          findRecentSunset, findNextSunset, winter)
+
+    riseTimes = numpy.where(nosunrise & neither, 0, baseDates + riseTimeGMT * 60)
+    setTimes = numpy.where(nosunset & neither, 0, baseDates + setTimeGMT * 60)
+
+    return riseTimes, setTimes
+
+
+#**********************************************************************
+#**********************************************************************
+#
+# Chebyshev ephemeris mode. The equation of time and the declination of
+# the sun are smooth functions of time, so instead of running the NOAA
+# series every time, fit them once with piecewise Chebyshev polynomials
+# (EPHEMERIS_SEGMENTS pieces a year, degree EPHEMERIS_DEGREE) and
+# evaluate those. The fit is the same for every site.
+#
+# With 24 segments of degree 6 the fit is within 1e-6 seconds of the
+# equation of time and 2e-9 degrees of the declination. Sunrise and
+# sunset come out within 0.0001 seconds of calcSunriseUTC/calcSunsetUTC
+# at every latitude up to 89 degrees (within 0.000002 seconds below the
+# polar circles). Rise and set still take the same five solar states as
+# the NOAA passes - they depend on the site, so can't be fitted once for
+# all of them - but each is a degree 6 Horner evaluation, and a day takes
+# about 40% of the time. See bench/sun_bench.py --bench chebyshev.
+#
+# SunCache uses it, when given a chebyshev_file, for the sites its
+# per-site ephemeris file doesn't cover - multi_schedule.py's other
+# sites, or a lat/long changed since 'make ephemeris'.
+#
+# File layout (little endian):
+#   header : magic "SOMACHB1", first year, number of years, segments per
+#            year, degree (int32s)
+#   coefficients : (degree + 1) equation of time coefficients followed by
+#            (degree + 1) declination coefficients (doubles), per segment
+#
+#**********************************************************************
+#**********************************************************************
+
+EPHEMERIS_SEGMENTS = 24
+EPHEMERIS_DEGREE = 6
+CHEBYSHEV_MAGIC = "SOMACHB1"
+CHEBYSHEV_HEADER = struct.Struct("<8siiii")
+
+
+class ChebyshevEphemeris(object):
+    '''Piecewise Chebyshev fit of the equation of time and the declination of the sun
+    over a range of years. Build one with fit() (needs numpy) or load() it from a
+    file written by save(). Times outside the fitted years use calcSolarState.'''
+
+    def __init__(self, first_year, years, coefficients, segments=EPHEMERIS_SEGMENTS, degree=EPHEMERIS_DEGREE):
+        self.first_year = first_year
+        self.years = years
+        self.segments = segments
+        self.degree = degree
+        self.coefficients = coefficients    # flat sequence of doubles, see above
+        # a couple of days of overlap at each end, for events before the first
+        # day's UTC midnight or after the last's
+        self.start = calcTimeJulianCent(calcJD(first_year, 1, 1) - 2)
+        end = calcTimeJulianCent(calcJD(first_year + years, 1, 1) + 2)
+        self.count = years * segments
+        self.width = (end - self.start) / self.count
+        self.powers = None
+
+    @classmethod
+    def fit(cls, first_year, last_year, segments=EPHEMERIS_SEGMENTS, degree=EPHEMERIS_DEGREE):
+        '''Fit the equation of time and declination for first_year to last_year.'''
+        import numpy
+        from numpy.polynomial import chebyshev
+
+        years = last_year - first_year + 1
+        ephemeris = cls(first_year, years, None, segments, degree)
+
+        # interpolate at the Chebyshev nodes of each segment
+        nodes = numpy.cos(numpy.pi * (numpy.arange(degree + 1) + 0.5) / (degree + 1))
+        lo = ephemeris.start + ephemeris.width * numpy.arange(ephemeris.count)
+        t = lo[:, None] + ephemeris.width * (nodes[None, :] + 1) / 2
+        eqTime, solarDec = calcSolarStateArray(t)
+
+        coefficients = numpy.empty((ephemeris.count, 2, degree + 1))
+        for i in range(ephemeris.count):
+            coefficients[i, 0] = chebyshev.chebfit(nodes, eqTime[i], degree)
+            coefficients[i, 1] = chebyshev.chebfit(nodes, solarDec[i], degree)
+        ephemeris.coefficients = coefficients.ravel().tolist()
+        return ephemeris
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        magic, first_year, years, segments, degree = CHEBYSHEV_HEADER.unpack_from(data, 0)
+        ncoefficients = years * segments * 2 * (degree + 1)
+        if magic != CHEBYSHEV_MAGIC or len(data) < CHEBYSHEV_HEADER.size + ncoefficients * 8:
+            raise ValueError("%s: not a Chebyshev ephemeris file" % filename)
+        coefficients = struct.unpack_from("<%dd" % ncoefficients, data, CHEBYSHEV_HEADER.size)
+        return cls(first_year, years, coefficients, segments, degree)
+
+    def save(self, filename):
+        tmpname = filename + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write(CHEBYSHEV_HEADER.pack(CHEBYSHEV_MAGIC, self.first_year, self.years,
+                                          self.segments, self.degree))
+            f.write(struct.pack("<%dd" % len(self.coefficients), *self.coefficients))
+        os.rename(tmpname, filename)
+
+    def solarState(self, t):
+        '''Drop-in replacement for calcSolarState.
+        @t : number of Julian centuries since J2000.0
+        Returns : eqTime (minutes of time), solarDec (degrees)'''
+        x = (t - self.start) / self.width
+        if not (0 <= x < self.count):     # also catches NaN
+            return calcSolarState(t)
+        segment = int(x)
+
+        # Clenshaw recurrence, for both series at once
+        u = 2.0 * (x - segment) - 1.0
+        u2 = u + u
+        c = self.coefficients
+        n = self.degree + 1
+        eq = segment * 2 * n
+        dec = eq + n
+        e1 = e2 = d1 = d2 = 0.0
+        for k in range(self.degree, 0, -1):
+            e1, e2 = u2 * e1 - e2 + c[eq + k], e1
+            d1, d2 = u2 * d1 - d2 + c[dec + k], d1
+        return u * e1 - e2 + c[eq], u * d1 - d2 + c[dec]
+
+    def powerSeries(self):
+        '''The fit as ordinary polynomials in the same variable, (equation of time,
+        declination) coefficient pairs highest power first, one list per segment, so
+        that each can be evaluated by Horner's rule. Worked out the first time it's
+        needed, from the Chebyshev coefficients.'''
+        if self.powers is None:
+            n = self.degree + 1
+            # power series of T0 .. Tdegree, lowest power first
+            bases = [[1.0], [0.0, 1.0]]
+            while len(bases) < n:
+                previous, before = bases[-1], bases[-2] + [0.0, 0.0]
+                bases.append([2.0 * a - b for a, b in zip([0.0] + previous, before)])
+            c = self.coefficients
+            powers = []
+            for segment in range(self.count):
+                series = []
+                for offset in (segment * 2 * n, segment * 2 * n + n):
+                    sums = [0.0] * n
+                    for k in range(n):
+                        for power, a in enumerate(bases[k]):
+                            sums[power] += c[offset + k] * a
+                    series.append(sums[::-1])
+                powers.append(zip(*series))
+            self.powers = powers
+        return self.powers
+
+    def calcSunriseSetUTC(self, JD, latitude, longitude):
+        '''calcSunriseSetUTC, using the fitted solar state. The same passes, but written
+        out here with the latitude's trig worked out once and each solar state a
+        Horner evaluation of the segment's power series, rather than through
+        calcSolarNoonState and calcSunEventUTC.
+        Returns : riseTime, setTime in minutes from zero Z, NaN if there is no such event'''
+        powers = self.powerSeries()
+        start = self.start
+        width = self.width
+        count = self.count
+
+        def state(jd):
+            t = (jd - 2451545.0) / 36525.0
+            x = (t - start) / width
+            if not (0 <= x < count):
+                return calcSolarState(t)
+            segment = int(x)
+            u = 2.0 * (x - segment) - 1.0
+            eqTime = solarDec = 0.0
+            for a, b in powers[segment]:
+                eqTime = eqTime * u + a
+                solarDec = solarDec * u + b
+            return eqTime, solarDec
+
+        latRad = degToRad(latitude)
+        cosLat = math.cos(latRad)
+        tanLat = math.tan(latRad)
+        cosZenith = math.cos(degToRad(SUNRISE_ZENITH))
+
+        def hourAngle(solarDec):
+            sdRad = degToRad(solarDec)
+            HAarg = cosZenith / (cosLat * math.cos(sdRad)) - tanLat * math.tan(sdRad)
+            if abs(HAarg) > 1.0:
+                return None
+            return radToDeg(math.acos(HAarg))
+
+        # solar noon, as calcSolNoonUTC and calcSolarNoonState
+        noon = 720 + longitude * 4
+        solNoonUTC = noon - state(JD + longitude / 360.0)[0]
+        solNoonUTC = noon - state(JD - 0.5 + solNoonUTC / 1440.0)[0]
+        noonEqTime, noonDec = state(JD + solNoonUTC / 1440.0)
+
+        # and each event, as calcSunEventUTC
+        noonAngle = hourAngle(noonDec)
+        times = []
+        for sign in (1, -1):
+            if noonAngle is None:
+                times.append(float('nan'))
+                continue
+            timeUTC = noon - 4 * sign * noonAngle - noonEqTime
+            eqTime, solarDec = state(JD + timeUTC / 1440.0)
+            angle = hourAngle(solarDec)
+            if angle is None:
+                times.append(float('nan'))
+            else:
+                times.append(noon - 4 * sign * angle - eqTime)
+        return times[0], times[1]
+
+    def calcSun(self, latitude, longitude, date):
+        '''calcSun, using the fitted solar state. The special cases near earth's poles
+        are handed to calcSun.
+        Returns: riseTime, setTime - UTC timestamp tuple'''
+        if ((latitude >= -90) and (latitude < -89)) :
+            latitude = -89
+        if ((latitude <= 90) and (latitude > 89)) :
+            latitude = 89
+
+        JD = calcJD(date.year, date.month, date.day)
+        riseTimeGMT, setTimeGMT = self.calcSunriseSetUTC(JD, latitude, longitude)
+        if not isNumber(riseTimeGMT) or not isNumber(setTimeGMT):
+            return calcSun(latitude, longitude, date)
+
+        baseDate = calendar.timegm([date.year, date.month, date.day,0,0,0])
+        return baseDate + riseTimeGMT * 60, baseDate + setTimeGMT * 60
+
+
+#**********************************************************************
+#**********************************************************************
+#
+# Caching. SunCache remembers recent calcSun results, and can be backed
+# by an ephemeris file of precomputed rise/set times for one site, and
+# for any other site by a Chebyshev ephemeris file (see above).
+#
+# Ephemeris file layout (little endian):
+#   header : magic "SOMASUN1", latitude (double), longitude (double),
+#            ordinal of the first date (int32), number of days (int32)
+#   records: riseTime, setTime (doubles, UTC timestamps), one per day
+#
+#**********************************************************************
+#**********************************************************************
+
+EPHEMERIS_MAGIC = "SOMASUN1"
+EPHEMERIS_HEADER = struct.Struct("<8sddii")
+EPHEMERIS_RECORD = struct.Struct("<dd")
+
+
+def writeEphemeris(filename, latitude, longitude, start_date, end_date):
+    '''Precompute sunrise and sunset for every day from start_date to end_date and
+    write them to an ephemeris file. Uses calcSunRange if numpy is available.
+    @filename : file to write. It is replaced atomically.
+    @latitude : latitude of observer in degrees
+    @longitude : longitude of observer in degrees
+    @start_date : first date in the file
+    @end_date : last date in the file'''
+    try:
+        riseTimes, setTimes = calcSunRange(latitude, longitude, start_date, end_date)
+    except ImportError:
+        riseTimes, setTimes = [], []
+        date = start_date
+        while date <= end_date:
+            riseTime, setTime = calcSun(latitude, longitude, date)
+            riseTimes.append(riseTime)
+            setTimes.append(setTime)
+            date += datetime.timedelta(days=1)
+
+    tmpname = filename + ".tmp"
+    with open(tmpname, "wb") as f:
+        f.write(EPHEMERIS_HEADER.pack(EPHEMERIS_MAGIC, latitude, longitude,
+                                      start_date.toordinal(), len(riseTimes)))
+        for riseTime, setTime in zip(riseTimes, setTimes):
+            f.write(EPHEMERIS_RECORD.pack(riseTime, setTime))
+    os.rename(tmpname, filename)
+
+
+class Ephemeris(object):
+    '''Read-only view of an ephemeris file. The file is memory mapped the first time
+    it is needed, and lookups read a single record straight out of the map.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.map = None
+        self.latitude = None
+        self.longitude = None
+        self.first = 0
+        self.count = 0
+
+    def open(self):
+        with open(self.filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.latitude, self.longitude, self.first, self.count = EPHEMERIS_HEADER.unpack_from(self.map, 0)
+        if magic != EPHEMERIS_MAGIC or len(self.map) < EPHEMERIS_HEADER.size + self.count * EPHEMERIS_RECORD.size:
+            raise ValueError("%s: not an ephemeris file" % self.filename)
+
+    def lookup(self, latitude, longitude, date):
+        '''Returns: riseTime, setTime - UTC timestamp tuple, or None if the file is for
+        another site or doesn't cover the date'''
+        if self.map is None:
+            self.open()
+        if abs(latitude - self.latitude) > 1e-6 or abs(longitude - self.longitude) > 1e-6:
+            return None
+        index = date.toordinal() - self.first
+        if index < 0 or index >= self.count:
+            return None
+        return EPHEMERIS_RECORD.unpack_from(self.map, EPHEMERIS_HEADER.size + index * EPHEMERIS_RECORD.size)
+
+
+class SunCache(object):
+    '''Bounded LRU cache in front of calcSun, keyed by (latitude, longitude, date).
+    Misses are looked up in the ephemeris file, if one is given and exists, and only
+    computed if the file doesn't have them - with the Chebyshev ephemeris in
+    chebyshev_file, if one is given and exists, or else calcSun.'''
+
+    def __init__(self, size=64, ephemeris_file=None, chebyshev_file=None):
+        self.size = size
+        self.entries = OrderedDict()
+        self.ephemeris_file = ephemeris_file
+        self.ephemeris = None
+        self.chebyshev_file = chebyshev_file
+        self.chebyshev = None
+
+    def lookup_ephemeris(self, latitude, longitude, date):
+        if self.ephemeris is None:
+            if not self.ephemeris_file or not os.path.exists(self.ephemeris_file):
+                return None
+            self.ephemeris = Ephemeris(self.ephemeris_file)
+        try:
+            return self.ephemeris.lookup(latitude, longitude, date)
+        except (EnvironmentError, ValueError, struct.error):
+            self.ephemeris_file = None      # unreadable, don't try again
+            self.ephemeris = None
+            return None
+
+    def calculate(self, latitude, longitude, date):
+        '''calcSun, with the Chebyshev ephemeris if there is one'''
+        if self.chebyshev is None and self.chebyshev_file:
+            try:
+                self.chebyshev = ChebyshevEphemeris.load(self.chebyshev_file)
+            except (EnvironmentError, ValueError, struct.error):
+                self.chebyshev_file = None      # missing or unreadable, don't try again
+        if self.chebyshev is not None:
+            return self.chebyshev.calcSun(latitude, longitude, date)
+        return calcSun(latitude, longitude, date)
+
+    def calcSun(self, latitude, longitude, date):
+        '''Same as calcSun, but cached.
+        Returns: riseTime, setTime - UTC timestamp tuple'''
+        key = (latitude, longitude, date)
+        result = self.entries.pop(key, None)
+        if result is None:
+            result = self.lookup_ephemeris(latitude, longitude, date)
+            if result is None:
+                result = self.calculate(latitude, longitude, date)
+            if len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+        self.entries[key] = result
+        return result
+
+    def twilight(self, latitude, longitude, date, kind):
+        '''Start (dawn) and end (dusk) of civil, nautical or astronomical twilight, see
+        TWILIGHT_ZENITHS. All kinds are calculated and cached together. Where the sun
+        never gets down (or up) to the twilight angle, the time it comes closest is used.
+        Returns: dawn, dusk - UTC timestamp tuple'''
+        key = (latitude, longitude, date, "twilight")
+        result = self.entries.pop(key, None)
+        if result is None:
+            kinds = sorted(TWILIGHT_ZENITHS)
+            events = calcSunEvents(latitude, longitude, date, [TWILIGHT_ZENITHS[k] for k in kinds], clamp=True)
+            result = dict(zip(kinds, events))
+            if len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+        self.entries[key] = result
+        return result[kind]
+
+
 if __name__ == '__main__':
 #    latitude = 37.451688
 #    longitude = 122.18305
@@ -654,9 +1419,24 @@ if __name__ == '__main__':
                       
     parser.add_option("--long", dest="longitude", default=122.18305, type="float",
                        help="Positive WEST of meridian.")
+    parser.add_option("--write-ephemeris", dest="ephemeris_file",
+                       help="Write precomputed sunrise and sunset times to this file instead")
+    parser.add_option("--write-chebyshev", dest="chebyshev_file",
+                       help="Write a Chebyshev ephemeris (see ChebyshevEphemeris) to this file instead")
+    parser.add_option("--years", dest="years", default="%d:%d" % (datetime.date.today().year, datetime.date.today().year + 10),
+                       help="Years covered by the ephemeris file, FIRST:LAST. Default the next ten years")
     parser.description = "Calculates today's sunrise and sunset for a given latitude and longitude (default, San Francisco)"
                      
     opts, args = parser.parse_args()
+
+    first, last = [int(year) for year in opts.years.split(":")]
+    if opts.ephemeris_file:
+        writeEphemeris(opts.ephemeris_file, opts.latitude, opts.longitude,
+                       datetime.date(first, 1, 1), datetime.date(last, 12, 31))
+        raise SystemExit
+    if opts.chebyshev_file:
+        ChebyshevEphemeris.fit(first, last).save(opts.chebyshev_file)
+        raise SystemExit
                    
 
     #riseTime, setTime = calcNextSun(latitude, longitude, datetime.date.today())
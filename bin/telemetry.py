@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## The uBrain's once a second status line, decoded and kept in memory:
+##
+##     @2014-08-10 21:15:03   5412.35   Acc: 0.01953     Amps: 3.27     TempRaw: 151 150 149 153   TempF: 76.37  75.61  74.84  77.89
+##
+## ubrain-daemon adds each one to a Telemetry, which keeps three tiers of fixed
+## size, each a set of arrays with one slot per time bucket (no objects per
+## sample):
+##     1 second   for the last hour
+##     1 minute   for the last day
+##     1 hour     for the last 30 days
+## Each slot has the number of samples in the bucket and the sum, minimum and
+## maximum of each field over them.
+##
+## ubrain-daemon answers queries on /var/run/soma/telemetry.sock:
+##
+##     telemetry.py [--tier 60] [--last 3600] [--socket PATH]
+##
+## prints the mean, min and max of each field for each minute of the last hour.
+##
+
+import os
+import sys
+import time
+import errno
+import socket
+from array import array
+from optparse import OptionParser
+
+FIELDS = ("acc", "amps", "temp1", "temp2", "temp3", "temp4")
+# (seconds per bucket, buckets)
+TIERS = ((1, 3600), (60, 1440), (3600, 720))
+
+
+def decode_status(line):
+    ''' Returns: tuple of the values of FIELDS from a status line, or None if it
+        isn't one. Temperatures are the TempF ones.'''
+    tokens = line.split()
+    if len(tokens) != 17 or tokens[3] != "Acc:" or tokens[5] != "Amps:" or tokens[12] != "TempF:" \
+       or not tokens[0].startswith("@"):
+        return None
+    try:
+        return (float(tokens[4]), float(tokens[6]),
+                float(tokens[13]), float(tokens[14]), float(tokens[15]), float(tokens[16]))
+    except ValueError:
+        return None
+
+
+class Tier(object):
+    ''' Ring buffer of buckets seconds long, capacity of them. Slot i holds the
+        bucket starting at times[i]; the oldest is at head once the ring is full.'''
+
+    def __init__(self, seconds, capacity, fields=FIELDS):
+        self.seconds = seconds
+        self.capacity = capacity
+        self.fields = fields
+        self.times = array("d", [0.0]) * capacity
+        self.counts = array("I", [0]) * capacity
+        self.sums = [array("d", [0.0]) * capacity for field in fields]
+        self.mins = [array("d", [0.0]) * capacity for field in fields]
+        self.maxs = [array("d", [0.0]) * capacity for field in fields]
+        self.head = 0
+        self.size = 0
+
+    def add(self, t, values):
+        bucket = t - t % self.seconds
+        last = (self.head - 1) % self.capacity
+        if self.size and self.times[last] == bucket:
+            self.counts[last] += 1
+            for sums, mins, maxs, value in zip(self.sums, self.mins, self.maxs, values):
+                sums[last] += value
+                if value < mins[last]:
+                    mins[last] = value
+                if value > maxs[last]:
+                    maxs[last] = value
+            return
+        if self.size and bucket < self.times[last]:
+            # the clock has been set back, so the ring would be out of order
+            self.size = 0
+        i = self.head
+        self.times[i] = bucket
+        self.counts[i] = 1
+        for sums, mins, maxs, value in zip(self.sums, self.mins, self.maxs, values):
+            sums[i] = mins[i] = maxs[i] = value
+        self.head = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def __len__(self):
+        return self.size
+
+    def _slot(self, n):
+        ''' Returns: slot of the nth oldest bucket'''
+        return (self.head - self.size + n) % self.capacity
+
+    def _find(self, t):
+        ''' Returns: how many buckets start before t, by bisection'''
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self._slot(middle)] < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def rows(self, start=None, end=None):
+        ''' Returns: list of (bucket start, count, [(mean, min, max) for each field])
+            for the buckets starting in [start, end), oldest first'''
+        first, last = 0, self.size
+        if start is not None:
+            first = self._find(start)
+        if end is not None:
+            last = self._find(end)
+        rows = []
+        for n in range(first, last):
+            i = self._slot(n)
+            count = self.counts[i]
+            rows.append((self.times[i], count,
+                         [(sums[i] / count, mins[i], maxs[i])
+                          for sums, mins, maxs in zip(self.sums, self.mins, self.maxs)]))
+        return rows
+
+
+class Telemetry(object):
+    ''' Every tier, fed the same samples'''
+
+    def __init__(self, tiers=TIERS, fields=FIELDS):
+        self.fields = fields
+        self.tiers = [Tier(seconds, capacity, fields) for seconds, capacity in tiers]
+
+    def add(self, t, values):
+        for tier in self.tiers:
+            tier.add(t, values)
+
+    def tier(self, seconds):
+        for tier in self.tiers:
+            if tier.seconds == seconds:
+                return tier
+        raise ValueError("no %d second tier" % seconds)
+
+    def report(self, seconds, start=None, end=None):
+        ''' Returns: the rows of a tier as text, with a header line naming the columns'''
+        lines = ["time count " + " ".join("%s_mean %s_min %s_max" % (f, f, f) for f in self.fields)]
+        for t, count, stats in self.tier(seconds).rows(start, end):
+            lines.append("%.0f %d " % (t, count) + " ".join("%.3f %.3f %.3f" % s for s in stats))
+        return "\n".join(lines) + "\n"
+
+
+class QueryServer(object):
+    ''' Answers "SECONDS [START [END]]" on a Unix socket with Telemetry.report.
+        Connections are only read once select says so, so a slow client doesn't hold
+        up the daemon.'''
+
+    def __init__(self, path, telemetry):
+        if os.path.exists(path):
+            os.remove(path)
+        self.telemetry = telemetry
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.sock.setblocking(0)
+        # connection -> what it has sent so far
+        self.pending = {}
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connections(self):
+        return self.pending.keys()
+
+    def accept(self):
+        try:
+            connection = self.sock.accept()[0]
+        except socket.error:
+            return
+        connection.setblocking(0)
+        self.pending[connection] = ""
+
+    def readable(self, connection):
+        try:
+            data = connection.recv(256)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        request = self.pending.pop(connection) + data
+        if data and not request.endswith("\n") and len(request) < 256:
+            self.pending[connection] = request
+            return
+        try:
+            fields = [float(x) for x in request.split()]
+            reply = self.telemetry.report(int(fields[0]), *fields[1:3])
+        except (ValueError, IndexError), e:
+            reply = "error %s\n" % e
+        try:
+            connection.settimeout(1.0)
+            connection.sendall(reply)
+        except socket.error:
+            pass
+        connection.close()
+
+
+def query(path, seconds, start=None, end=None):
+    ''' Ask ubrain-daemon for a tier.
+        Returns: the report text'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5.0)
+    sock.connect(path)
+    request = " ".join("%.3f" % x for x in [seconds, start, end] if x is not None)
+    sock.sendall(request + "\n")
+    reply = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        reply.append(data)
+    sock.close()
+    return "".join(reply)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--socket", dest="socket", default="/var/run/soma/telemetry.sock",
+                      help="ubrain-daemon's telemetry socket. Default /var/run/soma/telemetry.sock")
+    parser.add_option("--tier", dest="tier", default=60, type="int",
+                      help="Bucket size in seconds: %s. Default 60" % ", ".join(str(s) for s, c in TIERS))
+    parser.add_option("--last", dest="last", default=3600.0, type="float",
+                      help="How many seconds back to go. Default 3600")
+    options, args = parser.parse_args()
+
+    sys.stdout.write(query(options.socket, options.tier, time.time() - options.last))
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Weeks of uBrain telemetry on the BeagleBone's flash, without a database.
+##
+## ubrain-daemon appends each decoded status line (see telemetry.py) to a segment
+## file in /var/lib/soma/telemetry as a fixed width record:
+##     time (double, unix time), then acc, amps, temp1..temp4 (float each)
+## all little endian, 32 bytes. Segments are numbered in the order they are written,
+## telemetry-00000001.seg and so on, and a new one is started once a segment reaches
+## --log-segment-size, or if the clock goes backwards, so the records in a segment
+## are always in time order. The oldest segments are deleted to keep the total under
+## --log-max-size.
+##
+## Next to each segment, telemetry-<number>.idx has the time and record number of
+## every INDEX_EVERY'th record, so a reader can get to a time by reading a few
+## hundred bytes of index and one page of the segment.
+##
+##     telemetry_log.py [--dir DIR] [--start T] [--end T] [--bucket SECONDS]
+##
+## prints the records from T to T (default the last hour), or with --bucket, the
+## mean, min and max of each field per bucket. Times are unix times, or negative
+## for that many seconds ago.
+##
+
+import os
+import time
+import mmap
+import glob
+import struct
+import bisect
+from optparse import OptionParser
+
+import telemetry
+
+RECORD = struct.Struct("<d%df" % len(telemetry.FIELDS))
+INDEX_ENTRY = struct.Struct("<dI")
+INDEX_EVERY = 256
+SEGMENT_PREFIX = "telemetry-"
+
+
+class SegmentLog(object):
+    ''' ubrain-daemon's side: appends records, rotating segments as they fill.
+        flush_every records are written at a time; 1 writes each one as it comes,
+        so that at most the one being written is lost if the power goes.'''
+
+    def __init__(self, directory, segment_size=1 << 20, max_size=64 << 20, flush_every=1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.flush_every = flush_every
+        self.segment = None
+        self.index = None
+        self.records = 0
+        self.last_time = None
+        self.buffered = []
+        self.index_buffered = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open_segment(self):
+        self.close()
+        segments = segment_names(self.directory)
+        number = 1
+        if segments:
+            number = segment_number(segments[-1]) + 1
+        name = os.path.join(self.directory, "%s%08d" % (SEGMENT_PREFIX, number))
+        self.segment = open(name + ".seg", "ab")
+        self.index = open(name + ".idx", "ab")
+        self.records = 0
+        self.expire()
+
+    def expire(self):
+        ''' Delete the oldest segments until the rest fit in max_size'''
+        segments = segment_names(self.directory)
+        sizes = []
+        for name in segments:
+            try:
+                sizes.append(os.path.getsize(name + ".seg") + os.path.getsize(name + ".idx"))
+            except OSError:
+                sizes.append(0)
+        total = sum(sizes)
+        for name, size in zip(segments[:-1], sizes):
+            if total <= self.max_size:
+                break
+            for extension in (".seg", ".idx"):
+                try:
+                    os.remove(name + extension)
+                except OSError:
+                    pass
+            total -= size
+
+    def append(self, t, values):
+        if self.segment is None or self.records * RECORD.size >= self.segment_size or \
+           (self.last_time is not None and t < self.last_time):
+            self.flush()
+            self.open_segment()
+        if self.records % INDEX_EVERY == 0:
+            self.index_buffered.append(INDEX_ENTRY.pack(t, self.records))
+        self.buffered.append(RECORD.pack(t, *values))
+        self.records += 1
+        self.last_time = t
+        if len(self.buffered) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.segment is None:
+            return
+        if self.buffered:
+            self.segment.write("".join(self.buffered))
+            self.segment.flush()
+            self.buffered = []
+        if self.index_buffered:
+            self.index.write("".join(self.index_buffered))
+            self.index.flush()
+            self.index_buffered = []
+
+    def close(self):
+        self.flush()
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+        self.segment = self.index = None
+
+
+def segment_number(name):
+    return int(os.path.basename(name)[len(SEGMENT_PREFIX):])
+
+
+def segment_names(directory):
+    ''' Returns: segment file names without extension, oldest first'''
+    names = []
+    for name in glob.glob(os.path.join(directory, SEGMENT_PREFIX + "*.seg")):
+        try:
+            segment_number(name[:-4])
+        except ValueError:
+            continue
+        names.append(name[:-4])
+    return sorted(names, key=segment_number)
+
+
+class Segment(object):
+    ''' A segment, mmap'd for reading'''
+
+    def __init__(self, name):
+        self.name = name
+        self.map = None
+        with open(name + ".seg", "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # a record half written when the power went is left off
+            self.count = size // RECORD.size
+            if self.count:
+                self.map = mmap.mmap(f.fileno(), self.count * RECORD.size, mmap.MAP_SHARED, mmap.PROT_READ)
+        self.index_times = []
+        self.index_records = []
+        try:
+            with open(name + ".idx", "rb") as f:
+                data = f.read()
+            for i in range(len(data) // INDEX_ENTRY.size):
+                t, record = INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+                if record < self.count:
+                    self.index_times.append(t)
+                    self.index_records.append(record)
+        except IOError:
+            pass
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def time(self, i):
+        return struct.unpack_from("<d", self.map, i * RECORD.size)[0]
+
+    def first_time(self):
+        return self.time(0)
+
+    def last_time(self):
+        return self.time(self.count - 1)
+
+    def find(self, t):
+        ''' Returns: number of records before time t. The index narrows it down to
+            INDEX_EVERY records, then it's a binary search on the segment itself.'''
+        i = bisect.bisect_left(self.index_times, t)
+        low, high = 0, self.count
+        if i > 0:
+            low = self.index_records[i - 1]
+        if i < len(self.index_records):
+            high = self.index_records[i]
+        while low < high:
+            middle = (low + high) // 2
+            if self.time(middle) < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, first, last):
+        ''' Returns: list of (time, values...) tuples for records first to last'''
+        return [RECORD.unpack_from(self.map, i * RECORD.size) for i in range(first, last)]
+
+    def array(self, first, last):
+        ''' Returns: numpy record array of records first to last, straight from the
+            mmap without copying'''
+        import numpy
+        dtype = numpy.dtype([("time", "<f8")] + [(field, "<f4") for field in telemetry.FIELDS])
+        return numpy.frombuffer(self.map, dtype=dtype, count=last - first, offset=first * RECORD.size)
+
+
+def open_segments(directory, start, end):
+    ''' Returns: list of (Segment, first record, last record) for the records in
+        [start, end), oldest first'''
+    result = []
+    for name in segment_names(directory):
+        try:
+            segment = Segment(name)
+        except (IOError, OSError, ValueError):
+            continue
+        if segment.count == 0 or segment.first_time() >= end or segment.last_time() < start:
+            segment.close()
+            continue
+        result.append((segment, segment.find(start), segment.find(end)))
+    return result
+
+
+def read_range(directory, start, end):
+    ''' Returns: list of (time, values...) for every record in [start, end)'''
+    rows = []
+    for segment, first, last in open_segments(directory, start, end):
+        rows.extend(segment.records(first, last))
+        segment.close()
+    return rows
+
+
+def aggregate(directory, start, end, bucket):
+    ''' Returns: list of (bucket start, count, [(mean, min, max) for each field]) for
+        the buckets of bucket seconds from start to end that have records'''
+    import numpy
+    segments = open_segments(directory, start, end)
+    if not segments:
+        return []
+    records = numpy.concatenate([segment.array(first, last) for segment, first, last in segments])
+    for segment, first, last in segments:
+        segment.close()
+    # segments can overlap if the clock was set back
+    records = records[numpy.argsort(records["time"], kind="mergesort")]
+    buckets = numpy.floor((records["time"] - start) / bucket).astype(numpy.int64)
+    # where each bucket starts
+    starts = numpy.flatnonzero(numpy.concatenate(([True], buckets[1:] != buckets[:-1])))
+    counts = numpy.diff(numpy.concatenate((starts, [len(records)])))
+    stats = []
+    for field in telemetry.FIELDS:
+        values = records[field].astype(numpy.float64)
+        stats.append((numpy.add.reduceat(values, starts) / counts,
+                      numpy.minimum.reduceat(values, starts), numpy.maximum.reduceat(values, starts)))
+    rows = []
+    for n, i in enumerate(starts):
+        rows.append((start + buckets[i] * bucket, int(counts[n]),
+                     [(means[n], mins[n], maxs[n]) for means, mins, maxs in stats]))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--dir", dest="directory", default="/var/lib/soma/telemetry",
+                      help="Directory with the segments. Default /var/lib/soma/telemetry")
+    parser.add_option("--start", dest="start", default=-3600.0, type="float",
+                      help="From this unix time, or negative for seconds ago. Default -3600")
+    parser.add_option("--end", dest="end", default=0.0, type="float",
+                      help="To this unix time, or negative for seconds ago. Default now")
+    parser.add_option("--bucket", dest="bucket", type="float",
+                      help="Print the mean, min and max of each field over buckets this many seconds long")
+    options, args = parser.parse_args()
+
+    now = time.time()
+    start = options.start <= 0 and now + options.start or options.start
+    end = options.end <= 0 and now + options.end or options.end
+
+    if options.bucket:
+        print "time count " + " ".join("%s_mean %s_min %s_max" % (f, f, f) for f in telemetry.FIELDS)
+        for t, count, stats in aggregate(options.directory, start, end, options.bucket):
+            print "%.0f %d" % (t, count), " ".join("%.3f %.3f %.3f" % s for s in stats)
+    else:
+        print "time " + " ".join(telemetry.FIELDS)
+        for record in read_range(options.directory, start, end):
+            print "%.3f" % record[0], " ".join("%.3f" % value for value in record[1:])
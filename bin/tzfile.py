@@ -0,0 +1,315 @@
+#!/usr/bin/python
+# vi:set ai sw=4 ts=4 et:
+##
+## Local time <-> UTC for an explicit timezone, read straight from the system's
+## zoneinfo files (tzfile(5), as written by zic), without going through the process
+## TZ and libc. new_schedule.py uses this to turn "8:00pm" on a given date into unix
+## time.
+##
+##     zone = TimeZone.load("America/Los_Angeles")
+##     zone.local_to_utc(2014, 11, 2, 1, 30)      # first 1:30am, PDT
+##     zone.local_date(1407657600)                # date at that moment
+##
+## Times past the end of the file's transition table come from the POSIX TZ
+## string at the end of version 2+ files, which is all "slim" files have for
+## anything after the last rule change.
+##
+## Clock times that don't exist or happen twice are resolved the same way every time:
+##   gap  (spring forward) 2:30am is taken with the offset from before the change, so
+##                         it lands half an hour after it, at 3:30am PDT
+##   fold (fall back)      1:30am is the first one, before the clocks go back
+##
+
+import os
+import re
+import bisect
+import struct
+import datetime
+
+ZONEINFO_DIRS = ["/usr/share/zoneinfo", "/usr/lib/zoneinfo", "/usr/share/lib/zoneinfo"]
+LOCALTIME = "/etc/localtime"
+
+TZIF_HEADER = struct.Struct(">4sc15x6l")
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+POSIX_TZ = re.compile(r"^(<[^>]*>|[A-Za-z]{3,})([+-]?\d{1,2}(?::\d\d){0,2})"
+                      r"(?:(<[^>]*>|[A-Za-z]{3,})([+-]?\d{1,2}(?::\d\d){0,2})?"
+                      r"(?:,([^,]+),([^,]+))?)?$")
+POSIX_DATE = re.compile(r"^(?:M(\d+)\.(\d)\.(\d)|J(\d+)|(\d+))(?:/([+-]?\d+(?::\d\d){0,2}))?$")
+
+
+class TimeZoneError(Exception):
+    pass
+
+
+def parse_hms(text):
+    ''' "2", "-1:30", "26:00:00" -> seconds'''
+    sign = 1
+    if text[0] in "+-":
+        sign = text[0] == "-" and -1 or 1
+        text = text[1:]
+    seconds = 0
+    for i, part in enumerate(text.split(":")):
+        seconds += int(part) * (3600, 60, 1)[i]
+    return sign * seconds
+
+
+def days_from_epoch(year, month, day):
+    return datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL
+
+
+class PosixRule(object):
+    ''' The POSIX TZ string rules, e.g. "PST8PDT,M3.2.0,M11.1.0": a standard
+        offset and optionally a DST offset and the dates the clocks change'''
+
+    def __init__(self, text):
+        match = POSIX_TZ.match(text)
+        if match is None:
+            raise TimeZoneError("can't understand TZ string %r" % text)
+        std_name, std, dst_name, dst, start, end = match.groups()
+        self.text = text
+        # POSIX offsets are hours *west* of UTC
+        self.std = (-parse_hms(std), False, std_name.strip("<>"))
+        self.dst = None
+        if dst_name:
+            if dst is None:
+                self.dst = (self.std[0] + 3600, True, dst_name.strip("<>"))
+            else:
+                self.dst = (-parse_hms(dst), True, dst_name.strip("<>"))
+            self.start = self.parse_date(start or "M3.2.0")
+            self.end = self.parse_date(end or "M11.1.0")
+        self.years = {}
+
+    def parse_date(self, text):
+        match = POSIX_DATE.match(text)
+        if match is None:
+            raise TimeZoneError("can't understand TZ rule %r in %r" % (text, self.text))
+        month, week, weekday, julian, yday, at = match.groups()
+        if at is None:
+            at = "2"
+        at = parse_hms(at)
+        if month:
+            return ("M", int(month), int(week), int(weekday), at)
+        if julian:
+            return ("J", int(julian), 0, 0, at)
+        return ("n", int(yday), 0, 0, at)
+
+    def wall_day(self, rule, year):
+        ''' Returns: days from the epoch of the date rule picks in year'''
+        kind, a, b, c, at = rule
+        if kind == "M":
+            first = datetime.date(year, a, 1)
+            # weekday c, 0 is Sunday; week 5 means the last one in the month
+            day = 1 + (c - (first.weekday() + 1)) % 7 + (b - 1) * 7
+            next_month = datetime.date(year + a // 12, a % 12 + 1, 1)
+            while day > (next_month - first).days:
+                day -= 7
+            return days_from_epoch(year, a, day)
+        if kind == "J":
+            # 1-365, never counting February 29
+            day = days_from_epoch(year, 1, 1) + a - 1
+            if a >= 60 and (year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)):
+                day += 1
+            return day
+        return days_from_epoch(year, 1, 1) + a
+
+    def transitions(self, year):
+        ''' Returns: sorted list of (utc time, ttinfo) for the clock changes in year'''
+        if self.dst is None:
+            return []
+        if year not in self.years:
+            start = self.wall_day(self.start, year) * 86400 + self.start[4] - self.std[0]
+            end = self.wall_day(self.end, year) * 86400 + self.end[4] - self.dst[0]
+            self.years[year] = sorted([(start, self.dst), (end, self.std)])
+        return self.years[year]
+
+    def ttinfo(self, utc):
+        ''' Returns: (utc offset, isdst, abbreviation) at unix time utc'''
+        if self.dst is None:
+            return self.std
+        year = datetime.date.fromordinal(EPOCH_ORDINAL + int(utc // 86400)).year
+        changes = self.transitions(year)
+        # before the first change in the year, as after the last one
+        info = changes[-1][1]
+        for change, after in changes:
+            if utc >= change:
+                info = after
+        return info
+
+
+class TimeZone(object):
+    ''' A timezone: a table of transitions from a tzfile, and the POSIX rule for
+        after the last one.
+        ttinfo entries are (utc offset in seconds, isdst, abbreviation).'''
+
+    def __init__(self, name, transitions, infos, before, rule):
+        self.name = name
+        self.transitions = transitions
+        self.infos = infos
+        self.before = before
+        self.rule = rule
+        # days from the epoch -> list of (utc start, utc end, utc offset) near that day
+        self.days = {}
+        # (year, month, day) -> (wall clock midnight, offset or False, segments)
+        self.dates = {}
+
+    @classmethod
+    def load(cls, name=None):
+        ''' name is a zone such as "America/Los_Angeles", a path to a tzfile, or
+            None for the system timezone (/etc/localtime). A POSIX TZ string such
+            as "PST8PDT,M3.2.0,M11.1.0" also works.'''
+        if not name:
+            return cls.from_file(LOCALTIME, "localtime")
+        if name.startswith(":"):
+            name = name[1:]
+        if os.path.isabs(name):
+            return cls.from_file(name, name)
+        if ".." not in name.split("/"):
+            for directory in ZONEINFO_DIRS:
+                path = os.path.join(directory, name)
+                if os.path.isfile(path):
+                    return cls.from_file(path, name)
+        return cls(name, [], [], None, PosixRule(name))
+
+    @classmethod
+    def from_file(cls, path, name):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            return cls.from_tzif(data, name)
+        except (struct.error, IndexError), e:
+            raise TimeZoneError("%s: corrupt tzfile (%s)" % (path, e))
+
+    @classmethod
+    def from_tzif(cls, data, name):
+        magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = \
+            TZIF_HEADER.unpack_from(data, 0)
+        if magic != "TZif":
+            raise TimeZoneError("%s: not a tzfile" % name)
+        offset = TZIF_HEADER.size
+        time_format, leap_size = "l", 4
+        if version >= "2":
+            # skip the 32 bit data for the 64 bit data after it
+            offset += timecnt * 5 + typecnt * 6 + charcnt + leapcnt * 8 + isstdcnt + isutcnt
+            magic, version, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = \
+                TZIF_HEADER.unpack_from(data, offset)
+            offset += TZIF_HEADER.size
+            time_format, leap_size = "q", 8
+        times = list(struct.unpack_from(">%d%s" % (timecnt, time_format), data, offset))
+        offset += timecnt * leap_size
+        indexes = struct.unpack_from(">%dB" % timecnt, data, offset)
+        offset += timecnt
+        raw = []
+        for i in range(typecnt):
+            raw.append(struct.unpack_from(">lBB", data, offset))
+            offset += 6
+        chars = data[offset:offset + charcnt]
+        offset += charcnt + leapcnt * (leap_size + 4) + isstdcnt + isutcnt
+        infos = []
+        for utcoff, isdst, abbrind in raw:
+            infos.append((utcoff, bool(isdst), chars[abbrind:chars.index("\0", abbrind)]))
+
+        rule = None
+        if version >= "2":
+            footer = data[offset:].strip("\n")
+            if footer:
+                rule = PosixRule(footer)
+        # before the first transition: the first standard time type, as localtime.c does
+        before = infos and infos[0] or (0, False, "UTC")
+        for info in infos:
+            if not info[1]:
+                before = info
+                break
+        return cls(name, times, [infos[i] for i in indexes], before, rule)
+
+    def ttinfo(self, utc):
+        ''' Returns: (utc offset, isdst, abbreviation) at unix time utc'''
+        i = bisect.bisect_right(self.transitions, utc)
+        if i == len(self.transitions) and self.rule is not None:
+            return self.rule.ttinfo(utc)
+        if i == 0:
+            return self.before
+        return self.infos[i - 1]
+
+    def utcoffset(self, utc):
+        return self.ttinfo(utc)[0]
+
+    def changes(self, begin, end):
+        ''' Returns: list of (utc time, ttinfo before, ttinfo after) for each time the
+            offset or DST flag changes in [begin, end)'''
+        changes = []
+        i = bisect.bisect_left(self.transitions, begin)
+        while i < len(self.transitions) and self.transitions[i] < end:
+            changes.append(self.transitions[i])
+            i += 1
+        if self.rule is not None and (not self.transitions or end > self.transitions[-1]):
+            last = self.transitions and self.transitions[-1] or None
+            first_year = datetime.date.fromordinal(EPOCH_ORDINAL + int(begin // 86400)).year
+            last_year = datetime.date.fromordinal(EPOCH_ORDINAL + int(end // 86400)).year
+            for year in range(first_year, last_year + 1):
+                for change, info in self.rule.transitions(year):
+                    if begin <= change < end and (last is None or change > last):
+                        changes.append(change)
+        result = []
+        for change in changes:
+            before, after = self.ttinfo(change - 1), self.ttinfo(change)
+            if before[:2] != after[:2]:
+                result.append((change, before, after))
+        return result
+
+    def day_segments(self, days):
+        ''' Returns: list of (utc start, utc end, utc offset) covering every instant
+            whose local date could be days (from the epoch). Worked out once per day.'''
+        segments = self.days.get(days)
+        if segments is None:
+            # no offset is more than a day either way
+            begin = (days - 1) * 86400
+            end = (days + 2) * 86400
+            segments = []
+            start = begin
+            offset = self.utcoffset(begin)
+            for change, before, after in self.changes(begin, end):
+                segments.append((start, change, offset))
+                start, offset = change, after[0]
+            segments.append((start, end, offset))
+            self.days[days] = segments
+        return segments
+
+    def local_to_utc(self, year, month, day, hour=0, minute=0, second=0, fold=0):
+        ''' Returns: unix time of a local clock time. In a gap, the time is taken with
+            the offset from before it, so it comes out after the gap; in a fold, fold=0
+            is the first of the two, fold=1 the second.'''
+        date = (year, month, day)
+        offsets = self.dates.get(date)
+        if offsets is None:
+            days = days_from_epoch(year, month, day)
+            segments = self.day_segments(days)
+            # the offset, if it's the same all day
+            offsets = self.dates[date] = (days * 86400, len(segments) == 1 and segments[0][2], segments)
+        midnight, offset, segments = offsets
+        wall = midnight + hour * 3600 + minute * 60 + second
+        if offset is not False:
+            return wall - offset
+        matches = [wall - offset for start, end, offset in segments if start <= wall - offset < end]
+        if matches:
+            return fold and max(matches) or min(matches)
+        # in a gap: the last segment that ends before this wall time does
+        for start, end, offset in segments:
+            if end <= wall - offset:
+                gap_offset = offset
+        return wall - gap_offset
+
+    def local_date(self, utc):
+        ''' Returns: datetime.date at unix time utc'''
+        return datetime.date.fromordinal(EPOCH_ORDINAL + int((utc + self.utcoffset(utc)) // 86400))
+
+    def local_midnight(self, date):
+        ''' Returns: unix time of the start of date. Where the clocks go forward at
+            midnight that is 1:00am.'''
+        return self.local_to_utc(date.year, date.month, date.day)
+
+    def strftime(self, format, utc):
+        ''' time.strftime of the local time at utc, with %Z for the abbreviation'''
+        offset, isdst, abbreviation = self.ttinfo(utc)
+        wall = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(utc // 1) + offset)
+        return wall.strftime(format.replace("%Z", abbreviation.replace("%", "%%")))